@@ -49,6 +49,10 @@ setup(
         "tensorboardx",
     ],
 
+    entry_points={
+        "console_scripts": ["matrixabm-trace=matrixabm.tracing:cli"],
+    },
+
     url="http://github.com/nssac/matrixabm",
     classifiers=classifiers
 )
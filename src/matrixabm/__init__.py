@@ -6,14 +6,35 @@ import xactor as asys
 INFO_FINE = logging.INFO - 1
 WORLD_SIZE = len(asys.ranks())
 
-from .datatypes import Timestep, Constructor, StateUpdate
+from .datatypes import Timestep, Constructor, ConstructorTemplate, StateUpdate
 
-from .agent import Agent, AgentPopulation
+from .agent import Agent, AgentPopulation, DistributedAgentPopulation
 from .simulator import Simulator
 from .coordinator import Coordinator
 from .runner import Runner
+from .registry import AgentRegistry
+from .histogram import StreamingHistogram
+from .metrics import MetricsRegistry, MetricsAggregator
+from .memory import deep_sizeof
+from .combiner import (
+    Combiner,
+    SumCombiner,
+    LastWriteCombiner,
+    combinable,
+    get_combiners,
+)
 
-from .timestep_generator import TimestepGenerator, RangeTimestepGenerator
+from .timestep_generator import (
+    TimestepGenerator,
+    RangeTimestepGenerator,
+    ActivityTimestepGenerator,
+    EventCalendar,
+)
 from .state_store import StateStore, SQLite3Store
-from .load_balancer import RandomLoadBalancer, GreedyLoadBalancer
+from .flush_executor import FlushExecutor
+from .retention import RetentionPolicy
+from .aggregate_store import Aggregate, AggregateStore
+from .spatial_store import SpatialIndex, SpatialStore
+from .graph_store import CSRGraph, GraphStore
+from .load_balancer import RandomLoadBalancer, GreedyLoadBalancer, GraphLoadBalancer
 from .resource_manager import SQLite3Manager, TensorboardWriter
@@ -2,7 +2,10 @@
 
 from abc import ABC, abstractmethod
 
-from . import asys
+from . import asys, WORLD_SIZE
+from . import checkpoint
+from .datatypes import ConstructorTemplate
+from .registry import AgentRegistry
 
 
 class Agent(ABC):
@@ -11,8 +14,9 @@ class Agent(ABC):
     The Agent interface models a single agent in the simulation.
     Agents in the Matrix are not actors themselves.
     They are managed by a agent runner actor.
-    The agent runner actor calls the `step`, `is_alive` and `memory_usage`
-    methods of the agent at each timestep.
+    The agent runner actor calls the `step`, `is_alive`, `memory_usage`,
+    `next_wake_time`, `is_idle` and `interaction_keys` methods of the agent
+    at each timestep in which the agent is due.
     """
 
     @abstractmethod
@@ -45,6 +49,9 @@ class Agent(ABC):
     def memory_usage(self):
         """Return the memory usage of the agent.
 
+        If the runner is configured to measure the agents' memory usage,
+        this method is not used.
+
         Returns
         -------
         float
@@ -52,6 +59,63 @@ class Agent(ABC):
             This can be a relative number.
         """
 
+    def next_wake_time(self):
+        """Return the (real) time at which the agent is next due.
+
+        By default agents are stepped at every timestep.
+        Agents that have nothing to do until some future time
+        can return that time to "sleep" until then.
+        A sleeping agent is not stepped until the timestep
+        whose end is after its wake time.
+        While sleeping, the agent counts as zero CPU load.
+
+        Returns
+        -------
+        float or None
+            The next wake time,
+            or None if the agent is to be stepped at every timestep.
+        """
+        return None
+
+    def is_idle(self):
+        """Check if the agent is idle.
+
+        A sleeping agent that is idle may be hibernated by the runner,
+        i.e. moved out of memory into a node local on disk store
+        until its next wake time.
+        By default agents are not idle.
+
+        Returns
+        -------
+        bool
+            True if the agent is idle
+            False otherwise
+        """
+        return False
+
+    def interaction_keys(self):
+        """Return the keys of the shared state the agent used in its last step.
+
+        The keys are used for graph aware load balancing
+        (if the runners observe the agents' interactions).
+        Agents using the same key are taken to interact with each other;
+        a key may be any hashable and picklable value
+        (e.g. the ID of a location the agent visited),
+        and a key equal to the ID of another agent
+        makes the two agents interact.
+        By default the keys are derived from the agent's updates
+        (see `matrixabm.runner.Runner`);
+        agents may override this method
+        e.g. to also report the keys of the state they read.
+
+        Returns
+        -------
+        iterable or None
+            The interaction keys of the agent,
+            or None to use the keys of the agent's updates
+        """
+        return None
+
 
 class AgentPopulation(ABC):
     """Agent population interface.
@@ -64,6 +128,9 @@ class AgentPopulation(ABC):
     is supposed send a number of `create_agent` messages
     to the coordinator actor,
     one for every agent created.
+    Agents of the same class can instead be created in bulk
+    using a constructor template,
+    which is sent with a single `create_agent_bulk` message.
     Once all the `create_agent` messages are sent,
     the population actor sends the `create_agent_done` message
     to the coordinator actor.
@@ -71,11 +138,15 @@ class AgentPopulation(ABC):
     Receives
     --------
     * `create_agents` from Simulator
+    * `checkpoint` from Simulator
+    * `restore` from Simulator
 
     Sends
     -----
     * `create_agent*` to Coordinator
+    * `create_agent_bulk*` to Coordinator
     * `create_agent_done` to Coordinator
+    * `checkpoint_done` to Coordinator
     """
 
     def __init__(self, coordinator_aid):
@@ -97,10 +168,63 @@ class AgentPopulation(ABC):
             The current (to start) timestep
         """
         for args in self.do_create_agents(timestep):
-            self.coordinator_proxy.create_agent(*args, buffer_=True)
+            if isinstance(args[0], ConstructorTemplate):
+                self.coordinator_proxy.create_agent_bulk(*args, buffer_=True)
+            else:
+                self.coordinator_proxy.create_agent(*args, buffer_=True)
 
         self.coordinator_proxy.create_agent_done()
 
+    def get_checkpoint_state(self):
+        """Return the state of the population to be checkpointed.
+
+        By default all the attributes of the population are checkpointed.
+        Populations with unpicklable attributes should override this method
+        and `set_checkpoint_state`.
+
+        Returns
+        -------
+        object
+            The (picklable) state of the population
+        """
+        return dict(vars(self))
+
+    def set_checkpoint_state(self, state):
+        """Restore the state of the population.
+
+        Parameters
+        ----------
+        state : object
+            The state returned by `get_checkpoint_state`
+        """
+        vars(self).update(state)
+
+    def checkpoint(self, checkpoint_path):
+        """Write the population's shard of a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        rank = asys.current_rank()
+        path = checkpoint.shard_path(checkpoint_path, "population", rank)
+        checkpoint.write_shard(path, self.get_checkpoint_state())
+        self.coordinator_proxy.checkpoint_done(rank)
+
+    def restore(self, checkpoint_path):
+        """Restore the population's state from a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        rank = asys.current_rank()
+        path = checkpoint.shard_path(checkpoint_path, "population", rank)
+        self.set_checkpoint_state(checkpoint.read_shard(path))
+        self.coordinator_proxy.checkpoint_done(rank)
+
     @abstractmethod
     def do_create_agents(self, timestep):
         """Create new agents in the simulation.
@@ -121,4 +245,86 @@ class AgentPopulation(ABC):
                 Initial estimate step_time per unit simulated real time (in seconds)
             memory_usage : float
                 Initial estimate of memory usage
+
+            Instead of a 4 tuple, an item may also be a
+            3 tuple (template, step_time, memory_usage),
+            where template is a ConstructorTemplate
+            and step_time and memory_usage are the initial estimates
+            for each of the agents in the template.
+            The object IDs of the template are used as the agent IDs.
         """
+
+
+class DistributedAgentPopulation(AgentPopulation):
+    """Distributed agent population interface.
+
+    The distributed agent population models births of agents
+    when there is an agent population actor on every rank.
+    Each population actor creates its own share of the new agents,
+    constructs them directly on the local runner,
+    and only sends the IDs and initial load estimates of the new agents
+    to the coordinator actor using the `register_agent` message.
+    The agent handles are allocated locally
+    from a sequence striped over the ranks.
+    Agents are thus never sent through the master rank;
+    the coordinator may later move them to other ranks
+    to balance the load.
+
+    Receives
+    --------
+    * `create_agents` from Simulator
+    * `checkpoint` from Simulator
+    * `restore` from Simulator
+
+    Sends
+    -----
+    * `register_agent*` to Coordinator
+    * `register_agent_bulk*` to Coordinator
+    * `create_agent_done` to Coordinator
+    * `checkpoint_done` to Coordinator
+    """
+
+    def __init__(self, coordinator_aid, runner_aid):
+        """Initialize.
+
+        Parameters
+        ----------
+        coordinator_aid : str
+            ID of the agent coordinator actor
+        runner_aid : str
+            ID of the agent runner actors
+        """
+        super().__init__(coordinator_aid)
+        self.runner_aid = runner_aid
+        self.registry = AgentRegistry(asys.current_rank(), WORLD_SIZE)
+
+    def create_agents(self, timestep):
+        """Create new agents on the local runner.
+
+        Parameters
+        ----------
+        timestep : Timestep
+            The current (to start) timestep
+        """
+        rank = asys.current_rank()
+        runner = asys.local_actor(self.runner_aid)
+
+        for args in self.do_create_agents(timestep):
+            if isinstance(args[0], ConstructorTemplate):
+                template, step_time, memory_usage = args
+                agent_ids = template.object_ids
+                handles = [self.registry.allocate() for _ in agent_ids]
+                template.object_ids = handles
+                runner.create_agent_bulk(template)
+                self.coordinator_proxy.register_agent_bulk(
+                    rank, handles, agent_ids, step_time, memory_usage, buffer_=True
+                )
+            else:
+                agent_id, constructor, step_time, memory_usage = args
+                handle = self.registry.allocate()
+                runner.create_agent(handle, constructor)
+                self.coordinator_proxy.register_agent(
+                    rank, handle, agent_id, step_time, memory_usage, buffer_=True
+                )
+
+        self.coordinator_proxy.create_agent_done()
@@ -0,0 +1,347 @@
+"""Streaming aggregate output store.
+
+Often only aggregates of the agents' outputs are analysed
+(e.g. the number of agents in every state at every step,
+or the mean and distribution of some value),
+yet every per agent row is stored and aggregated afterwards.
+
+An aggregate store instead computes declared group by aggregates
+of the values observed by the agents while it flushes,
+and persists only the per step results.
+Agents observe values by sending `observe` updates::
+
+    StateUpdate(store_name, order_key, "observe", aggregate, step, *key, value)
+
+where `key` has one value for every group by column of the aggregate.
+
+The results of every aggregate are written to a table of the same name
+in the store's SQLite3 database, with the columns::
+
+    step, <group by columns>, <statistics>
+
+and optionally to a columnar NumPy ``.npz`` file per aggregate and step.
+The results of the latest step are kept in memory,
+and can be read by the agents in the next step
+(using `AggregateStore.read_latest` on any rank of the node).
+
+The observed values of a flush are folded in order key order,
+so the results are identical on every node.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from . import INFO_FINE
+from . import tracing
+from .state_store import SQLite3Store
+from .histogram import StreamingHistogram
+
+# Supported statistics
+STATS = ("count", "sum", "mean", "var", "min", "max")
+
+# Default statistics
+DEFAULT_STATS = ("count", "sum", "mean", "min", "max")
+
+
+class Aggregate:
+    """A declared group by aggregate of observed values.
+
+    Attributes
+    ----------
+    name : str
+        Name of the aggregate (and its results table)
+    group_by : list of str
+        The group by columns
+    stats : list of str
+        The statistics computed for every group (see `STATS`)
+    quantiles : list of float
+        Quantiles estimated for every group
+    histogram : bool
+        If True, the histogram of the values of every group is stored
+    """
+
+    def __init__(
+        self, name, group_by=(), stats=DEFAULT_STATS, quantiles=(), histogram=False
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        name : str
+            Name of the aggregate (and its results table)
+        group_by : list of str
+            The group by columns
+        stats : list of str
+            The statistics computed for every group (see `STATS`)
+        quantiles : list of float
+            Quantiles estimated for every group
+            (using a `StreamingHistogram`; requires non-negative values)
+        histogram : bool
+            If True, the histogram of the values of every group is stored
+            (as a JSON list of bin right edges and counts)
+        """
+        for stat in stats:
+            if stat not in STATS:
+                raise ValueError("Unknown statistic %r" % stat)
+
+        self.name = name
+        self.group_by = list(group_by)
+        self.stats = list(stats)
+        self.quantiles = [float(q) for q in quantiles]
+        self.histogram = bool(histogram)
+
+    def result_columns(self):
+        """Return the names of the result columns (after the group by columns)."""
+        columns = list(self.stats)
+        columns.extend("q_%s" % str(q).replace(".", "_") for q in self.quantiles)
+        if self.histogram:
+            columns.append("histogram")
+        return columns
+
+    def new_accumulator(self):
+        """Return a new accumulator of the values of a group."""
+        return _Accumulator(self.quantiles or self.histogram)
+
+    def results(self, acc):
+        """Return the results of a group.
+
+        Parameters
+        ----------
+        acc : _Accumulator
+            The accumulator of the values of the group
+
+        Returns
+        -------
+        list
+            The values of the result columns
+        """
+        mean = acc.sum / acc.count
+        values = {
+            "count": acc.count,
+            "sum": acc.sum,
+            "mean": mean,
+            "var": max(acc.sum_squares / acc.count - mean * mean, 0.0),
+            "min": acc.min,
+            "max": acc.max,
+        }
+        results = [values[stat] for stat in self.stats]
+        results.extend(acc.hist.quantile(q) for q in self.quantiles)
+        if self.histogram:
+            bins = [(float(e), int(c)) for e, c in acc.hist.nonempty_bins()]
+            results.append(json.dumps(bins))
+        return results
+
+
+def _results_by_key(aggregate, rows):
+    """Convert result rows of an aggregate to a dict of group key to results."""
+    n_keys = len(aggregate.group_by)
+    columns = aggregate.result_columns()
+    return {
+        tuple(row[1 : n_keys + 1]): dict(zip(columns, row[n_keys + 1 :]))
+        for row in rows
+    }
+
+
+class _Accumulator:
+    """Running statistics of the values of a group."""
+
+    __slots__ = ["count", "sum", "sum_squares", "min", "max", "hist"]
+
+    def __init__(self, with_histogram):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.hist = StreamingHistogram() if with_histogram else None
+
+    def add(self, value):
+        """Add a value."""
+        self.count += 1
+        self.sum += value
+        self.sum_squares += value * value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.hist is not None:
+            self.hist.add(value)
+
+
+class AggregateStore(SQLite3Store):
+    """Streaming aggregate output store.
+
+    Attributes
+    ----------
+    aggregates : dict [str -> Aggregate]
+        The declared aggregates
+    output_dir : str or None
+        Directory where the columnar results are written
+    latest : dict [str -> dict [tuple -> dict]]
+        Aggregate name to group key to the results of the latest step
+    """
+
+    def __init__(
+        self,
+        store_name,
+        simulator_aid,
+        sqlite3_aid,
+        aggregates,
+        output_dir=None,
+        **kwargs,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_name : str
+            Name of the current state store
+        simulator_aid : str
+            ID of the simulator actor
+        sqlite3_aid : str
+            ID of the local SQLite3 connection manager
+        aggregates : list of Aggregate
+            The declared aggregates
+        output_dir : str, optional
+            If given, the results of every aggregate and step
+            are also written to ``<output_dir>/<aggregate>-<step>.npz``
+        **kwargs : dict
+            Other arguments of `SQLite3Store`
+        """
+        super().__init__(store_name, simulator_aid, sqlite3_aid, **kwargs)
+
+        self.aggregates = {aggregate.name: aggregate for aggregate in aggregates}
+        self.output_dir = output_dir
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Accumulators of the current flush keyed by (aggregate, step, key)
+        self.accumulators = {}
+        self.latest = {name: {} for name in self.aggregates}
+
+        con = self.connection()
+        for aggregate in self.aggregates.values():
+            columns = ["step"] + aggregate.group_by + aggregate.result_columns()
+            sql = f"""
+                create table if not exists
+                {store_name}.{aggregate.name} ({", ".join(columns)})
+                """
+            con.execute(sql)
+            sql = f"""
+                create index if not exists
+                {store_name}.{aggregate.name}_step_idx
+                on {aggregate.name} (step)
+                """
+            con.execute(sql)
+
+    def observe(self, aggregate, step, *args):
+        """Observe a value.
+
+        Parameters
+        ----------
+        aggregate : str
+            Name of the aggregate
+        step : int or float
+            The current timestep
+        *args : tuple
+            The group by key followed by the observed value
+        """
+        key = (aggregate, step, args[:-1])
+        acc = self.accumulators.get(key)
+        if acc is None:
+            acc = self.aggregates[aggregate].new_accumulator()
+            self.accumulators[key] = acc
+        acc.add(args[-1])
+
+    def apply_updates(self):
+        """Fold the observed values and write the results."""
+        super().apply_updates()
+
+        # Results grouped by (aggregate, step)
+        results = {}
+        for (name, step, key), acc in sorted(self.accumulators.items()):
+            rows = results.setdefault((name, step), [])
+            rows.append((step, *key, *self.aggregates[name].results(acc)))
+        self.accumulators.clear()
+
+        self.log.log(INFO_FINE, "Writing results of %d aggregates", len(results))
+        con = self.connection()
+        with tracing.span("write_results", cat="store", n_results=len(results)):
+            for (name, step), rows in results.items():
+                marks = ",".join(["?"] * len(rows[0]))
+                sql = f"insert into {self.store_name}.{name} values ({marks})"
+                con.executemany(sql, rows)
+
+                if self.output_dir is not None:
+                    self._write_columns(name, step, rows)
+
+        # Keep the results of the latest step of every aggregate
+        latest_steps = {}
+        for name, step in results:
+            if step >= latest_steps.get(name, step):
+                latest_steps[name] = step
+        for name, step in latest_steps.items():
+            self.latest[name] = _results_by_key(
+                self.aggregates[name], results[name, step]
+            )
+
+    def _write_columns(self, name, step, rows):
+        """Write the results of an aggregate and step to a NumPy npz file."""
+        aggregate = self.aggregates[name]
+        columns = ["step"] + aggregate.group_by + aggregate.result_columns()
+        arrays = {col: np.array(values) for col, values in zip(columns, zip(*rows))}
+        fname = os.path.join(self.output_dir, "%s-%s.npz" % (name, step))
+        np.savez(fname, **arrays)
+
+    def get(self, aggregate, *key):
+        """Return the results of a group in the latest step.
+
+        Parameters
+        ----------
+        aggregate : str
+            Name of the aggregate
+        *key : tuple
+            The group by key
+
+        Returns
+        -------
+        dict [str -> object] or None
+            The results of the group, if any
+        """
+        return self.latest[aggregate].get(key)
+
+    def load_checkpoint(self, path):
+        """Replace the database with the checkpointed copy."""
+        super().load_checkpoint(path)
+        con = self.connection()
+        for name, aggregate in self.aggregates.items():
+            self.latest[name] = self.read_latest(con, self.store_name, aggregate)
+
+    @staticmethod
+    def read_latest(con, store_name, aggregate):
+        """Read the results of the latest step of an aggregate.
+
+        Parameters
+        ----------
+        con : sqlite3.Connection
+            Connection with the store's database attached
+            (e.g. of the local SQLite3 manager)
+        store_name : str
+            Name of the store's database
+        aggregate : Aggregate
+            The aggregate
+
+        Returns
+        -------
+        dict [tuple -> dict [str -> object]]
+            Group key to the results of the group
+        """
+        name = aggregate.name
+        sql = f"""
+            select *
+            from {store_name}.{name}
+            where step = (select max(step) from {store_name}.{name})
+            """
+        return _results_by_key(aggregate, con.execute(sql))
@@ -0,0 +1,159 @@
+"""NumPy array directories shared by the ranks of a node.
+
+Stores that keep their state in NumPy arrays
+(e.g. `matrixabm.spatial_store` and `matrixabm.graph_store`)
+live on a single rank of the node,
+while the agents reading the state may be on any rank of the node.
+Such a store publishes a new version of its arrays after every flush
+as a directory of ``.npy`` files (and a ``meta.json`` file)
+in a node local directory,
+and atomically updates the ``CURRENT`` file of the directory
+to point to it.
+The other ranks memory map the latest version,
+and reload it only when a new version has been published.
+
+A published version is never modified.
+The two latest versions are kept,
+as readers may still map the previous version.
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+# Name of the file pointing to the latest published version
+CURRENT_FILE = "CURRENT"
+
+# Number of published versions kept
+KEEP_VERSIONS = 2
+
+# Latest loaded object of every directory of this process
+# as (version, object) tuples keyed by directory
+_LATEST = {}
+
+
+def concat_ranges(starts, counts):
+    """Return the concatenation of the ranges [start, start + count)."""
+    offsets = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(offsets - starts, counts)
+
+
+def to_csr(query_index, values, n_queries):
+    """Group values by their query index into (offsets, values) arrays."""
+    order = np.argsort(query_index, kind="stable")
+    offsets = np.zeros(n_queries + 1, dtype=np.int64)
+    np.cumsum(np.bincount(query_index, minlength=n_queries), out=offsets[1:])
+    return offsets, values[order]
+
+
+def save_arrays(path, arrays, meta):
+    """Write arrays and metadata to a directory.
+
+    Parameters
+    ----------
+    path : str
+        The directory
+    arrays : dict [str -> np.ndarray]
+        The arrays
+    meta : dict
+        JSON serializable metadata
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    with open(os.path.join(path, "meta.json"), "w") as fobj:
+        json.dump(meta, fobj)
+
+
+def load_arrays(path, mmap=True):
+    """Read arrays and metadata written by `save_arrays`.
+
+    Parameters
+    ----------
+    path : str
+        The directory
+    mmap : bool
+        If True, the arrays are memory mapped read only
+
+    Returns
+    -------
+    arrays : dict [str -> np.ndarray]
+        The arrays
+    meta : dict
+        The metadata
+    """
+    with open(os.path.join(path, "meta.json")) as fobj:
+        meta = json.load(fobj)
+
+    mmap_mode = "r" if mmap else None
+    arrays = {}
+    for fname in os.listdir(path):
+        if fname.endswith(".npy"):
+            name = fname[: -len(".npy")]
+            arrays[name] = np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+    return arrays, meta
+
+
+def publish(publish_dir, version, obj):
+    """Publish a new version of an object.
+
+    Parameters
+    ----------
+    publish_dir : str
+        The (node local) directory
+    version : int
+        The new version number
+    obj : object
+        The object, with a `save(path)` method
+    """
+    name = "v%d" % version
+    obj.save(os.path.join(publish_dir, name))
+    publish_path(publish_dir, name)
+
+    old_path = os.path.join(publish_dir, "v%d" % (version - KEEP_VERSIONS))
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def publish_path(publish_dir, path):
+    """Point the directory to an already saved version.
+
+    Parameters
+    ----------
+    publish_dir : str
+        The (node local) directory
+    path : str
+        Path of the saved version, absolute or relative to `publish_dir`
+    """
+    os.makedirs(publish_dir, exist_ok=True)
+    current = os.path.join(publish_dir, CURRENT_FILE)
+    with open(current + ".tmp", "w") as fobj:
+        fobj.write(path)
+    os.replace(current + ".tmp", current)
+
+
+def open_latest(publish_dir, load):
+    """Return the latest published version of an object.
+
+    Parameters
+    ----------
+    publish_dir : str
+        The (node local) directory
+    load : callable
+        Function loading the object from a saved version's path
+
+    Returns
+    -------
+    object
+        The latest published object
+    """
+    with open(os.path.join(publish_dir, CURRENT_FILE)) as fobj:
+        version = fobj.read().strip()
+
+    latest = _LATEST.get(publish_dir)
+    if latest is None or latest[0] != version:
+        latest = (version, load(os.path.join(publish_dir, version)))
+        _LATEST[publish_dir] = latest
+    return latest[1]
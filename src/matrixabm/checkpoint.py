@@ -0,0 +1,152 @@
+"""Checkpoint files.
+
+A checkpoint is taken at a step boundary,
+when every update of the step has been flushed
+and no agents are in flight between the runners.
+The simulator asks every actor with simulation state
+(the coordinator, runners, populations and stores)
+to write its own shard of the checkpoint in parallel.
+
+Every checkpoint is a directory in the checkpoint directory
+named after the number of completed steps.
+It contains one file per actor (and rank)::
+
+    step-00000010/
+        simulator.pkl
+        coordinator.pkl
+        runner-<rank>.pkl
+        population-<rank>.pkl
+        store-<store_name>-<rank>.sqlite3
+
+Once all the shards of a checkpoint have been written,
+the simulator atomically updates the `LATEST` file
+in the checkpoint directory to point to it.
+An incomplete checkpoint is thus never restored from.
+
+Shards are written to a temporary file which is then renamed,
+so a shard file is either complete or absent.
+"""
+
+import os
+import pickle
+
+# Name of the file pointing to the latest complete checkpoint
+LATEST_FILE = "LATEST"
+
+
+def step_path(checkpoint_dir, num_steps):
+    """Return the path of the checkpoint taken after the given number of steps.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The checkpoint directory
+    num_steps : int
+        Number of completed steps
+
+    Returns
+    -------
+    str
+        Path of the checkpoint
+    """
+    return os.path.join(checkpoint_dir, "step-%08d" % num_steps)
+
+
+def shard_path(checkpoint_path, name, rank=None, ext=".pkl"):
+    """Return the path of a checkpoint shard.
+
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path of the checkpoint
+    name : str
+        Name of the shard
+    rank : int, optional
+        Rank of the shard
+    ext : str
+        Extension of the shard file
+
+    Returns
+    -------
+    str
+        Path of the shard file
+    """
+    if rank is not None:
+        name = "%s-%d" % (name, rank)
+    return os.path.join(checkpoint_path, name + ext)
+
+
+def write_shard(path, state):
+    """Write a checkpoint shard.
+
+    Parameters
+    ----------
+    path : str
+        Path of the shard file
+    state : object
+        The (picklable) state to be written
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fobj:
+        pickle.dump(state, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_shard(path):
+    """Read a checkpoint shard.
+
+    Parameters
+    ----------
+    path : str
+        Path of the shard file
+
+    Returns
+    -------
+    object
+        The state written to the shard
+    """
+    with open(path, "rb") as fobj:
+        return pickle.load(fobj)
+
+
+def write_latest(checkpoint_dir, checkpoint_path):
+    """Mark a checkpoint as the latest complete checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The checkpoint directory
+    checkpoint_path : str
+        Path of the complete checkpoint
+    """
+    path = os.path.join(checkpoint_dir, LATEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fobj:
+        fobj.write(os.path.basename(checkpoint_path))
+        fobj.write("\n")
+    os.replace(tmp_path, path)
+
+
+def read_latest(checkpoint_dir):
+    """Return the path of the latest complete checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The checkpoint directory
+
+    Returns
+    -------
+    str
+        Path of the latest complete checkpoint
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no complete checkpoint in the checkpoint directory
+    """
+    with open(os.path.join(checkpoint_dir, LATEST_FILE)) as fobj:
+        name = fobj.read().strip()
+    return os.path.join(checkpoint_dir, name)
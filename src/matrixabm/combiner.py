@@ -0,0 +1,162 @@
+"""Update combiners.
+
+Many state updates are increments or aggregates
+(e.g. counters, sums, per cell tallies),
+where only the combined effect of all the updates with the same key
+matters, not the individual updates.
+A store method applying such updates can be declared combinable
+by decorating it with a combiner::
+
+    class MyStore(SQLite3Store):
+        @combinable(SumCombiner(key_args=1))
+        def add_count(self, cell, count):
+            ...
+
+The runners then combine the outgoing updates
+of a combinable method with the same key
+into a single update per step
+(in the spirit of MapReduce combiners),
+and send the combined updates to the store in batches
+at the end of the step.
+The store merges the partial results from the different runners
+with the same combiner,
+and applies a single update per key when it flushes.
+
+The combiners of a store class are found using `get_combiners`;
+the runners need to be given the combiners of every store.
+"""
+
+from abc import ABC, abstractmethod
+
+from .datatypes import StateUpdate
+
+
+class Combiner(ABC):
+    """Combiner interface.
+
+    The updates are grouped by key,
+    which is made of the first `key_args` positional arguments of the update.
+    A combiner must be associative and commutative.
+
+    Attributes
+    ----------
+    key_args : int
+        Number of leading positional arguments forming the key
+    """
+
+    def __init__(self, key_args=1):
+        """Initialize.
+
+        Parameters
+        ----------
+        key_args : int
+            Number of leading positional arguments forming the key
+        """
+        self.key_args = int(key_args)
+
+    def key(self, update):
+        """Return the key of an update.
+
+        Parameters
+        ----------
+        update : StateUpdate
+            The update
+
+        Returns
+        -------
+        tuple
+            The key of the update
+        """
+        return update.args[: self.key_args]
+
+    @abstractmethod
+    def combine(self, a, b):
+        """Combine two updates with the same key into one.
+
+        Parameters
+        ----------
+        a : StateUpdate
+            The first update
+        b : StateUpdate
+            The second update
+
+        Returns
+        -------
+        StateUpdate
+            The combined update
+        """
+
+
+class SumCombiner(Combiner):
+    """Sum the values of the updates with the same key.
+
+    The positional arguments after the key are the values,
+    which are summed element wise.
+    The combined update has the smaller order key of the two.
+    Updates with keyword arguments are not supported.
+    """
+
+    def combine(self, a, b):
+        """Combine two updates with the same key into one."""
+        if __debug__:
+            if a.kwargs or b.kwargs:
+                raise ValueError("SumCombiner doesn't support keyword arguments")
+
+        k = self.key_args
+        values = (x + y for x, y in zip(a.args[k:], b.args[k:]))
+        order_key = min(a.order_key, b.order_key)
+        return StateUpdate(a.store_name, order_key, a.method, *a.args[:k], *values)
+
+
+class LastWriteCombiner(Combiner):
+    """Keep only the last of the updates with the same key.
+
+    The last update is the one with the larger order key;
+    of two updates with equal order keys the second one is kept.
+    """
+
+    def combine(self, a, b):
+        """Combine two updates with the same key into one."""
+        return b if b.order_key >= a.order_key else a
+
+
+def combinable(combiner):
+    """Declare a store method combinable with the given combiner.
+
+    Parameters
+    ----------
+    combiner : Combiner
+        The combiner of the method's updates
+
+    Returns
+    -------
+    callable
+        The method decorator
+    """
+
+    def decorator(method):
+        method.combiner = combiner
+        return method
+
+    return decorator
+
+
+def get_combiners(store_cls):
+    """Return the combiners of the combinable methods of a store class.
+
+    Parameters
+    ----------
+    store_cls : type
+        The state store class
+
+    Returns
+    -------
+    dict [str -> Combiner]
+        Method name to combiner
+    """
+    combiners = {}
+    for name in dir(store_cls):
+        combiner = getattr(getattr(store_cls, name, None), "combiner", None)
+        if isinstance(combiner, Combiner):
+            combiners[name] = combiner
+    return combiners
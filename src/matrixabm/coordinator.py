@@ -1,14 +1,26 @@
 """Agent coordinator."""
 
 from time import perf_counter
-import numpy as np
+from collections import defaultdict
 
+import numpy as np
 import xactor as asys
 
 from . import INFO_FINE, WORLD_SIZE
+from . import tracing
+from . import checkpoint
+from .registry import AgentRegistry
+from .histogram import StreamingHistogram
 
 LOG = asys.getLogger(__name__)
 
+# Maximum number of agents sent to a runner in one create_agent_bulk message
+BULK_CREATE_CHUNK_SIZE = 10000
+
+# Number of agents every agent of a large interaction group is linked to
+# on either side (in a ring); smaller groups are linked pairwise
+INTERACTION_RING_DEGREE = 8
+
 
 class Coordinator:
     """Agent coordinator.
@@ -18,24 +30,67 @@ class Coordinator:
     while making sure the overall agent load is balanced.
     There is a single coordinator actor in every simulation.
 
+    With a distributed population,
+    there is a population actor on every rank.
+    Populations create agents on their local runners,
+    and only register the new agents' IDs and load estimates
+    with the coordinator.
+
+    Internally, and in all messages to and from the runners,
+    agents are referred to by integer handles.
+    The coordinator's agent registry maps handles to agent IDs and back.
+
+    Interactions between agents (for graph aware load balancers)
+    may be declared by the model with `agent_interactions` messages,
+    or observed by the runners.
+    The agents observed using the same interaction key in a step
+    (and the agent whose ID is the key, if any)
+    are passed to the balancer as interacting pairwise,
+    with a total weight of one per agent and key.
+    To bound the number of pairs,
+    the agents of a large group are instead linked in a ring
+    (sorted by handle) to the `INTERACTION_RING_DEGREE` agents
+    on either side of them.
+
     Receives
     --------
     * `step` from Simulator
     * `create_agent*` from Population
-    * `create_agent_done` from Population
+    * `create_agent_bulk*` from Population
+    * `register_agent*` from (distributed) Population
+    * `register_agent_bulk*` from (distributed) Population
+    * `create_agent_done` from Population(s)
     * `agent_step_profile*` from Runner
+    * `agent_step_profile_chunk*` from Runner
     * `agent_step_profile_done` from Runner
+    * `agent_interactions*` from Population (optional)
+    * `agent_interaction_keys*` from Runner (with interaction observation)
+    * `checkpoint` from Simulator
+    * `restore` from Simulator
+    * `checkpoint_done` from Runner(s) and Population(s)
+    * `agents_stolen*` from Runner(s)
+    * `finish_done` from Runner(s)
 
     Sends
     -----
     * `create_agent*` to Runner
+    * `create_agent_bulk*` to Runner
     * `create_agent_done` to Runner
     * `move_agent*` to Runner
     * `move_agent_done` to Runner
     * `coordinator_done` to Simulator
+    * `checkpoint_done` to Simulator
+    * `runners_finished` to Simulator
     """
 
-    def __init__(self, balancer, simulator_aid, runner_aid, summary_writer_aid=None):
+    def __init__(
+        self,
+        balancer,
+        simulator_aid,
+        runner_aid,
+        summary_writer_aid=None,
+        distributed_population=False,
+    ):
         """Initialize.
 
         Parameters
@@ -48,7 +103,12 @@ class Coordinator:
             The ID of the runner actors
         summary_writer_aid : str
             The ID of the local summary writer actor
+        distributed_population : bool
+            If True, expect a population actor on every rank
+            (which allocate the agent handles themselves)
         """
+        tracing.start_tracing_from_env()
+
         self.balancer = balancer
         self.simulator_proxy = asys.ActorProxy(asys.MASTER_RANK, simulator_aid)
         self.runner_proxies = [
@@ -56,22 +116,38 @@ class Coordinator:
         ]
         self.every_runner_proxy = asys.ActorProxy(asys.EVERY_RANK, runner_aid)
         self.summary_writer_aid = summary_writer_aid
+        self.num_populations = WORLD_SIZE if distributed_population else 1
+        self.registry = AgentRegistry()
 
         self.num_agents_created = 0
         self.num_agents_died = 0
 
+        # Number of actors (including the coordinator itself)
+        # done with the current checkpoint or restore
+        self.num_checkpoint_done = 0
+
+        # Number of runners done at the end of the simulation
+        self.num_finish_done = 0
+
         # Step variables
         self.timestep = None
         self.agent_constructor = None
-        self.flag_create_agent_done = None
+        self.agent_templates = None
+        self.agent_template_row = None
+        self.num_create_agent_done = None
         self.num_agent_step_profile_done = None
+        self.num_agents_stepped = None
         self.rank_step_time = None
         self.rank_memory_usage = None
+        self.rank_rss = None
         self.rank_n_updates = None
-        self.agent_step_time = None
-        self.agent_memory_usage = None
-        self.agent_n_updates = None
         self.balancing_time = None
+        self.interaction_groups = None
+
+        # Per agent step statistics
+        self.agent_step_time = StreamingHistogram()
+        self.agent_memory_usage = StreamingHistogram()
+        self.agent_n_updates = StreamingHistogram(min_value=1.0)
 
         self._prepare_for_next_step()
 
@@ -81,20 +157,58 @@ class Coordinator:
 
         self.timestep = None
         self.agent_constructor = {}
+        self.agent_templates = []
+        self.agent_template_row = {}
         self.balancer.reset()
 
-        self.flag_create_agent_done = False
+        self.num_create_agent_done = 0
         self.num_agent_step_profile_done = 0
+        self.num_agents_stepped = 0
 
         self.rank_step_time = [0.0] * WORLD_SIZE
         self.rank_memory_usage = [0.0] * WORLD_SIZE
+        self.rank_rss = [None] * WORLD_SIZE
         self.rank_n_updates = [0] * WORLD_SIZE
 
-        self.agent_step_time = {}
-        self.agent_memory_usage = {}
-        self.agent_n_updates = {}
+        self.agent_step_time.reset()
+        self.agent_memory_usage.reset()
+        self.agent_n_updates.reset()
 
         self.balancing_time = -1.0
+        self.interaction_groups = defaultdict(list)
+
+    def _add_observed_interactions(self):
+        """Pass the interactions observed in the step to the balancer."""
+        degree = INTERACTION_RING_DEGREE
+        objects_a, objects_b, weights = [], [], []
+        for key, handles in self.interaction_groups.items():
+            if key in self.registry:
+                handles.append(self.registry.get_handle(key))
+            if len(handles) < 2:
+                continue
+
+            handles = np.unique(handles)
+            n = len(handles)
+            if n < 2:
+                continue
+
+            if n - 1 <= 2 * degree:
+                a, b = np.triu_indices(n, 1)
+                weight = 1.0 / (n - 1)
+            else:
+                a = np.repeat(np.arange(n), degree)
+                b = (a + np.tile(np.arange(1, degree + 1), n)) % n
+                weight = 0.5 / degree
+            objects_a.append(handles[a])
+            objects_b.append(handles[b])
+            weights.append(np.full(len(a), weight))
+
+        if objects_a:
+            self.balancer.add_interactions(
+                np.concatenate(objects_a),
+                np.concatenate(objects_b),
+                np.concatenate(weights),
+            )
 
     def _write_summary(self):
         """Log the summary of activites."""
@@ -115,6 +229,12 @@ class Coordinator:
             self.num_agents_created - self.num_agents_died,
             self.timestep.step,
         )
+        summary_writer.add_scalar(
+            "num_agents_stepped", self.num_agents_stepped, self.timestep.step
+        )
+        summary_writer.add_scalar(
+            "num_updates", sum(self.rank_n_updates), self.timestep.step
+        )
 
         for rank in range(WORLD_SIZE):
             summary_writer.add_scalar(
@@ -125,26 +245,31 @@ class Coordinator:
                 self.rank_memory_usage[rank],
                 self.timestep.step,
             )
+            if self.rank_rss[rank] is not None:
+                summary_writer.add_scalar(
+                    f"rank_rss/{rank}", self.rank_rss[rank], self.timestep.step
+                )
             summary_writer.add_scalar(
                 f"rank_n_updates/{rank}", self.rank_n_updates[rank], self.timestep.step
             )
 
-        agent_step_time = np.array(list(self.agent_step_time.values()))
-        summary_writer.add_histogram(
-            "agent_step_time", agent_step_time, self.timestep.step, bins="auto"
+        # Empty histograms (e.g. when all agents are sleeping) are skipped
+        self.agent_step_time.write_summary(
+            summary_writer, "agent_step_time", self.timestep.step
         )
-        agent_memory_usage = np.array(list(self.agent_memory_usage.values()))
-        summary_writer.add_histogram(
-            "agent_memory_usage", agent_memory_usage, self.timestep.step, bins="auto"
+        self.agent_memory_usage.write_summary(
+            summary_writer, "agent_memory_usage", self.timestep.step
         )
-        agent_n_updates = np.array(list(self.agent_n_updates.values()))
-        summary_writer.add_histogram(
-            "agent_n_updates", agent_n_updates, self.timestep.step, bins="auto"
+        self.agent_n_updates.write_summary(
+            summary_writer, "agent_n_updates", self.timestep.step
         )
 
         summary_writer.add_scalar(
             "balancing_time", self.balancing_time, self.timestep.step
         )
+        edge_cut = getattr(self.balancer, "edge_cut", None)
+        if edge_cut is not None:
+            summary_writer.add_scalar("edge_cut", edge_cut, self.timestep.step)
 
         summary_writer.flush()
 
@@ -152,47 +277,75 @@ class Coordinator:
         """Try to start the load balancing step."""
         LOG.log(
             INFO_FINE,
-            "Can balance load? (TS=%s,CAD=%s)",
+            "Can balance load? (TS=%s,NCAD=%d/%d)",
             bool(self.timestep),
-            self.flag_create_agent_done,
+            self.num_create_agent_done,
+            self.num_populations,
         )
         if self.timestep is None:
             return
-        if not self.flag_create_agent_done:
+        if self.num_create_agent_done < self.num_populations:
             return
 
         start_time = perf_counter()
         self.balancer.balance()
-        self.balancing_time = perf_counter() - start_time
-
-        for agent_id, rank in self.balancer.get_new_objects():
-            constructor = self.agent_constructor[agent_id]
-            self.runner_proxies[rank].create_agent(agent_id, constructor, buffer_=True)
-        self.every_runner_proxy.create_agent_done()
-
-        for agent_id, src, dst in self.balancer.get_moving_objects():
-            self.runner_proxies[src].move_agent(agent_id, dst, buffer_=True)
-        self.every_runner_proxy.move_agent_done()
+        end_time = perf_counter()
+        self.balancing_time = end_time - start_time
+        tracing.complete("balance", start_time, end_time, cat="coordinator")
+
+        with tracing.span("send_new_agents", cat="coordinator"):
+            template_rows = defaultdict(list)
+            for handle, rank in self.balancer.get_new_objects():
+                if handle in self.agent_template_row:
+                    template_index, row = self.agent_template_row[handle]
+                    template_rows[rank, template_index].append(row)
+                    continue
+
+                constructor = self.agent_constructor[handle]
+                self.runner_proxies[rank].create_agent(
+                    handle, constructor, buffer_=True
+                )
+
+            for (rank, template_index), rows in template_rows.items():
+                template = self.agent_templates[template_index]
+                for i in range(0, len(rows), BULK_CREATE_CHUNK_SIZE):
+                    chunk = template.subset(rows[i : i + BULK_CREATE_CHUNK_SIZE])
+                    self.runner_proxies[rank].create_agent_bulk(chunk, buffer_=True)
+
+            self.every_runner_proxy.create_agent_done()
+
+        with tracing.span("send_moving_agents", cat="coordinator"):
+            move_sources = defaultdict(set)
+            for handle, src, dst in self.balancer.get_moving_objects():
+                self.runner_proxies[src].move_agent(handle, dst, buffer_=True)
+                move_sources[dst].add(src)
+            for rank in asys.ranks():
+                self.runner_proxies[rank].move_agent_done(len(move_sources[rank]))
 
     def _try_finish_step(self):
         """Try to finish the step."""
         LOG.log(
             INFO_FINE,
-            "Can finish step? (TS=%s,CAD=%s,NASPD=%d/%d)",
+            "Can finish step? (TS=%s,NCAD=%d/%d,NASPD=%d/%d)",
             bool(self.timestep),
-            self.flag_create_agent_done,
+            self.num_create_agent_done,
+            self.num_populations,
             self.num_agent_step_profile_done,
             WORLD_SIZE,
         )
         if self.timestep is None:
             return
-        if not self.create_agent_done:
+        if self.num_create_agent_done < self.num_populations:
             return
         if self.num_agent_step_profile_done < WORLD_SIZE:
             return
 
         self.simulator_proxy.coordinator_done()
-        self._write_summary()
+        if self.interaction_groups:
+            with tracing.span("add_interactions", cat="coordinator"):
+                self._add_observed_interactions()
+        with tracing.span("write_summary", cat="coordinator"):
+            self._write_summary()
         self._prepare_for_next_step()
 
     def step(self, timestep):
@@ -222,19 +375,96 @@ class Coordinator:
         memory_usage : float
             Initial estimate of memory usage
         """
-        self.agent_constructor[agent_id] = constructor
-        self.balancer.add_object(agent_id, memory_usage, step_time)
+        handle = self.registry.register(agent_id)
+        self.agent_constructor[handle] = constructor
+        self.balancer.add_object(handle, memory_usage, step_time)
         self.num_agents_created += 1
 
+    def create_agent_bulk(self, template, step_time, memory_usage):
+        """Log the creation of a number of agents.
+
+        Parameters
+        ----------
+        template : ConstructorTemplate
+            Constructor template of the agents;
+            its object IDs are used as the agent IDs
+        step_time : float
+            Initial estimate step_time per unit simulated real time (in seconds)
+            of every agent
+        memory_usage : float
+            Initial estimate of memory usage of every agent
+        """
+        template_index = len(self.agent_templates)
+        handles = []
+        for row, agent_id in enumerate(template.object_ids):
+            handle = self.registry.register(agent_id)
+            self.agent_template_row[handle] = (template_index, row)
+            self.balancer.add_object(handle, memory_usage, step_time)
+            handles.append(handle)
+
+        # The runners only need the handles
+        template.object_ids = handles
+        self.agent_templates.append(template)
+        self.num_agents_created += len(template)
+
+    def register_agent(self, rank, handle, agent_id, step_time, memory_usage):
+        """Log an agent already created on a runner.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner where the agent was created
+        handle : int
+            Handle of the created agent
+        agent_id : str
+            ID of the created agent
+        step_time : float
+            Initial estimate step_time per unit simulated real time (in seconds)
+        memory_usage : float
+            Initial estimate of memory usage
+        """
+        self.registry.register(agent_id, handle)
+        self.balancer.add_object(handle, memory_usage, step_time, rank)
+        self.num_agents_created += 1
+
+    def register_agent_bulk(self, rank, handles, agent_ids, step_time, memory_usage):
+        """Log a number of agents already created on a runner.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner where the agents were created
+        handles : list of int
+            Handles of the created agents
+        agent_ids : list of str
+            IDs of the created agents
+        step_time : float
+            Initial estimate step_time per unit simulated real time (in seconds)
+            of every agent
+        memory_usage : float
+            Initial estimate of memory usage of every agent
+        """
+        for handle, agent_id in zip(handles, agent_ids):
+            self.registry.register(agent_id, handle)
+            self.balancer.add_object(handle, memory_usage, step_time, rank)
+        self.num_agents_created += len(handles)
+
     def create_agent_done(self):
         """Log that agent creation is done."""
-        assert not self.flag_create_agent_done
+        assert self.num_create_agent_done < self.num_populations
 
-        self.flag_create_agent_done = True
+        self.num_create_agent_done += 1
         self._try_load_balance()
 
     def agent_step_profile(
-        self, rank, agent_id, step_time, memory_usage, n_updates, is_alive
+        self,
+        rank,
+        handle,
+        step_time,
+        memory_usage,
+        n_updates,
+        is_alive,
+        wake_time=None,
     ):
         """Log an agent step profile.
 
@@ -242,8 +472,8 @@ class Coordinator:
         ----------
         rank : int
             Rank of the agent runner
-        agent_id : str
-            ID of the dead agent
+        handle : int
+            Handle of the agent
         step_time : float
             Time taken by the agent to execute current timestep (in seconds)
         memory_usage : float
@@ -252,34 +482,214 @@ class Coordinator:
             Number of updates produced by the agent
         is_alive : bool
             True if agent will generate events in the future
+        wake_time : float or None
+            The next wake time of the agent;
+            None if the agent is due every timestep
         """
         self.rank_step_time[rank] += step_time
         self.rank_memory_usage[rank] += memory_usage
         self.rank_n_updates[rank] += n_updates
+        self.num_agents_stepped += 1
 
-        self.agent_step_time[agent_id] = step_time
-        self.agent_memory_usage[agent_id] = memory_usage
-        self.agent_n_updates[agent_id] = n_updates
+        self.agent_step_time.add(step_time)
+        self.agent_memory_usage.add(memory_usage)
+        self.agent_n_updates.add(n_updates)
 
         if not is_alive:
-            self.balancer.delete_object(agent_id)
+            self.balancer.delete_object(handle)
+            self.registry.unregister(handle)
             self.num_agents_died += 1
             return
 
-        scaled_step_time = step_time / (self.timestep.end - self.timestep.start)
-        self.balancer.update_load(agent_id, memory_usage, scaled_step_time)
+        # Agents sleeping beyond the current timestep count as zero CPU load
+        if wake_time is not None and wake_time >= self.timestep.end:
+            scaled_step_time = 0.0
+        else:
+            scaled_step_time = step_time / (self.timestep.end - self.timestep.start)
+        self.balancer.update_load(handle, memory_usage, scaled_step_time)
+
+    def agent_step_profile_chunk(
+        self, rank, handles, step_time, memory_usage, n_updates
+    ):
+        """Log the step profile of a chunk of agents.
+
+        The agents in the chunk were not profiled individually.
+        They are all alive and due in the next timestep,
+        and are charged the same (mean) step time.
+        Their memory usage estimates are left unchanged.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the agent runner
+        handles : list of int
+            Handles of the agents
+        step_time : float
+            Total time taken by the agents to execute current timestep (in seconds)
+        memory_usage : float
+            Total (last measured) memory usage of the agents
+        n_updates : int
+            Total number of updates produced by the agents
+        """
+        self.rank_step_time[rank] += step_time
+        self.rank_memory_usage[rank] += memory_usage
+        self.rank_n_updates[rank] += n_updates
+        self.num_agents_stepped += len(handles)
 
-    def agent_step_profile_done(self, rank):
+        scaled_step_time = step_time / len(handles)
+        scaled_step_time /= self.timestep.end - self.timestep.start
+        for handle in handles:
+            self.balancer.update_load(handle, None, scaled_step_time)
+
+    def agent_step_profile_done(self, rank, rss=None):
         """Log that a runner has completed the step.
 
         Parameters
         ----------
         rank : int
             Rank of the agent runner
+        rss : int, optional
+            Resident set size of the runner's process (in bytes),
+            if memory measurement is enabled
         """
         assert self.num_agent_step_profile_done < WORLD_SIZE
         if __debug__:
             LOG.debug("Runner on %d is done", rank)
 
+        self.rank_rss[rank] = rss
         self.num_agent_step_profile_done += 1
         self._try_finish_step()
+
+    def agent_interactions(self, agent_ids_a, agent_ids_b, weights=None):
+        """Declare interactions between pairs of agents.
+
+        Parameters
+        ----------
+        agent_ids_a : list of str
+            IDs of the first agents of the pairs
+        agent_ids_b : list of str
+            IDs of the second agents of the pairs
+        weights : list of float, optional
+            Strength of the interactions (defaults to 1)
+        """
+        get_handle = self.registry.get_handle
+        self.balancer.add_interactions(
+            [get_handle(agent_id) for agent_id in agent_ids_a],
+            [get_handle(agent_id) for agent_id in agent_ids_b],
+            weights,
+        )
+
+    def agent_interaction_keys(self, rank, key_handles):
+        """Log the interaction keys of the agents stepped by a runner.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the agent runner
+        key_handles : dict [object -> list of int]
+            Interaction key to the handles of the agents using it
+        """
+        if __debug__:
+            LOG.debug("Runner on %d observed %d keys", rank, len(key_handles))
+
+        for key, handles in key_handles.items():
+            self.interaction_groups[key].extend(handles)
+
+    def agents_stolen(self, src_rank, dst_rank, handles):
+        """Log that agents were stolen by a runner from another runner.
+
+        Parameters
+        ----------
+        src_rank : int
+            Rank of the runner the agents were taken from
+        dst_rank : int
+            Rank of the runner now owning the agents
+        handles : list of int
+            Handles of the stolen agents
+        """
+        if __debug__:
+            LOG.debug(
+                "Runner on %d stole %d agents from %d", dst_rank, len(handles), src_rank
+            )
+
+        for handle in handles:
+            self.balancer.move_object(handle, dst_rank)
+
+    def checkpoint(self, checkpoint_path):
+        """Write the coordinator's shard of a checkpoint.
+
+        The runners and populations report to the coordinator
+        once they have written their shards;
+        once all of them have, the simulator is informed.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        with tracing.span("checkpoint", cat="coordinator"):
+            state = {
+                "balancer": self.balancer,
+                "registry": self.registry,
+                "num_agents_created": self.num_agents_created,
+                "num_agents_died": self.num_agents_died,
+            }
+            checkpoint.write_shard(
+                checkpoint.shard_path(checkpoint_path, "coordinator"), state
+            )
+
+        self.checkpoint_done(asys.current_rank())
+
+    def restore(self, checkpoint_path):
+        """Restore the coordinator's state from a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        state = checkpoint.read_shard(
+            checkpoint.shard_path(checkpoint_path, "coordinator")
+        )
+        self.balancer = state["balancer"]
+        self.registry = state["registry"]
+        self.num_agents_created = state["num_agents_created"]
+        self.num_agents_died = state["num_agents_died"]
+        self._prepare_for_next_step()
+
+        self.checkpoint_done(asys.current_rank())
+
+    def checkpoint_done(self, rank):
+        """Log that an actor is done with the current checkpoint or restore.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner, population or the coordinator itself
+        """
+        if __debug__:
+            LOG.debug("Checkpoint done on %d", rank)
+
+        self.num_checkpoint_done += 1
+        if self.num_checkpoint_done < 1 + WORLD_SIZE + self.num_populations:
+            return
+
+        self.num_checkpoint_done = 0
+        self.simulator_proxy.checkpoint_done()
+
+    def finish_done(self, rank):
+        """Log that a runner is done at the end of the simulation.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner
+        """
+        if __debug__:
+            LOG.debug("Runner on %d finished", rank)
+
+        self.num_finish_done += 1
+        if self.num_finish_done < WORLD_SIZE:
+            return
+
+        self.simulator_proxy.runners_finished()
@@ -72,6 +72,128 @@ class Constructor:
         """
         return self.cls(*self.args, **self.kwargs)
 
+@dataclass(init=False)
+class ConstructorTemplate:
+    """A delayed constructor of many objects of the same class.
+
+    The class and the arguments shared by all the objects are stored once.
+    The per-object keyword arguments are stored column wise;
+    that is, there is one list of values for every per-object argument.
+
+    Attributes
+    ----------
+    cls : type
+        The class to be used for creating the objects
+    args : list
+        The shared positional arguments of the constructor
+    kwargs : dict
+        The shared keyword arguments of the constructor
+    object_ids : list
+        The IDs of the objects
+    columns : dict [str -> list]
+        The per-object keyword arguments of the constructor
+    """
+
+    cls: type
+    args: list
+    kwargs: dict
+    object_ids: list
+    columns: dict
+
+    def __init__(self, cls, *args, **kwargs):
+        """Make the constructor template.
+
+        Parameters
+        ----------
+        cls : type
+            The class to be used for creating the objects
+        *args : list
+            Shared positional arguments of the constructor
+        **kwargs : dict
+            Shared keyword arguments of the constructor
+        """
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs
+        self.object_ids = []
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def add(self, object_id, **kwargs):
+        """Add an object to be constructed.
+
+        All objects must be added with the same set of per-object arguments.
+
+        Parameters
+        ----------
+        object_id : str
+            ID of the object
+        **kwargs : dict
+            Per-object keyword arguments of the constructor
+        """
+        if not self.object_ids:
+            self.columns = {k: [] for k in kwargs}
+        elif kwargs.keys() != self.columns.keys():
+            raise ValueError(
+                "Per-object arguments %s don't match %s"
+                % (sorted(kwargs), sorted(self.columns))
+            )
+
+        self.object_ids.append(object_id)
+        for k, v in kwargs.items():
+            self.columns[k].append(v)
+
+    def subset(self, indices):
+        """Return a template for a subset of the objects.
+
+        Parameters
+        ----------
+        indices : list of int
+            Indices of the objects in the subset
+
+        Returns
+        -------
+        ConstructorTemplate
+            The template with the same class and shared arguments
+        """
+        ret = ConstructorTemplate(self.cls, *self.args, **self.kwargs)
+        ret.object_ids = [self.object_ids[i] for i in indices]
+        ret.columns = {k: [col[i] for i in indices] for k, col in self.columns.items()}
+        return ret
+
+    def construct(self, index):
+        """Construct a single object.
+
+        Parameters
+        ----------
+        index : int
+            Index of the object
+
+        Returns
+        -------
+        object
+            The constructed object
+        """
+        kwargs = dict(self.kwargs)
+        for k, col in self.columns.items():
+            kwargs[k] = col[index]
+        return self.cls(*self.args, **kwargs)
+
+    def construct_all(self):
+        """Construct all the objects.
+
+        Yields
+        ------
+        object_id : str
+            ID of the object
+        object : object
+            The constructed object
+        """
+        for i, object_id in enumerate(self.object_ids):
+            yield object_id, self.construct(i)
+
 @dataclass(init=False, order=True)
 class StateUpdate:
     """A state update message.
@@ -0,0 +1,152 @@
+"""Node level flush executor.
+
+The state store actors on a node usually live on the same rank,
+and thus would flush their updates one after another.
+A flush executor on the rank collects the flushes of the local stores
+once every local store is ready to flush,
+and runs them together.
+
+Stores that share a connection (e.g. SQLite3 stores
+using the shared connection of the local `SQLite3Manager`)
+are flushed one after another in a single transaction.
+Stores with separate connections are flushed concurrently
+in a pool of threads
+(sqlite3 releases the GIL while executing statements).
+
+Every store still reports its own flush time to the simulator.
+"""
+
+from time import perf_counter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import xactor as asys
+
+from . import INFO_FINE
+
+LOG = asys.getLogger(__name__)
+
+
+def _flush_group(stores):
+    """Flush a group of stores sharing a connection.
+
+    Parameters
+    ----------
+    stores : list of StateStore
+        The stores to be flushed;
+        stores in a group of more than one must be SQLite3 stores
+
+    Returns
+    -------
+    list of (float, float) tuples
+        The start and end time of every store's flush
+    """
+    if len(stores) == 1:
+        start_time = perf_counter()
+        stores[0].flush()
+        return [(start_time, perf_counter())]
+
+    times = []
+    with stores[0].connection():
+        for store in stores:
+            start_time = perf_counter()
+            store.apply_updates()
+            times.append((start_time, perf_counter()))
+
+    # Every store's updates are durable only after the commit
+    end_time = perf_counter()
+    return [(start_time, end_time) for start_time, _ in times]
+
+
+class FlushExecutor:
+    """Node level executor of the local stores' flushes.
+
+    There is one flush executor on every rank with store actors.
+    The store actors submit themselves to the local executor
+    (using `asys.local_actor`) when they are ready to flush.
+
+    Attributes
+    ----------
+    store_names : list of str
+        Names of the local stores
+    pending : list of StateStore
+        Stores ready to flush in the current step
+    pool : concurrent.futures.ThreadPoolExecutor or None
+        The thread pool running the flushes concurrently
+    """
+
+    def __init__(self, store_names, concurrent=True, max_workers=None):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_names : list of str
+            Names of the local stores
+        concurrent : bool
+            If True, stores with separate connections
+            are flushed concurrently
+        max_workers : int, optional
+            Maximum number of flushes running concurrently
+            (defaults to the number of local stores)
+        """
+        self.store_names = list(store_names)
+        self.pending = []
+
+        if concurrent and len(self.store_names) > 1:
+            if max_workers is None:
+                max_workers = len(self.store_names)
+            self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="flush")
+        else:
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Shutdown the thread pool."""
+        if self.pool is None:
+            return
+
+        self.pool.shutdown()
+        self.pool = None
+
+    def submit(self, store):
+        """Submit the flush of a store.
+
+        The stores are flushed once every local store has been submitted.
+
+        Parameters
+        ----------
+        store : StateStore
+            A store ready to flush
+        """
+        assert store.store_name in self.store_names
+        self.pending.append(store)
+        if len(self.pending) < len(self.store_names):
+            return
+
+        stores, self.pending = self.pending, []
+
+        # Group the stores by their connection
+        groups = defaultdict(list)
+        for store in stores:
+            if hasattr(store, "apply_updates"):
+                groups[id(store.connection())].append(store)
+            else:
+                groups[id(store)].append(store)
+        groups = list(groups.values())
+
+        LOG.log(
+            INFO_FINE,
+            "Flushing %d stores in %d groups",
+            len(stores),
+            len(groups),
+        )
+        if self.pool is None or len(groups) == 1:
+            group_times = [_flush_group(group) for group in groups]
+        else:
+            group_times = list(self.pool.map(_flush_group, groups))
+
+        for group, times in zip(groups, group_times):
+            for store, (start_time, end_time) in zip(group, times):
+                store.report_flush(start_time, end_time)
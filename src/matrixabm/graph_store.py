@@ -0,0 +1,573 @@
+"""Contact network store.
+
+Epidemic models on synthetic populations step over a large contact graph,
+reading the neighbours of every agent (and the attributes of the contacts)
+on every step.
+A graph store keeps the graph in compressed sparse row (CSR) form,
+with the edge attributes as typed NumPy columns,
+and answers batched neighbour and attribute lookups
+with vectorized operations.
+
+The nodes of the graph are integers from 0 to ``n_nodes - 1``
+(e.g. the agent handles).
+The edges are directed;
+an undirected contact is stored as two edges.
+Agents update the graph by sending updates::
+
+    StateUpdate(store_name, order_key, "add_edge", src, dst, *values)
+    StateUpdate(store_name, order_key, "remove_edge", src, dst)
+    StateUpdate(store_name, order_key, "set_edge_attr", src, dst, name, value)
+
+where `values` has one value for every edge attribute.
+The updates of a flush are folded per edge in order key order,
+and then applied to the CSR arrays in bulk.
+
+Large graphs (e.g. prepared from a synthetic population)
+are written once with `CSRGraph.save`,
+and memory mapped by the store.
+Like the spatial store,
+the store publishes the graph as of every flush
+in a node local directory,
+which the other ranks of the node memory map using `open_graph`
+(see `matrixabm.array_io`).
+"""
+
+import os
+import shutil
+from time import perf_counter
+
+import numpy as np
+
+from . import INFO_FINE
+from . import tracing
+from . import metrics
+from . import array_io
+from .array_io import concat_ranges
+from .state_store import StateStore
+
+# Kinds of the folded edge updates
+ADD, REMOVE, SET = 0, 1, 2
+
+
+class CSRGraph:
+    """Directed graph in compressed sparse row form.
+
+    The edges of node ``i`` are the edges ``indptr[i]`` to ``indptr[i+1] - 1``,
+    sorted by their target node.
+    The edge IDs are the positions of the edges in these arrays,
+    and are only valid for the same version of the graph.
+
+    Attributes
+    ----------
+    n_nodes : int
+        Number of nodes
+    indptr : np.ndarray
+        Offsets of the edges of every node, shape (n_nodes + 1,)
+    indices : np.ndarray
+        Target nodes of the edges
+    attrs : dict [str -> np.ndarray]
+        Edge attribute name to the attribute values of the edges
+    """
+
+    def __init__(self, n_nodes, src, dst, attrs=None):
+        """Build the graph from a list of edges.
+
+        Parameters
+        ----------
+        n_nodes : int
+            Number of nodes
+        src : array of int
+            Source nodes of the edges
+        dst : array of int
+            Target nodes of the edges
+        attrs : dict [str -> array], optional
+            Edge attribute name to the attribute values of the edges;
+            the dtype of the values is kept
+        """
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        attrs = {} if attrs is None else attrs
+
+        order = np.lexsort((dst, src))
+        self.n_nodes = int(n_nodes)
+        self.indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=self.n_nodes), out=self.indptr[1:])
+        self.indices = dst[order]
+        self.attrs = {name: np.asarray(values)[order] for name, values in attrs.items()}
+
+    @classmethod
+    def _from_arrays(cls, n_nodes, indptr, indices, attrs):
+        """Make a graph from already built arrays."""
+        graph = cls.__new__(cls)
+        graph.n_nodes = n_nodes
+        graph.indptr = indptr
+        graph.indices = indices
+        graph.attrs = attrs
+        return graph
+
+    @property
+    def n_edges(self):
+        """Number of edges."""
+        return len(self.indices)
+
+    def sources(self):
+        """Return the source nodes of the edges."""
+        return np.repeat(np.arange(self.n_nodes), np.diff(self.indptr))
+
+    def degree(self, nodes):
+        """Return the out degree of the given nodes.
+
+        Parameters
+        ----------
+        nodes : array of int
+            The nodes
+
+        Returns
+        -------
+        np.ndarray
+            The out degree of every node
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return self.indptr[nodes + 1] - self.indptr[nodes]
+
+    def edges_of(self, nodes):
+        """Find the outgoing edges of the given nodes.
+
+        Parameters
+        ----------
+        nodes : array of int
+            The nodes
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The edges of the i-th node are ``edge_ids[offsets[i]:offsets[i+1]]``
+        edge_ids : np.ndarray
+            IDs of the edges
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.indptr[nodes]
+        counts = self.indptr[nodes + 1] - starts
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, concat_ranges(starts, counts)
+
+    def neighbors(self, nodes):
+        """Find the neighbours of the given nodes.
+
+        Parameters
+        ----------
+        nodes : array of int
+            The nodes
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The neighbours of the i-th node are ``nbrs[offsets[i]:offsets[i+1]]``
+        nbrs : np.ndarray
+            The neighbours
+        """
+        offsets, edge_ids = self.edges_of(nodes)
+        return offsets, self.indices[edge_ids]
+
+    def edge_attrs(self, nodes, names=None):
+        """Find the neighbours of the given nodes and the attributes of the edges.
+
+        Parameters
+        ----------
+        nodes : array of int
+            The nodes
+        names : list of str, optional
+            The attributes (defaults to all)
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The neighbours of the i-th node are ``nbrs[offsets[i]:offsets[i+1]]``
+        nbrs : np.ndarray
+            The neighbours
+        values : dict [str -> np.ndarray]
+            Attribute name to the attribute values of the edges (aligned with `nbrs`)
+        """
+        if names is None:
+            names = list(self.attrs)
+        offsets, edge_ids = self.edges_of(nodes)
+        values = {name: self.attrs[name][edge_ids] for name in names}
+        return offsets, self.indices[edge_ids], values
+
+    def find_edges(self, src, dst):
+        """Find the IDs of the given edges.
+
+        Parameters
+        ----------
+        src : array of int
+            Source nodes of the edges
+        dst : array of int
+            Target nodes of the edges
+
+        Returns
+        -------
+        np.ndarray
+            IDs of the edges (-1 for edges not in the graph)
+        """
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        edge_ids = np.full(len(src), -1, dtype=np.int64)
+
+        valid = (src >= 0) & (src < self.n_nodes)
+        lo = np.zeros(len(src), dtype=np.int64)
+        end = np.zeros(len(src), dtype=np.int64)
+        lo[valid] = self.indptr[src[valid]]
+        end[valid] = self.indptr[src[valid] + 1]
+
+        # Binary search of the (sorted) targets of every source node at once
+        hi = end.copy()
+        active = np.flatnonzero(lo < hi)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            right = self.indices[mid] < dst[active]
+            lo[active[right]] = mid[right] + 1
+            hi[active[~right]] = mid[~right]
+            active = active[lo[active] < hi[active]]
+
+        candidates = np.flatnonzero(lo < end)
+        found = candidates[self.indices[lo[candidates]] == dst[candidates]]
+        edge_ids[found] = lo[found]
+        return edge_ids
+
+    def updated(
+        self, remove=(), add_src=(), add_dst=(), add_attrs=None, set_attrs=None
+    ):
+        """Return a copy of the graph with edges added, removed and changed.
+
+        The new edges are merged into the (sorted) existing edges,
+        without sorting all the edges again.
+
+        Parameters
+        ----------
+        remove : array of int
+            IDs of the edges to be removed
+        add_src : array of int
+            Source nodes of the edges to be added (which are not in the graph)
+        add_dst : array of int
+            Target nodes of the edges to be added
+        add_attrs : dict [str -> array], optional
+            Attribute name to the attribute values of the added edges
+        set_attrs : dict [str -> (array, array)], optional
+            Attribute name to the IDs and new attribute values
+            of existing edges
+
+        Returns
+        -------
+        CSRGraph
+            The updated graph
+        """
+        remove = np.asarray(remove, dtype=np.int64)
+        add_src = np.asarray(add_src, dtype=np.int64)
+        add_dst = np.asarray(add_dst, dtype=np.int64)
+        add_attrs = {} if add_attrs is None else add_attrs
+        set_attrs = {} if set_attrs is None else set_attrs
+
+        # The arrays may be read only memory maps, so they are copied on write
+        attrs = dict(self.attrs)
+        for name, (edge_ids, values) in set_attrs.items():
+            if len(edge_ids):
+                attrs[name] = np.array(attrs[name])
+                attrs[name][edge_ids] = values
+
+        if not len(remove) and not len(add_src):
+            return self._from_arrays(self.n_nodes, self.indptr, self.indices, attrs)
+
+        n_nodes = self.n_nodes
+        if len(add_src):
+            n_nodes = max(n_nodes, int(add_src.max()) + 1, int(add_dst.max()) + 1)
+
+        keep = np.ones(self.n_edges, dtype=bool)
+        keep[remove] = False
+        src = self.sources()[keep]
+        indices = self.indices[keep]
+        attrs = {name: values[keep] for name, values in attrs.items()}
+
+        new_keys = add_src * n_nodes + add_dst
+        order = np.argsort(new_keys)
+        pos = np.searchsorted(src * n_nodes + indices, new_keys[order])
+        src = np.insert(src, pos, add_src[order])
+        indices = np.insert(indices, pos, add_dst[order])
+        for name, values in attrs.items():
+            new_values = np.asarray(add_attrs[name], dtype=values.dtype)[order]
+            attrs[name] = np.insert(values, pos, new_values)
+
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+        return self._from_arrays(n_nodes, indptr, indices, attrs)
+
+    def save(self, path):
+        """Write the graph to a directory of .npy files.
+
+        Parameters
+        ----------
+        path : str
+            The (new) directory
+        """
+        arrays = {"indptr": self.indptr, "indices": self.indices}
+        for name, values in self.attrs.items():
+            arrays["attr_" + name] = values
+        meta = {"n_nodes": self.n_nodes, "attr_names": list(self.attrs)}
+        array_io.save_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read a graph written by `save`.
+
+        Parameters
+        ----------
+        path : str
+            The directory
+        mmap : bool
+            If True, the arrays are memory mapped read only
+
+        Returns
+        -------
+        CSRGraph
+            The graph
+        """
+        arrays, meta = array_io.load_arrays(path, mmap)
+        attrs = {name: arrays["attr_" + name] for name in meta["attr_names"]}
+        return cls._from_arrays(
+            meta["n_nodes"], arrays["indptr"], arrays["indices"], attrs
+        )
+
+
+def open_graph(graph_dir):
+    """Return the latest graph published by a graph store.
+
+    The graph is memory mapped, and is reloaded only when
+    a new graph has been published.
+
+    Parameters
+    ----------
+    graph_dir : str
+        The (node local) graph directory of the store
+
+    Returns
+    -------
+    CSRGraph
+        The latest published graph
+    """
+    return array_io.open_latest(graph_dir, CSRGraph.load)
+
+
+class GraphStore(StateStore):
+    """Contact network store.
+
+    Attributes
+    ----------
+    edge_attrs : dict [str -> np.dtype]
+        Edge attribute name to the dtype of its values
+    graph_dir : str or None
+        Node local directory where the graphs are published
+    graph : CSRGraph
+        The graph as of the last flush
+    """
+
+    def __init__(
+        self,
+        store_name,
+        simulator_aid,
+        edge_attrs=None,
+        graph_path=None,
+        n_nodes=0,
+        graph_dir=None,
+        **kwargs,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_name : str
+            Name of the current state store
+        simulator_aid : str
+            ID of the simulator actor
+        edge_attrs : dict [str -> dtype], optional
+            Edge attribute name to the dtype of its values
+            (defaults to the attributes of the initial graph)
+        graph_path : str, optional
+            Directory of the initial graph (written with `CSRGraph.save`),
+            which is memory mapped
+        n_nodes : int
+            Number of nodes of the (empty) initial graph,
+            if `graph_path` is not given
+        graph_dir : str, optional
+            Node local directory where the graphs are published
+            for the other ranks of the node
+        **kwargs : dict
+            Other arguments of `StateStore`
+        """
+        super().__init__(store_name, simulator_aid, **kwargs)
+
+        if graph_path is not None:
+            self.graph = CSRGraph.load(graph_path)
+            if edge_attrs is None:
+                edge_attrs = {name: v.dtype for name, v in self.graph.attrs.items()}
+            if set(edge_attrs) != set(self.graph.attrs):
+                raise ValueError("Edge attributes differ from those of the graph")
+        else:
+            edge_attrs = {} if edge_attrs is None else edge_attrs
+            attrs = {name: np.empty(0, dtype) for name, dtype in edge_attrs.items()}
+            self.graph = CSRGraph(n_nodes, [], [], attrs)
+
+        self.edge_attrs = {name: np.dtype(dtype) for name, dtype in edge_attrs.items()}
+        self.attr_index = {name: i for i, name in enumerate(self.edge_attrs)}
+        self.graph_dir = graph_dir
+        self.version = 0
+
+        self.update_cache = []
+
+        # Folded edge updates of the current flush keyed by (src, dst)
+        self.edge_ops = {}
+
+        if graph_dir is not None and graph_path is not None:
+            # The initial graph is published without copying it
+            array_io.publish_path(graph_dir, os.path.abspath(graph_path))
+        else:
+            self._publish_graph()
+
+        self.metric_graph_update_time = metrics.counter(
+            f"store_graph_update_time/{store_name}"
+        )
+        self.metric_graph_edges = metrics.gauge(f"store_graph_edges/{store_name}")
+        self.metric_graph_edges.set(self.graph.n_edges)
+
+    def handle_update(self, update):
+        """Handle incoming update."""
+        self.update_cache.append(update)
+
+    def add_edge(self, src, dst, *values):
+        """Add an edge (replacing its attributes if it exists).
+
+        Parameters
+        ----------
+        src : int
+            The source node
+        dst : int
+            The target node
+        *values : tuple
+            The value of every edge attribute
+        """
+        if len(values) != len(self.edge_attrs):
+            raise ValueError("Expected %d edge attributes" % len(self.edge_attrs))
+        self.edge_ops[src, dst] = (ADD, values)
+
+    def remove_edge(self, src, dst):
+        """Remove an edge (if it exists).
+
+        Parameters
+        ----------
+        src : int
+            The source node
+        dst : int
+            The target node
+        """
+        self.edge_ops[src, dst] = (REMOVE, None)
+
+    def set_edge_attr(self, src, dst, name, value):
+        """Set an attribute of an edge (if it exists).
+
+        Parameters
+        ----------
+        src : int
+            The source node
+        dst : int
+            The target node
+        name : str
+            Name of the attribute
+        value : object
+            The new value
+        """
+        key = (src, dst)
+        op = self.edge_ops.get(key)
+        if op is None:
+            self.edge_ops[key] = (SET, {name: value})
+        elif op[0] == SET:
+            op[1][name] = value
+        elif op[0] == ADD:
+            values = list(op[1])
+            values[self.attr_index[name]] = value
+            self.edge_ops[key] = (ADD, values)
+
+    def flush(self):
+        """Apply the updates to the graph."""
+        self.log.log(INFO_FINE, "Applying %d updates", len(self.update_cache))
+        with tracing.span("apply", cat="store", n_updates=len(self.update_cache)):
+            self.update_cache.sort()
+            for update in self.update_cache:
+                update.apply(self)
+            self.update_cache.clear()
+
+        if self.edge_ops:
+            self._apply_edge_ops()
+
+    def _apply_edge_ops(self):
+        """Apply the folded edge updates in bulk and publish the graph."""
+        start_time = perf_counter()
+        keys = sorted(self.edge_ops)
+        ops = [self.edge_ops[key] for key in keys]
+        self.edge_ops = {}
+
+        with tracing.span("update_graph", cat="store", n_edges=len(keys)):
+            src = np.array([key[0] for key in keys], dtype=np.int64)
+            dst = np.array([key[1] for key in keys], dtype=np.int64)
+            kind = np.array([op[0] for op in ops])
+            edge_ids = self.graph.find_edges(src, dst)
+            exists = edge_ids >= 0
+
+            remove = edge_ids[exists & (kind == REMOVE)]
+
+            added = np.flatnonzero(~exists & (kind == ADD))
+            add_attrs = {
+                name: np.array([ops[i][1][j] for i in added], dtype=dtype)
+                for j, (name, dtype) in enumerate(self.edge_attrs.items())
+            }
+
+            set_attrs = {name: ([], []) for name in self.edge_attrs}
+            for i in np.flatnonzero(exists & (kind != REMOVE)):
+                op_kind, values = ops[i]
+                if op_kind == ADD:
+                    values = zip(self.edge_attrs, values)
+                else:
+                    values = values.items()
+                for name, value in values:
+                    set_attrs[name][0].append(edge_ids[i])
+                    set_attrs[name][1].append(value)
+
+            self.graph = self.graph.updated(
+                remove, src[added], dst[added], add_attrs, set_attrs
+            )
+            self._publish_graph()
+
+        self.metric_graph_update_time.inc(perf_counter() - start_time)
+        self.metric_graph_edges.set(self.graph.n_edges)
+
+    def _publish_graph(self):
+        """Write the graph for the other ranks of the node."""
+        if self.graph_dir is None:
+            return
+
+        self.version += 1
+        array_io.publish(self.graph_dir, self.version, self.graph)
+
+    def save_checkpoint(self, path):
+        """Write the graph."""
+        tmp_path = path + ".tmp.csr"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        self.graph.save(tmp_path)
+        if os.path.exists(path + ".csr"):
+            shutil.rmtree(path + ".csr")
+        os.replace(tmp_path, path + ".csr")
+
+    def load_checkpoint(self, path):
+        """Replace the graph with the checkpointed one."""
+        self.graph = CSRGraph.load(path + ".csr", mmap=False)
+        self._publish_graph()
+        self.metric_graph_edges.set(self.graph.n_edges)
@@ -0,0 +1,167 @@
+"""Agent hibernation.
+
+Agents that are alive but rarely active
+can be spilled out of the runner's memory
+into a node local on disk store,
+and are faulted back in when they are next due.
+
+The hibernation store is a scratch SQLite3 database
+private to a single runner.
+It is not meant to survive the simulation;
+it is opened without a journal or synchronous writes,
+and is deleted when closed.
+"""
+
+import os
+import pickle
+import sqlite3
+
+import xactor as asys
+
+from . import INFO_FINE
+
+LOG = asys.getLogger(__name__)
+
+
+class HibernationStore:
+    """Node local on disk store of hibernated agents.
+
+    Attributes
+    ----------
+    path : str
+        Path of the SQLite3 database file
+    connection : sqlite3.Connection
+        The sqlite3 connection object
+    handles : set of int
+        Handles of the hibernated agents
+    """
+
+    def __init__(self, path):
+        """Initialize.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite3 database file;
+            any existing file is overwritten
+        """
+        self.path = path
+        self.handles = set()
+
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        LOG.log(INFO_FINE, "Opening hibernation store at '%s'", path)
+        con = sqlite3.connect(path, isolation_level=None)
+        con.execute("pragma journal_mode = off")
+        con.execute("pragma synchronous = off")
+        con.execute("create table agent (handle integer primary key, data blob)")
+        self.connection = con
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, handle):
+        return handle in self.handles
+
+    def put_many(self, agents):
+        """Hibernate a number of agents.
+
+        Parameters
+        ----------
+        agents : list of (int, Agent) tuples
+            Handles and the agents to be hibernated
+
+        Returns
+        -------
+        int
+            Total size of the serialized agents in bytes
+        """
+        rows = [
+            (handle, pickle.dumps(agent, protocol=pickle.HIGHEST_PROTOCOL))
+            for handle, agent in agents
+        ]
+
+        con = self.connection
+        con.execute("begin")
+        con.executemany("insert into agent values (?, ?)", rows)
+        con.execute("commit")
+
+        self.handles.update(handle for handle, _ in agents)
+        return sum(len(data) for _, data in rows)
+
+    def take_many(self, handles):
+        """Fault in a number of hibernated agents.
+
+        The agents are removed from the store.
+
+        Parameters
+        ----------
+        handles : list of int
+            Handles of the hibernated agents
+
+        Returns
+        -------
+        list of (int, Agent) tuples
+            Handles and the faulted in agents
+        """
+        con = self.connection
+        con.execute("begin")
+        con.execute("create temp table if not exists wanted (handle integer)")
+        con.execute("delete from wanted")
+        con.executemany("insert into wanted values (?)", ((h,) for h in handles))
+        rows = con.execute(
+            "select handle, data from agent where handle in (select handle from wanted)"
+        ).fetchall()
+        con.execute("delete from agent where handle in (select handle from wanted)")
+        con.execute("commit")
+
+        if __debug__:
+            if len(rows) != len(handles):
+                raise RuntimeError(
+                    "Expected %d hibernated agents, found %d"
+                    % (len(handles), len(rows))
+                )
+
+        self.handles.difference_update(handles)
+        return [(handle, pickle.loads(data)) for handle, data in rows]
+
+    def dump(self):
+        """Return the serialized hibernated agents (e.g. for a checkpoint).
+
+        Returns
+        -------
+        list of (int, bytes) tuples
+            Handles and the serialized agents
+        """
+        return self.connection.execute("select handle, data from agent").fetchall()
+
+    def load(self, rows):
+        """Add serialized agents (e.g. from a checkpoint).
+
+        Parameters
+        ----------
+        rows : list of (int, bytes) tuples
+            Handles and the serialized agents
+        """
+        con = self.connection
+        con.execute("begin")
+        con.executemany("insert into agent values (?, ?)", rows)
+        con.execute("commit")
+
+        self.handles.update(handle for handle, _ in rows)
+
+    def close(self):
+        """Close the connection and delete the database file."""
+        if self.connection is None:
+            return
+
+        LOG.log(INFO_FINE, "Closing hibernation store at '%s'", self.path)
+        self.connection.close()
+        self.connection = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,268 @@
+"""Streaming histograms.
+
+A streaming histogram summarizes a stream of non-negative values
+(e.g. agent step times) using a fixed number of logarithmically spaced bins,
+along with the exact count, sum, sum of squares, min and max.
+Its memory usage does not depend on the number of values added.
+Quantiles are estimated from the bins
+with a relative error bounded by the bin width.
+
+Values are first collected into a small preallocated buffer
+and are binned in bulk when the buffer fills up.
+"""
+
+import numpy as np
+
+# Number of values buffered before they are binned
+BUFFER_SIZE = 4096
+
+
+class StreamingHistogram:
+    """Fixed bin streaming histogram.
+
+    Bin 0 holds values below `min_value` (including zero),
+    the last bin holds values at or above `max_value`,
+    and the bins in between split [min_value, max_value)
+    into `bins_per_decade` logarithmically spaced bins per power of ten.
+
+    Attributes
+    ----------
+    min_value : float
+        Lower limit of the logarithmic bins
+    max_value : float
+        Upper limit of the logarithmic bins
+    bins_per_decade : int
+        Number of bins per power of ten
+    bin_edges : np.ndarray
+        The right edges of the bins
+    bin_counts : np.ndarray
+        Number of values in every bin
+    count : int
+        Number of values added
+    sum : float
+        Sum of the values added
+    sum_squares : float
+        Sum of squares of the values added
+    min : float
+        Minimum of the values added
+    max : float
+        Maximum of the values added
+    """
+
+    def __init__(self, min_value=1e-9, max_value=1e9, bins_per_decade=20):
+        """Initialize.
+
+        Parameters
+        ----------
+        min_value : float
+            Lower limit of the logarithmic bins
+        max_value : float
+            Upper limit of the logarithmic bins
+        bins_per_decade : int
+            Number of bins per power of ten
+        """
+        if not 0.0 < min_value < max_value:
+            raise ValueError("Expected 0 < min_value < max_value")
+
+        self.min_value = float(min_value)
+        self.max_value = float(max_value)
+        self.bins_per_decade = int(bins_per_decade)
+
+        self._log_min = np.log10(self.min_value)
+        n_log_bins = int(
+            np.ceil((np.log10(self.max_value) - self._log_min) * self.bins_per_decade)
+        )
+        log_edges = self.min_value * np.power(
+            10.0, np.arange(1, n_log_bins + 1) / self.bins_per_decade
+        )
+        self.bin_edges = np.concatenate([[self.min_value], log_edges, [np.inf]])
+        self.bin_counts = np.zeros(len(self.bin_edges), dtype=np.int64)
+
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+        self._buffer = np.empty(BUFFER_SIZE, dtype=np.float64)
+        self._n_buffered = 0
+
+    def reset(self):
+        """Remove all the values."""
+        self.bin_counts.fill(0)
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._n_buffered = 0
+
+    def add(self, value):
+        """Add a value.
+
+        Parameters
+        ----------
+        value : float
+            The value to be added
+        """
+        self._buffer[self._n_buffered] = value
+        self._n_buffered += 1
+        if self._n_buffered == BUFFER_SIZE:
+            self._fold()
+
+    def _fold(self):
+        """Bin the buffered values."""
+        if not self._n_buffered:
+            return
+
+        values = self._buffer[: self._n_buffered]
+        self._n_buffered = 0
+
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sum_squares += float(np.dot(values, values))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        indices = np.searchsorted(self.bin_edges, values, side="right")
+        np.minimum(indices, len(self.bin_counts) - 1, out=indices)
+        self.bin_counts += np.bincount(indices, minlength=len(self.bin_counts))
+
+    def __getstate__(self):
+        # Only the binned values are pickled, not the buffer
+        self._fold()
+        state = dict(self.__dict__)
+        del state["_buffer"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffer = np.empty(BUFFER_SIZE, dtype=np.float64)
+
+    def merge(self, other):
+        """Add the values of another histogram with the same bins.
+
+        Parameters
+        ----------
+        other : StreamingHistogram
+            The other histogram
+        """
+        if len(self.bin_edges) != len(other.bin_edges) or not np.array_equal(
+            self.bin_edges, other.bin_edges
+        ):
+            raise ValueError("Can't merge histograms with different bins")
+
+        self._fold()
+        other._fold()  # pylint: disable=protected-access
+
+        self.bin_counts += other.bin_counts
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def __len__(self):
+        self._fold()
+        return self.count
+
+    def mean(self):
+        """Return the mean of the values (nan if empty)."""
+        self._fold()
+        if not self.count:
+            return np.nan
+        return self.sum / self.count
+
+    def quantile(self, q):
+        """Estimate a quantile of the values.
+
+        The quantile is interpolated within the bin containing it,
+        and clamped to the observed min and max.
+
+        Parameters
+        ----------
+        q : float
+            The quantile to estimate (between 0 and 1)
+
+        Returns
+        -------
+        float
+            The estimated quantile (nan if empty)
+        """
+        self._fold()
+        if not self.count:
+            return np.nan
+
+        rank = q * (self.count - 1)
+        cum_counts = np.cumsum(self.bin_counts)
+        i = int(np.searchsorted(cum_counts, rank, side="right"))
+        i = min(i, len(self.bin_counts) - 1)
+
+        lo = self.bin_edges[i - 1] if i > 0 else self.min
+        hi = self.bin_edges[i]
+        lo = max(lo, self.min)
+        hi = min(hi, self.max)
+
+        before = cum_counts[i - 1] if i > 0 else 0
+        frac = (rank - before + 0.5) / self.bin_counts[i]
+        frac = min(max(frac, 0.0), 1.0)
+        return float(lo + (hi - lo) * frac)
+
+    def nonempty_bins(self):
+        """Return the right edges and counts of the non empty bin range.
+
+        The leading and trailing empty bins are trimmed;
+        the right edge of the last bin is set to the observed max.
+
+        Returns
+        -------
+        bin_edges : np.ndarray
+            The right edges of the bins
+        bin_counts : np.ndarray
+            The number of values in every bin
+        """
+        self._fold()
+        nonzero = np.flatnonzero(self.bin_counts)
+        if not len(nonzero):
+            return np.empty(0), np.empty(0, dtype=np.int64)
+
+        start, end = nonzero[0], nonzero[-1] + 1
+        bin_edges = self.bin_edges[start:end].copy()
+        bin_edges[-1] = self.max
+        return bin_edges, self.bin_counts[start:end].copy()
+
+    def write_summary(self, summary_writer, tag, global_step):
+        """Write the histogram to a tensorboard summary writer.
+
+        Besides the histogram itself, the mean, median,
+        99th percentile and max are written as scalars.
+
+        Parameters
+        ----------
+        summary_writer : TensorboardWriter
+            The summary writer
+        tag : str
+            The histogram tag
+        global_step : float
+            The current step
+        """
+        self._fold()
+        if not self.count:
+            return
+
+        bin_edges, bin_counts = self.nonempty_bins()
+        summary_writer.add_histogram_raw(
+            tag,
+            min=self.min,
+            max=self.max,
+            num=self.count,
+            sum=self.sum,
+            sum_squares=self.sum_squares,
+            bucket_limits=bin_edges.tolist(),
+            bucket_counts=bin_counts.tolist(),
+            global_step=global_step,
+        )
+        summary_writer.add_scalar(f"{tag}/mean", self.mean(), global_step)
+        summary_writer.add_scalar(f"{tag}/p50", self.quantile(0.5), global_step)
+        summary_writer.add_scalar(f"{tag}/p99", self.quantile(0.99), global_step)
+        summary_writer.add_scalar(f"{tag}/max", self.max, global_step)
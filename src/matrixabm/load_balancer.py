@@ -3,7 +3,6 @@
 A load balancer encapsulates the agent load balancing logic.
 """
 
-import heapq
 import random
 from abc import ABC, abstractmethod
 
@@ -14,6 +13,19 @@ LAMBDA_B = 0.9
 LAMBDA = 0.9
 IMBALANCE_TOL = 0.05
 
+# Initial size of the object tables of the greedy load balancer
+INITIAL_CAPACITY = 1024
+
+# Weight below which the interactions are forgotten by the graph load balancer
+MIN_INTERACTION_WEIGHT = 1e-3
+
+# Number of label propagation passes finding communities of new objects
+N_COMMUNITY_PASSES = 6
+
+# Keys are summed with a dense table instead of by sorting
+# if the table is at most this many times larger than the keys
+DENSE_SUM_FACTOR = 4
+
 
 class LoadBalancer(ABC):
     """Load Balancer interface.
@@ -33,17 +45,20 @@ class LoadBalancer(ABC):
         """Prepare the balancer for next balancing round."""
 
     @abstractmethod
-    def add_object(self, o, la, lb):
+    def add_object(self, o, la, lb, b=None):
         """Add a new object.
 
         Parameters
         ----------
-        o : str or int
-            ID of the object
+        o : int
+            Handle of the object
         la : float
             First component of object load (e.g. CPU usage)
         lb : float
             Second component of object load (e.g. Memory usage)
+        b : int, optional
+            The bucket where the object has already been placed.
+            If given, the object is not reported as a new object.
         """
 
     @abstractmethod
@@ -52,8 +67,22 @@ class LoadBalancer(ABC):
 
         Parameters
         ----------
-        o : str or int
-            ID of the object
+        o : int
+            Handle of the object
+        """
+
+    @abstractmethod
+    def move_object(self, o, b):
+        """Record that an object was moved outside of the balancer.
+
+        The object is not reported as a moving object.
+
+        Parameters
+        ----------
+        o : int
+            Handle of the object
+        b : int
+            The bucket where the object now is
         """
 
     @abstractmethod
@@ -62,12 +91,14 @@ class LoadBalancer(ABC):
 
         Parameters
         ----------
-        o : str or int
-            ID of the object
-        la : float
-            First component of object load (e.g. CPU usage)
-        lb : float
-            Second component of object load (e.g. Memory usage)
+        o : int
+            Handle of the object
+        la : float or None
+            First component of object load (e.g. CPU usage);
+            None leaves the current estimate unchanged
+        lb : float or None
+            Second component of object load (e.g. Memory usage);
+            None leaves the current estimate unchanged
         """
 
     @abstractmethod
@@ -81,8 +112,8 @@ class LoadBalancer(ABC):
         Returns
         -------
         list of two tuples [(o, b])
-            o : str or int
-                ID of the object
+            o : int
+                Handle of the object
             b : int
                 The bucket of the object
         """
@@ -94,14 +125,30 @@ class LoadBalancer(ABC):
         Returns
         -------
         list of three tuples [(o, srcb, dstb])
-            o : str or int
-                ID of the object
+            o : int
+                Handle of the object
             srcb : int
                 The source bucket of the object
             dstb : int
                 The destination bucket of the object
         """
 
+    def add_interactions(self, objects_a, objects_b, weights=None):
+        """Record interactions between pairs of objects.
+
+        Balancers not aware of the interactions ignore them.
+
+        Parameters
+        ----------
+        objects_a : list of int
+            Handles of the first objects of the pairs
+        objects_b : list of int
+            Handles of the second objects of the pairs
+        weights : list of float, optional
+            Strength of the interactions (defaults to 1)
+        """
+
+
 class GreedyLoadBalancer(LoadBalancer):
     """Greedy load balancer.
 
@@ -110,80 +157,139 @@ class GreedyLoadBalancer(LoadBalancer):
     to the least loaded bucket.
     This process continues until the imbalance
     is below a tolerance threshold.
+
+    The object tables are arrays indexed by slots,
+    which grow as needed.
+    Every object is given a slot when it is added.
+    The slots of deleted objects are reused
+    for objects added after the next balance step,
+    so the tables grow with the live objects,
+    not with all the objects ever added.
     """
 
     def __init__(self, n_buckets):
         """Initialize."""
         super().__init__(n_buckets)
-        self.bucket_objects = [set() for _ in range(self.n_buckets)]
-        self.object_bucket = dict()
 
-        self.object_la = {}
-        self.object_lb = {}
+        # Slot of every object
+        self.object_slot = dict()
+        # Object of every slot; -1 if the slot is not in use
+        self.slot_object = np.full(INITIAL_CAPACITY, -1, dtype=np.int64)
+        # Number of slots ever used
+        self.n_slots = 0
+        # Slots to be reused, and slots to be reused after the next balance step
+        self.free_slots = []
+        self.dead_slots = []
+
+        # Bucket of every slot; -1 if the slot is not in use
+        self.object_bucket = np.full(INITIAL_CAPACITY, -1, dtype=np.int64)
+        self.object_la = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
+        self.object_lb = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
 
         # The values of the following are only valid
         # after a call to balance
-        self.object_load = {}
+        self.live_slots = np.zeros(0, dtype=np.int64)
+        self.object_load = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
         self.bucket_load = np.zeros(self.n_buckets, dtype=np.float64)
         self.imbalance = 0.0
 
-        self.new_objects = set()
+        self.new_objects = []
         self.object_bucket_prev = dict()
 
+    def _allocate_slot(self, o):
+        """Allocate a slot for the object, growing the tables if needed."""
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.object_slot[o] = slot
+            self.slot_object[slot] = o
+            return slot
+
+        slot = self.n_slots
+        self.n_slots += 1
+        capacity = len(self.object_bucket)
+        if slot == capacity:
+            self.slot_object = np.concatenate(
+                [self.slot_object, np.full(capacity, -1, dtype=np.int64)]
+            )
+            self.object_bucket = np.concatenate(
+                [self.object_bucket, np.full(capacity, -1, dtype=np.int64)]
+            )
+            self.object_la = np.concatenate([self.object_la, np.zeros(capacity)])
+            self.object_lb = np.concatenate([self.object_lb, np.zeros(capacity)])
+            self.object_load = np.concatenate([self.object_load, np.zeros(capacity)])
+
+        self.object_slot[o] = slot
+        self.slot_object[slot] = o
+        return slot
+
+    def _slots(self, objects):
+        """Return the slots of the objects as an array (-1 if not in use)."""
+        get_slot = self.object_slot.get
+        slots = [get_slot(o, -1) for o in np.asarray(objects).tolist()]
+        return np.array(slots, dtype=np.int64)
+
+    def _recycle_slots(self):
+        """Make the slots of the objects deleted before the balance reusable."""
+        self.free_slots.extend(self.dead_slots)
+        self.dead_slots.clear()
+
     def reset(self):
         """Prepare the balancer for next balancing round."""
         self.new_objects.clear()
         self.object_bucket_prev.clear()
 
-    def add_object(self, o, la, lb):
+    def add_object(self, o, la, lb, b=None):
         """Add a new object."""
-        b = random.randint(0, self.n_buckets - 1)
+        if b is None:
+            b = random.randint(0, self.n_buckets - 1)
+            self.new_objects.append(o)
 
-        self.bucket_objects[b].add(o)
-        self.object_bucket[o] = b
-
-        self.object_la[o] = la
-        self.object_lb[o] = lb
-
-        self.new_objects.add(o)
+        slot = self._allocate_slot(o)
+        self.object_bucket[slot] = b
+        self.object_la[slot] = la
+        self.object_lb[slot] = lb
 
     def delete_object(self, o):
         """Remove an object."""
-        b = self.object_bucket[o]
+        slot = self.object_slot.pop(o)
+        self.slot_object[slot] = -1
+        self.object_bucket[slot] = -1
+        self.object_la[slot] = 0.0
+        self.object_lb[slot] = 0.0
+        self.dead_slots.append(slot)
 
-        del self.object_la[o]
-        del self.object_lb[o]
-
-        del self.object_bucket[o]
-        self.bucket_objects[b].remove(o)
+    def move_object(self, o, b):
+        """Record that an object was moved outside of the balancer."""
+        self.object_bucket[self.object_slot[o]] = b
 
     def update_load(self, o, la, lb):
         """Set the load of the given objects."""
-        p_la = self.object_la[o]
-        p_lb = self.object_lb[o]
-
-        la = (1 - LAMBDA_A) * p_la + LAMBDA_A * la
-        lb = (1 - LAMBDA_B) * p_lb + LAMBDA_B * lb
-
-        self.object_la[o] = la
-        self.object_lb[o] = lb
+        slot = self.object_slot[o]
+        if la is not None:
+            self.object_la[slot] = (1 - LAMBDA_A) * self.object_la[slot] + LAMBDA_A * la
+        if lb is not None:
+            self.object_lb[slot] = (1 - LAMBDA_B) * self.object_lb[slot] + LAMBDA_B * lb
 
     def _update_load(self):
-        """Update the object and bucket load."""
-        max_la = max(self.object_la.values())
-        max_lb = max(self.object_lb.values())
+        """Update the live slots and the object and bucket load."""
+        live = np.flatnonzero(self.object_bucket[: self.n_slots] >= 0)
+        self.live_slots = live
+        if not len(live):
+            self.bucket_load.fill(0.0)
+            return
 
-        for o in self.object_bucket:
-            la = self.object_la[o] / max_la
-            lb = self.object_la[o] / max_lb
-            l = (1 - LAMBDA) * la + LAMBDA * lb
+        # Loads can be zero (e.g. sleeping agents)
+        la = self.object_la[live]
+        lb = self.object_lb[live]
+        max_la = la.max() or 1.0
+        max_lb = lb.max() or 1.0
 
-            self.object_load[o] = l
+        load = (1 - LAMBDA) * (la / max_la) + LAMBDA * (lb / max_lb)
+        self.object_load[live] = load
 
-        for i in range(self.n_buckets):
-            self.bucket_load.fill(0.0)
-            for o in self.bucket_objects[i]:
-                self.bucket_load[i] += self.object_load[o]
+        self.bucket_load = np.bincount(
+            self.object_bucket[live], weights=load, minlength=self.n_buckets
+        )
 
     def _update_imbalance(self):
         """Check if there is a load imbalance."""
@@ -191,42 +297,48 @@ class GreedyLoadBalancer(LoadBalancer):
         max_load = self.bucket_load.max()
         sum_load = self.bucket_load.sum()
 
+        if sum_load == 0.0:
+            self.imbalance = 0.0
+            return
+
         self.imbalance = float((max_load - min_load) / sum_load)
 
-    def _greedy_move(self,):
+    def _greedy_move(self):
         """Greedily select agents to move from max loaded rank to min loaded rank."""
-        src = np.argmax(self.bucket_load)
-        dst = np.argmin(self.bucket_load)
+        src = int(np.argmax(self.bucket_load))
+        dst = int(np.argmin(self.bucket_load))
 
-        object_load_h = [(self.object_load[o], o) for o in self.bucket_objects[src]]
-        heapq.heapify(object_load_h)
+        live = self.live_slots
+        slots = live[self.object_bucket[live] == src]
+        loads = self.object_load[slots]
+        order = np.argsort(loads, kind="stable")
+        slots, loads = slots[order], loads[order]
+        objects = self.slot_object[slots]
 
         moved = False
-        while object_load_h:
-            l, o = heapq.heappop(object_load_h)
-
+        src_load = self.bucket_load[src]
+        dst_load = self.bucket_load[dst]
+        for slot, o, l in zip(slots.tolist(), objects.tolist(), loads.tolist()):
             # If movement will still leave the src bucket
             # more or equally loaded than dst bucket,
             # then move the object
-            if self.bucket_load[src] - l >= self.bucket_load[dst] + l:
+            if src_load - l >= dst_load + l:
                 moved = True
                 if o not in self.object_bucket_prev:
                     self.object_bucket_prev[o] = src
 
-                self.bucket_load[src] -= l
-                self.bucket_load[dst] += l
-                self.bucket_objects[src].remove(o)
-                self.bucket_objects[dst].add(o)
-                self.object_bucket[o] = dst
+                src_load -= l
+                dst_load += l
+                self.object_bucket[slot] = dst
             else:
                 break
 
+        self.bucket_load[src] = src_load
+        self.bucket_load[dst] = dst_load
         return moved
 
-    def balance(self):
-        """Balance the load distribution in the buckets."""
-        self._update_load()
-
+    def _greedy_balance(self):
+        """Move objects until the imbalance is below the tolerance."""
         while True:
             self._update_imbalance()
             if self.imbalance < IMBALANCE_TOL:
@@ -236,17 +348,27 @@ class GreedyLoadBalancer(LoadBalancer):
             if not moved:
                 break
 
+    def _prune_moves(self):
+        """Forget the moves of new objects and of objects moved back."""
+        new_objects = set(self.new_objects)
         for o in list(self.object_bucket_prev.keys()):
-            if o in self.new_objects:
+            if o in new_objects:
                 del self.object_bucket_prev[o]
-            elif self.object_bucket_prev[o] == self.object_bucket[o]:
+            elif self.object_bucket_prev[o] == self.object_bucket[self.object_slot[o]]:
                 del self.object_bucket_prev[o]
 
+    def balance(self):
+        """Balance the load distribution in the buckets."""
+        self._update_load()
+        self._greedy_balance()
+        self._prune_moves()
+        self._recycle_slots()
+
     def get_new_objects(self):
         """Return the bucket of the new objects."""
         ret = []
         for o in self.new_objects:
-            b = self.object_bucket[o]
+            b = int(self.object_bucket[self.object_slot[o]])
             ret.append((o, b))
         return ret
 
@@ -255,10 +377,385 @@ class GreedyLoadBalancer(LoadBalancer):
         ret = []
         for o in self.object_bucket_prev:
             srcb = self.object_bucket_prev[o]
-            dstb = self.object_bucket[o]
+            dstb = int(self.object_bucket[self.object_slot[o]])
             ret.append((o, srcb, dstb))
         return ret
 
+
+def _sum_by_key(keys, weights, n_keys):
+    """Sum weights by key.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        Non-negative integer keys
+    weights : np.ndarray
+        The weights
+    n_keys : int
+        Upper bound of the keys
+
+    Returns
+    -------
+    keys : np.ndarray
+        The distinct keys (sorted)
+    sums : np.ndarray
+        The sum of the weights of every key
+    """
+    if n_keys <= DENSE_SUM_FACTOR * len(keys):
+        sums = np.bincount(keys, weights=weights, minlength=n_keys)
+        keys = np.flatnonzero(np.bincount(keys, minlength=n_keys))
+        return keys, sums[keys]
+
+    order = np.argsort(keys)
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(weights[order], starts)
+
+
+def _best_per_object(obj, value, tie):
+    """Return the indices of the highest value (then lowest tie) of every object."""
+    idx = np.lexsort((tie, -value, obj))
+    first = np.ones(len(idx), dtype=bool)
+    first[1:] = obj[idx[1:]] != obj[idx[:-1]]
+    return idx[first]
+
+
+class GraphLoadBalancer(GreedyLoadBalancer):
+    """Graph aware load balancer.
+
+    Heavily interacting objects (agents) scattered over the buckets (ranks)
+    make for a lot of cross rank (and cross node) update and read traffic.
+    Besides the object loads, the graph aware load balancer
+    keeps a weighted graph of the interactions between the objects,
+    which are declared by the model or observed by the runners
+    (see `add_interactions`).
+
+    On every balance step, new objects interacting with each other
+    are first grouped into communities using (unconstrained) label propagation.
+    The new objects are then placed in community order
+    into contiguous runs of buckets, filling up the least loaded buckets.
+    The load is then balanced greedily (as with `GreedyLoadBalancer`),
+    and the partition is refined with a few passes of label propagation,
+    moving objects to the bucket of most of their interactions
+    as long as the destination bucket's load stays within tolerance,
+    which reduces the weight of the interactions cut by the partition.
+    To avoid oscillation,
+    the passes alternately move objects only to higher or to lower buckets.
+
+    New objects are placed freely,
+    while the number of existing objects moved by the refinement
+    is limited on every balance step,
+    so the partition improves incrementally
+    and per step migration stays small.
+
+    Attributes
+    ----------
+    imbalance_tol : float
+        Maximum load of a bucket relative to the mean load
+        after which no objects are moved into it by the refinement
+    max_migration : float
+        Maximum fraction of existing objects moved by the refinement
+        on every balance step
+    n_passes : int
+        Maximum number of label propagation passes on every balance step
+    interaction_decay : float
+        Factor by which the interaction weights decay on every balance step
+    edge_cut : float
+        Fraction of the interaction weight cut by the partition
+        after the last balance step
+    """
+
+    def __init__(
+        self,
+        n_buckets,
+        imbalance_tol=0.1,
+        max_migration=0.01,
+        n_passes=8,
+        interaction_decay=1.0,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        n_buckets : int
+            Number of buckets
+        imbalance_tol : float
+            Maximum load of a bucket relative to the mean load
+            after which no objects are moved into it by the refinement
+        max_migration : float
+            Maximum fraction of existing objects moved by the refinement
+            on every balance step
+        n_passes : int
+            Maximum number of label propagation passes on every balance step
+        interaction_decay : float
+            Factor by which the interaction weights decay on every balance step.
+            With a factor below 1, interactions that are no longer observed
+            are eventually forgotten,
+            and declared interactions have to be declared again.
+        """
+        super().__init__(n_buckets)
+
+        self.imbalance_tol = float(imbalance_tol)
+        self.max_migration = float(max_migration)
+        self.n_passes = int(n_passes)
+        self.interaction_decay = float(interaction_decay)
+        self.edge_cut = 0.0
+
+        # Interaction graph between slots; every pair is stored once with a < b
+        self.edge_a = np.zeros(0, dtype=np.int64)
+        self.edge_b = np.zeros(0, dtype=np.int64)
+        self.edge_w = np.zeros(0, dtype=np.float64)
+
+        # Interactions (between slots) recorded since the last balance step
+        self.pending_interactions = []
+
+    def add_interactions(self, objects_a, objects_b, weights=None):
+        """Record interactions between pairs of objects."""
+        # Interactions with unknown (e.g. dead) objects are ignored
+        objects_a = self._slots(objects_a)
+        objects_b = self._slots(objects_b)
+        if weights is None:
+            weights = np.ones(len(objects_a))
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+        self.pending_interactions.append((objects_a, objects_b, weights))
+
+    def _merge_interactions(self, index):
+        """Merge the recorded interactions into the interaction graph.
+
+        Parameters
+        ----------
+        index : np.ndarray
+            Dense index of every live slot; -1 for slots not in use
+
+        Returns
+        -------
+        lo, hi, w : np.ndarray
+            The interaction graph over the dense indices
+        """
+        w = self.edge_w * self.interaction_decay
+        if not self.pending_interactions:
+            # Only forget the weak interactions and those with dead objects
+            lo, hi = index[self.edge_a], index[self.edge_b]
+            valid = (lo >= 0) & (hi >= 0) & (w >= MIN_INTERACTION_WEIGHT)
+            lo, hi, w = lo[valid], hi[valid], w[valid]
+        else:
+            parts = [(self.edge_a, self.edge_b, w)]
+            parts.extend(self.pending_interactions)
+            self.pending_interactions = []
+
+            a = np.concatenate([part[0] for part in parts])
+            b = np.concatenate([part[1] for part in parts])
+            w = np.concatenate([part[2] for part in parts])
+
+            # Forget interactions with dead (or unknown) objects
+            a = np.where(a >= 0, index[a], -1)
+            b = np.where(b >= 0, index[b], -1)
+            lo = np.minimum(a, b)
+            hi = np.maximum(a, b)
+            valid = (lo != hi) & (lo >= 0)
+            lo, hi, w = lo[valid], hi[valid], w[valid]
+
+            n = len(self.live_slots)
+            keys, w = _sum_by_key(lo * n + hi, w, n * n)
+            strong = w >= MIN_INTERACTION_WEIGHT
+            lo, hi, w = keys[strong] // n, keys[strong] % n, w[strong]
+
+        # The live slots are sorted, so lo < hi holds for the slots too
+        self.edge_a = self.live_slots[lo]
+        self.edge_b = self.live_slots[hi]
+        self.edge_w = w
+        return lo, hi, w
+
+    def _refine_pass(self, live, u, v, w, upward, budget, is_new, capacity):
+        """Run a label propagation pass.
+
+        Parameters
+        ----------
+        live : np.ndarray
+            The slot of every dense index
+        u, v, w : np.ndarray
+            The interaction graph over the dense indices
+            (with both directions of every pair)
+        upward : bool
+            If True, objects only move to higher buckets, else to lower buckets
+        budget : int
+            Maximum number of existing objects moved
+        is_new : np.ndarray
+            True for the new objects
+        capacity : float
+            Maximum load of a bucket after moving objects into it
+
+        Returns
+        -------
+        n_moved : int
+            Number of objects moved
+        n_migrated : int
+            Number of existing objects moved
+        """
+        n_buckets = self.n_buckets
+        bucket = self.object_bucket[live]
+
+        # Interaction weight of every object with every bucket
+        n_keys = len(live) * n_buckets
+        keys, weight = _sum_by_key(u * n_buckets + bucket[v], w, n_keys)
+        obj = keys // n_buckets
+        dst = keys % n_buckets
+        src = bucket[obj]
+
+        internal = np.zeros(len(live))
+        own = dst == src
+        internal[obj[own]] = weight[own]
+        gain = weight - internal[obj]
+
+        candidate = (gain > 0) & ((dst > src) if upward else (dst < src))
+        idx = np.flatnonzero(candidate)
+        if not len(idx):
+            return 0, 0
+
+        # The best destination of every object, highest gains first
+        idx = idx[_best_per_object(obj[idx], gain[idx], dst[idx])]
+        idx = idx[np.argsort(-gain[idx], kind="stable")]
+        obj, src, dst = obj[idx], src[idx], dst[idx]
+        load = self.object_load[live[obj]]
+
+        # Fill every destination bucket up to the capacity
+        order = np.argsort(dst, kind="stable")
+        cum_load = np.cumsum(load[order])
+        group_start = np.searchsorted(dst[order], dst[order])
+        cum_load -= cum_load[group_start] - load[order][group_start]
+        fits = np.empty(len(obj), dtype=bool)
+        fits[order] = cum_load <= capacity - self.bucket_load[dst[order]]
+
+        # Limit the migration of existing objects
+        migrated = fits & ~is_new[obj]
+        fits &= ~migrated | (np.cumsum(migrated) <= budget)
+        migrated &= fits
+
+        obj, src, dst, load = obj[fits], src[fits], dst[fits], load[fits]
+        migrated = migrated[fits]
+        objects = self.slot_object[live[obj[migrated]]]
+        for o, b in zip(objects.tolist(), src[migrated].tolist()):
+            if o not in self.object_bucket_prev:
+                self.object_bucket_prev[o] = b
+
+        self.object_bucket[live[obj]] = dst
+        self.bucket_load -= np.bincount(src, weights=load, minlength=n_buckets)
+        self.bucket_load += np.bincount(dst, weights=load, minlength=n_buckets)
+        return len(obj), int(migrated.sum())
+
+    def _communities(self, u, v, w, n):
+        """Find communities with label propagation.
+
+        Parameters
+        ----------
+        u, v, w : np.ndarray
+            The interaction graph over the dense indices
+            (with both directions of every pair)
+        n : int
+            Number of dense indices
+
+        Returns
+        -------
+        np.ndarray
+            The community label of every dense index
+        """
+        label = np.arange(n)
+        for i in range(N_COMMUNITY_PASSES):
+            keys, weight = _sum_by_key(u * n + label[v], w, n * n)
+            obj = keys // n
+            best = _best_per_object(obj, weight, keys % n)
+
+            # Only half of the objects adopt a new label at a time
+            best = best[(obj[best] + i) % 2 == 0]
+            label[obj[best]] = keys[best] % n
+        return label
+
+    def _place_new_objects(self, live, u, v, w, new, is_new):
+        """Place the new objects by community into contiguous runs of buckets."""
+        inner = is_new[u] & is_new[v]
+        if not inner.any():
+            return
+
+        label = self._communities(u[inner], v[inner], w[inner], len(live))
+        new = live[new[np.lexsort((new, label[new]))]]
+        load = self.object_load[new]
+
+        # Fill up the buckets to the same load
+        old_load = self.bucket_load - np.bincount(
+            self.object_bucket[new], weights=load, minlength=self.n_buckets
+        )
+        mean_load = (old_load.sum() + load.sum()) / self.n_buckets
+        fill = np.maximum(mean_load - old_load, 0.0)
+        if fill.sum() == 0.0:
+            fill = np.ones(self.n_buckets)
+        bounds = np.cumsum(fill) * (load.sum() / fill.sum())
+
+        mid_load = np.cumsum(load) - load / 2
+        buckets = np.searchsorted(bounds, mid_load, side="right")
+        self.object_bucket[new] = np.minimum(buckets, self.n_buckets - 1)
+        self.bucket_load = old_load + np.bincount(
+            self.object_bucket[new], weights=load, minlength=self.n_buckets
+        )
+
+    def _refine(self, live, u, v, w, is_new):
+        """Reduce the edge cut with label propagation passes."""
+        capacity = self.bucket_load.sum() / self.n_buckets * (1 + self.imbalance_tol)
+        budget = int(self.max_migration * len(live))
+
+        n_idle_passes = 0
+        for i in range(self.n_passes):
+            n_moved, n_migrated = self._refine_pass(
+                live, u, v, w, i % 2 == 0, budget, is_new, capacity
+            )
+            budget -= n_migrated
+
+            # Stop once neither direction improves the partition
+            n_idle_passes = 0 if n_moved else n_idle_passes + 1
+            if n_idle_passes == 2:
+                break
+
+    def _update_edge_cut(self):
+        """Compute the fraction of the interaction weight that is cut."""
+        total = self.edge_w.sum()
+        if total == 0.0:
+            self.edge_cut = 0.0
+            return
+
+        cut = self.object_bucket[self.edge_a] != self.object_bucket[self.edge_b]
+        self.edge_cut = float(self.edge_w[cut].sum() / total)
+
+    def balance(self):
+        """Balance the load distribution in the buckets."""
+        self._update_load()
+
+        # The interaction graph is processed over the live objects
+        # relabeled to the dense range [0, n_live)
+        live = self.live_slots
+        index = np.full(self.n_slots, -1, dtype=np.int64)
+        index[live] = np.arange(len(live))
+        lo, hi, w = self._merge_interactions(index)
+
+        if not len(w):
+            self._greedy_balance()
+        else:
+            # Both directions of every interaction
+            u = np.concatenate([lo, hi])
+            v = np.concatenate([hi, lo])
+            w = np.concatenate([w, w])
+            new = index[self._slots(self.new_objects)]
+            new = new[new >= 0]
+            is_new = np.zeros(len(live), dtype=bool)
+            is_new[new] = True
+
+            self._place_new_objects(live, u, v, w, new, is_new)
+            self._greedy_balance()
+            self._refine(live, u, v, w, is_new)
+        self._update_edge_cut()
+        self._prune_moves()
+        self._recycle_slots()
+
+
 class RandomLoadBalancer(LoadBalancer):
     """Random load balancer.
 
@@ -281,15 +778,15 @@ class RandomLoadBalancer(LoadBalancer):
         """Prepare the balancer for next balancing round."""
         self.new_objects.clear()
 
-    def add_object(self, o, la, lb):
+    def add_object(self, o, la, lb, b=None):
         """Add a new object."""
-        b = random.randint(0, self.n_buckets - 1)
+        if b is None:
+            b = random.randint(0, self.n_buckets - 1)
+            self.new_objects.add(o)
 
         self.bucket_objects[b].add(o)
         self.object_bucket[o] = b
 
-        self.new_objects.add(o)
-
     def delete_object(self, o):
         """Remove an object."""
         b = self.object_bucket[o]
@@ -297,6 +794,12 @@ class RandomLoadBalancer(LoadBalancer):
         del self.object_bucket[o]
         self.bucket_objects[b].remove(o)
 
+    def move_object(self, o, b):
+        """Record that an object was moved outside of the balancer."""
+        self.bucket_objects[self.object_bucket[o]].remove(o)
+        self.bucket_objects[b].add(o)
+        self.object_bucket[o] = b
+
     def update_load(self, o, la, lb):
         """Set the load of the given objects."""
 
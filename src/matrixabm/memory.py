@@ -0,0 +1,125 @@
+"""Memory measurement.
+
+This module provides functions to measure the memory used
+by individual agent objects and by the current process.
+They are used by the runner
+when measured memory accounting is enabled,
+in place of the agents' self reported `memory_usage`.
+"""
+
+import os
+import sys
+import types
+import resource
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+# Maximum number of objects visited by deep_sizeof
+MAX_OBJECTS = 10000
+
+# Objects which are shared and not counted as part of the object graph
+_SHARED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+)
+
+# Objects without references to other objects
+_ATOMIC_TYPES = (str, bytes, bytearray, int, float, complex, bool, type(None))
+
+
+def deep_sizeof(obj, max_objects=MAX_OBJECTS):
+    """Estimate the memory used by an object and the objects it refers to.
+
+    The object graph is traversed through
+    the items of dicts, lists, tuples, sets and deques,
+    and the instance attributes (`__dict__` and `__slots__`) of other objects.
+    Classes, modules and functions are considered shared and are not counted.
+    NumPy arrays are counted with their data buffer
+    (if they own it).
+    Objects reachable through multiple paths are counted once.
+
+    Parameters
+    ----------
+    obj : object
+        The object to measure
+    max_objects : int
+        Maximum number of objects to visit;
+        if there are more objects, the returned size is a lower bound
+
+    Returns
+    -------
+    int
+        The estimated size in bytes
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < max_objects:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SHARED_TYPES):
+            continue
+        seen.add(id(o))
+
+        size += sys.getsizeof(o)
+        if isinstance(o, (_ATOMIC_TYPES, np.ndarray)):
+            continue
+
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+
+        attrs = getattr(o, "__dict__", None)
+        if attrs is not None:
+            stack.append(attrs)
+        for cls in type(o).__mro__:
+            for slot in getattr(cls, "__slots__", ()):
+                if slot != "__dict__" and hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+
+    return size
+
+
+def rss_bytes():
+    """Return the resident set size of the current process.
+
+    On platforms without ``/proc`` the peak resident set size is returned.
+
+    Returns
+    -------
+    int
+        The (peak) resident set size in bytes
+    """
+    try:
+        with open("/proc/self/statm") as fobj:
+            return int(fobj.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def start_tracing():
+    """Start tracing memory allocations with tracemalloc (if not tracing)."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def traced_bytes():
+    """Return the memory currently traced by tracemalloc.
+
+    Returns
+    -------
+    int or None
+        The traced memory in bytes,
+        or None if tracemalloc is not tracing
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
@@ -0,0 +1,354 @@
+"""Rank local metrics.
+
+Every rank has its own metrics registry,
+where any component running on the rank (runner, stores, user code)
+can record counters, gauges and histograms::
+
+    from matrixabm import metrics
+
+    metrics.counter("runner_updates_sent").inc(len(updates))
+    metrics.histogram("store_sort_time").observe(sort_time)
+
+Recording a metric is a plain attribute update,
+cheap enough to be used in hot loops;
+looking up a metric by name is a dict lookup,
+so hot loops should look the metric up once and keep a reference to it.
+
+At the end of every step the runner on every rank
+collects the per step deltas of the rank's metrics
+and sends them to the metrics aggregator actor on the master rank.
+Metrics recorded after the runner's report
+(e.g. by the flush of the stores)
+are sent with the report of the next step,
+or at the end of the simulation.
+Once the aggregator receives the deltas from every rank,
+it writes them out through a TensorboardWriter,
+and rewrites a plain text OpenMetrics file
+with the cumulative values of all metrics on every rank.
+"""
+
+import os
+import re
+
+import xactor as asys
+
+from . import WORLD_SIZE
+from .histogram import StreamingHistogram
+
+LOG = asys.getLogger(__name__)
+
+
+class Counter:
+    """A monotonically increasing count.
+
+    Attributes
+    ----------
+    name : str
+        Name of the counter
+    value : float
+        Current value of the counter
+    """
+
+    __slots__ = ("name", "value", "_collected")
+
+    def __init__(self, name):
+        """Initialize."""
+        self.name = name
+        self.value = 0
+        self._collected = 0
+
+    def inc(self, n=1):
+        """Increment the counter by n."""
+        self.value += n
+
+    def collect(self):
+        """Return the increment since the last collection."""
+        delta = self.value - self._collected
+        self._collected = self.value
+        return delta
+
+
+class Gauge:
+    """A value that can go up and down.
+
+    Attributes
+    ----------
+    name : str
+        Name of the gauge
+    value : float
+        Current value of the gauge
+    """
+
+    __slots__ = ("name", "value")
+
+    def __init__(self, name):
+        """Initialize."""
+        self.name = name
+        self.value = 0.0
+
+    def set(self, value):
+        """Set the gauge value."""
+        self.value = value
+
+    def collect(self):
+        """Return the current value."""
+        return self.value
+
+
+class Histogram:
+    """A distribution of observed values.
+
+    Attributes
+    ----------
+    name : str
+        Name of the histogram
+    hist : StreamingHistogram
+        The values observed since the last collection
+    """
+
+    __slots__ = ("name", "hist", "observe")
+
+    def __init__(self, name):
+        """Initialize."""
+        self.name = name
+        self.hist = StreamingHistogram()
+        self.observe = self.hist.add
+
+    def collect(self):
+        """Return the values observed since the last collection."""
+        hist = self.hist
+        self.hist = StreamingHistogram()
+        self.observe = self.hist.add
+        return hist
+
+
+class MetricsRegistry:
+    """Registry of the metrics of a rank.
+
+    Attributes
+    ----------
+    metrics : dict [str -> Counter or Gauge or Histogram]
+        The registered metrics
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.metrics = {}
+
+    def _get(self, name, cls):
+        metric = self.metrics.get(name, None)
+        if metric is None:
+            metric = cls(name)
+            self.metrics[name] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(
+                "Metric %s is a %s not a %s"
+                % (name, type(metric).__name__, cls.__name__)
+            )
+        return metric
+
+    def counter(self, name):
+        """Return the counter with the given name, creating it if needed."""
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        """Return the gauge with the given name, creating it if needed."""
+        return self._get(name, Gauge)
+
+    def histogram(self, name):
+        """Return the histogram with the given name, creating it if needed."""
+        return self._get(name, Histogram)
+
+    def collect(self):
+        """Collect the per step values of all metrics.
+
+        Returns
+        -------
+        dict [str -> (str, object)]
+            Metric name to (metric type, collected value).
+            For counters the value is the increment since the last collection,
+            for gauges it is the current value,
+            and for histograms it is a StreamingHistogram
+            of the values observed since the last collection.
+        """
+        ret = {}
+        for name, metric in self.metrics.items():
+            ret[name] = (type(metric).__name__.lower(), metric.collect())
+        return ret
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name):
+    """Return the rank local counter with the given name."""
+    return REGISTRY.counter(name)
+
+
+def gauge(name):
+    """Return the rank local gauge with the given name."""
+    return REGISTRY.gauge(name)
+
+
+def histogram(name):
+    """Return the rank local histogram with the given name."""
+    return REGISTRY.histogram(name)
+
+
+def collect():
+    """Collect the per step values of the rank local metrics."""
+    return REGISTRY.collect()
+
+
+def openmetrics_name(name):
+    """Convert a metric name to a valid OpenMetrics metric name."""
+    name = re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+    if name[0].isdigit():
+        name = "_" + name
+    return name
+
+
+class MetricsAggregator:
+    """Metrics aggregator.
+
+    There is a single metrics aggregator actor on the master rank.
+
+    Receives
+    --------
+    * `report` from Runner(s)
+
+    Attributes
+    ----------
+    summary_writer_aid : str or None
+        The ID of the local summary writer actor
+    openmetrics_path : str or None
+        Path of the OpenMetrics text file to be written
+    pending : dict [float -> dict [int -> dict]]
+        Reported metrics for the incomplete steps
+    totals : dict [(str, int) -> (str, object)]
+        Cumulative values for every (metric name, rank)
+    """
+
+    def __init__(self, summary_writer_aid=None, openmetrics_path=None):
+        """Initialize.
+
+        Parameters
+        ----------
+        summary_writer_aid : str, optional
+            The ID of the local summary writer actor
+        openmetrics_path : str, optional
+            Path of the OpenMetrics text file to be written
+        """
+        self.summary_writer_aid = summary_writer_aid
+        self.openmetrics_path = openmetrics_path
+
+        self.pending = {}
+        self.totals = {}
+
+    def report(self, rank, step, values):
+        """Receive the per step metric values of a rank.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the reporter
+        step : float
+            The current step
+        values : dict [str -> (str, object)]
+            The collected metric values (see `MetricsRegistry.collect`)
+        """
+        step_values = self.pending.setdefault(step, {})
+        step_values[rank] = values
+        if len(step_values) < WORLD_SIZE:
+            return
+
+        del self.pending[step]
+        self._update_totals(step_values)
+        self._write_summary(step, step_values)
+        self._write_openmetrics()
+
+    def _update_totals(self, step_values):
+        """Update the cumulative metric values."""
+        for rank, values in step_values.items():
+            for name, (kind, value) in values.items():
+                key = (name, rank)
+                if key not in self.totals:
+                    if kind == "histogram":
+                        total = StreamingHistogram()
+                        total.merge(value)
+                        self.totals[key] = (kind, total)
+                    else:
+                        self.totals[key] = (kind, value)
+                elif kind == "counter":
+                    self.totals[key] = (kind, self.totals[key][1] + value)
+                elif kind == "gauge":
+                    self.totals[key] = (kind, value)
+                else:
+                    self.totals[key][1].merge(value)
+
+    def _write_summary(self, step, step_values):
+        """Write the step values to the summary writer.
+
+        Counters are summed over the ranks,
+        gauges are written per rank,
+        and histograms are merged over the ranks.
+        """
+        if self.summary_writer_aid is None:
+            return
+        summary_writer = asys.local_actor(self.summary_writer_aid)
+        if summary_writer is None:
+            return
+
+        counters = {}
+        histograms = {}
+        for rank, values in sorted(step_values.items()):
+            for name, (kind, value) in values.items():
+                if kind == "counter":
+                    counters[name] = counters.get(name, 0) + value
+                elif kind == "gauge":
+                    summary_writer.add_scalar(f"metrics/{name}/{rank}", value, step)
+                else:
+                    if name not in histograms:
+                        histograms[name] = StreamingHistogram()
+                    histograms[name].merge(value)
+
+        for name, value in counters.items():
+            summary_writer.add_scalar(f"metrics/{name}", value, step)
+        for name, hist in histograms.items():
+            hist.write_summary(summary_writer, f"metrics/{name}", step)
+
+    def _write_openmetrics(self):
+        """Rewrite the OpenMetrics file with the cumulative values."""
+        if self.openmetrics_path is None:
+            return
+
+        by_name = {}
+        for (name, rank), (kind, value) in sorted(self.totals.items()):
+            by_name.setdefault(name, []).append((rank, kind, value))
+
+        lines = []
+        for name, entries in by_name.items():
+            om_name = openmetrics_name(name)
+            kind = entries[0][1]
+            om_kind = "summary" if kind == "histogram" else kind
+            lines.append(f"# TYPE {om_name} {om_kind}")
+            for rank, kind, value in entries:
+                label = f'rank="{rank}"'
+                if kind == "counter":
+                    lines.append(f"{om_name}_total{{{label}}} {value}")
+                elif kind == "gauge":
+                    lines.append(f"{om_name}{{{label}}} {value}")
+                else:
+                    for q in (0.5, 0.9, 0.99):
+                        lines.append(
+                            f'{om_name}{{{label},quantile="{q}"}} {value.quantile(q)}'
+                        )
+                    lines.append(f"{om_name}_count{{{label}}} {len(value)}")
+                    lines.append(f"{om_name}_sum{{{label}}} {value.sum}")
+        lines.append("# EOF")
+
+        tmp_path = self.openmetrics_path + ".tmp"
+        with open(tmp_path, "w") as fobj:
+            fobj.write("\n".join(lines))
+            fobj.write("\n")
+        os.replace(tmp_path, self.openmetrics_path)
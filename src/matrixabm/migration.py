@@ -0,0 +1,132 @@
+"""Agent migration payloads.
+
+When agents are moved between runners,
+all agents moving from one runner to another
+are packed together into as few payloads as possible.
+
+The agents are pickled with pickle protocol 5,
+so that large buffers (e.g. the data of NumPy arrays in the agents' state)
+are kept out of band as separate buffers
+instead of being copied into the pickle stream.
+The pickle stream and the buffers are compressed with zlib
+if the payload is larger than a threshold.
+Payloads are split so that they stay below the maximum message size
+of the actor system.
+"""
+
+import zlib
+import pickle
+from dataclasses import dataclass
+
+from xactor.evars import get_max_message_size
+
+# Payloads larger than this (in bytes) are compressed
+COMPRESS_THRESHOLD = 64 * 1024
+
+# Compression level used by zlib
+COMPRESS_LEVEL = 1
+
+# Maximum size of a payload (in bytes)
+MAX_PAYLOAD_SIZE = get_max_message_size() // 2
+
+
+@dataclass
+class AgentPayload:
+    """A packed batch of migrating agents.
+
+    Attributes
+    ----------
+    data : bytes
+        The (possibly compressed) pickle stream
+    buffers : list of bytes
+        The (possibly compressed) out of band buffers
+    compressed : bool
+        True if the data and buffers are compressed
+    n_agents : int
+        Number of agents in the payload
+    """
+
+    data: bytes
+    buffers: list
+    compressed: bool
+    n_agents: int
+
+    def size(self):
+        """Return the size of the payload in bytes."""
+        return len(self.data) + sum(len(b) for b in self.buffers)
+
+
+def _pack(entries, compress_threshold):
+    """Pack the entries into a single payload."""
+    buffers = []
+    data = pickle.dumps(entries, protocol=5, buffer_callback=buffers.append)
+    buffers = [b.raw().tobytes() for b in buffers]
+
+    payload = AgentPayload(data, buffers, False, len(entries))
+    if compress_threshold is not None and payload.size() > compress_threshold:
+        data = zlib.compress(payload.data, COMPRESS_LEVEL)
+        buffers = [zlib.compress(b, COMPRESS_LEVEL) for b in payload.buffers]
+        compressed = AgentPayload(data, buffers, True, len(entries))
+        if compressed.size() < payload.size():
+            payload = compressed
+
+    return payload
+
+
+def pack_agents(
+    entries, compress_threshold=COMPRESS_THRESHOLD, max_payload_size=MAX_PAYLOAD_SIZE
+):
+    """Pack migrating agents into payloads.
+
+    Parameters
+    ----------
+    entries : list of tuples
+        The migrating agents along with their metadata
+        (e.g. tuples of handle, agent and wake time)
+    compress_threshold : int or None
+        Payloads larger than this (in bytes) are compressed;
+        None disables compression
+    max_payload_size : int
+        Maximum size of a payload (in bytes).
+        Larger payloads are split in half until they fit.
+        A payload with a single agent is never split.
+
+    Returns
+    -------
+    list of AgentPayload
+        The packed payloads
+    """
+    if not entries:
+        return []
+
+    payload = _pack(entries, compress_threshold)
+    if payload.size() <= max_payload_size or len(entries) == 1:
+        return [payload]
+
+    mid = len(entries) // 2
+    return pack_agents(
+        entries[:mid], compress_threshold, max_payload_size
+    ) + pack_agents(entries[mid:], compress_threshold, max_payload_size)
+
+
+def unpack_agents(payload):
+    """Unpack migrating agents from a payload.
+
+    Parameters
+    ----------
+    payload : AgentPayload
+        The packed payload
+
+    Returns
+    -------
+    list of tuples
+        The migrating agents along with their metadata
+    """
+    data, buffers = payload.data, payload.buffers
+    if payload.compressed:
+        data = zlib.decompress(data)
+        buffers = [zlib.decompress(b) for b in buffers]
+
+    # The unpickled objects (e.g. NumPy arrays) must be writable
+    buffers = [bytearray(b) for b in buffers]
+    return pickle.loads(data, buffers=buffers)
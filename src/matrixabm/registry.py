@@ -0,0 +1,142 @@
+"""Agent registry.
+
+Internally the Matrix refers to agents using integer handles
+instead of their (user facing) string IDs.
+Handles are assigned when the agents are created
+and are used as keys in the coordinator, runner and load balancer tables,
+and in all the messages exchanged between them.
+
+Handles are allocated from a striped sequence:
+offset, offset + stride, offset + 2 * stride, ...
+This allows every rank to allocate handles independently
+(using its rank as offset and the number of ranks as stride)
+without ever allocating the same handle twice.
+Handles are never reused.
+"""
+
+
+class AgentRegistry:
+    """Mapping between agent string IDs and integer handles.
+
+    Attributes
+    ----------
+    offset : int
+        The first handle allocated by this registry
+    stride : int
+        Difference between consecutively allocated handles
+    next_handle : int
+        The next handle to be allocated
+    id_handle : dict [str -> int]
+        Agent ID to handle mapping of the registered agents
+    handle_id : dict [int -> str]
+        Handle to agent ID mapping of the registered agents
+    """
+
+    def __init__(self, offset=0, stride=1):
+        """Initialize.
+
+        Parameters
+        ----------
+        offset : int
+            The first handle allocated by this registry
+        stride : int
+            Difference between consecutively allocated handles
+        """
+        self.offset = int(offset)
+        self.stride = int(stride)
+        self.next_handle = self.offset
+
+        self.id_handle = {}
+        self.handle_id = {}
+
+    def __len__(self):
+        return len(self.handle_id)
+
+    def __contains__(self, agent_id):
+        return agent_id in self.id_handle
+
+    def allocate(self):
+        """Allocate a new handle without registering an agent.
+
+        Returns
+        -------
+        int
+            The new handle
+        """
+        handle = self.next_handle
+        self.next_handle += self.stride
+        return handle
+
+    def register(self, agent_id, handle=None):
+        """Register an agent.
+
+        Parameters
+        ----------
+        agent_id : str
+            ID of the agent
+        handle : int, optional
+            Handle of the agent, if already allocated elsewhere.
+            If not given a new handle is allocated.
+
+        Returns
+        -------
+        int
+            Handle of the agent
+        """
+        if __debug__:
+            if agent_id in self.id_handle:
+                raise ValueError("Agent %s is already registered" % agent_id)
+
+        if handle is None:
+            handle = self.allocate()
+
+        self.id_handle[agent_id] = handle
+        self.handle_id[handle] = agent_id
+        return handle
+
+    def unregister(self, handle):
+        """Unregister an agent.
+
+        Parameters
+        ----------
+        handle : int
+            Handle of the agent
+
+        Returns
+        -------
+        str
+            ID of the agent
+        """
+        agent_id = self.handle_id.pop(handle)
+        del self.id_handle[agent_id]
+        return agent_id
+
+    def get_handle(self, agent_id):
+        """Return the handle of an agent.
+
+        Parameters
+        ----------
+        agent_id : str
+            ID of the agent
+
+        Returns
+        -------
+        int
+            Handle of the agent
+        """
+        return self.id_handle[agent_id]
+
+    def get_agent_id(self, handle):
+        """Return the ID of an agent.
+
+        Parameters
+        ----------
+        handle : int
+            Handle of the agent
+
+        Returns
+        -------
+        str
+            ID of the agent
+        """
+        return self.handle_id[handle]
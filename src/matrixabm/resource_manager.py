@@ -4,7 +4,11 @@ This module defines actors whose sole task is to
 manage a resouce and make them available to other actors.
 """
 
+import os
+import queue
 import sqlite3
+import threading
+from time import monotonic
 
 import xactor as asys
 from tensorboardX import SummaryWriter
@@ -13,11 +17,47 @@ from . import INFO_FINE
 
 LOG = asys.getLogger(__name__)
 
+# Maximum number of summaries waiting to be written
+MAX_SUMMARY_QUEUE_SIZE = 100000
+
+# Number of seconds between flushes of the summary writer
+SUMMARY_FLUSH_INTERVAL = 5.0
+
+# Marker used to stop the summary writer thread
+_STOP = object()
+
+# Number of seconds a sqlite3 connection waits for a locked database
+SQLITE3_BUSY_TIMEOUT = 60.0
+
+
+def _connect():
+    """Open a sqlite3 connection to which databases are to be attached."""
+    return sqlite3.connect(
+        ":memory:", timeout=SQLITE3_BUSY_TIMEOUT, check_same_thread=False
+    )
+
+
+def _attach(con, dbname, dsn):
+    """Attach a database to a connection in WAL mode."""
+    con.execute(f"attach database ? as {dbname}", (dsn,))
+    con.execute(f"pragma {dbname}.journal_mode = wal")
+
 
 class SQLite3Manager:
     """SQLtie3 manager.
 
     The SQLite3 manager manages sqlite3 connections.
+    The shared connection has all the databases attached.
+    Separate connections to single databases can also be opened,
+    e.g. to write to different databases concurrently.
+    The connections may be used from other threads,
+    though only by one thread at a time.
+
+    The databases are put in write ahead log (WAL) mode,
+    so that readers on one connection do not block a writer on another
+    (and vice versa);
+    a connection waiting for a lock held by another writer
+    retries for up to `SQLITE3_BUSY_TIMEOUT` seconds.
 
     Attributes
     ----------
@@ -26,7 +66,9 @@ class SQLite3Manager:
     dsns : list of str
         List of sqlite3 paths corresponding the database names
     connection : sqlite3.Connection
-        The sqlite3 connection object
+        The shared sqlite3 connection object
+    separate_connections : list of sqlite3.Connection
+        The separate connections opened so far
     """
 
     def __init__(self, dbnames, dsns):
@@ -36,13 +78,13 @@ class SQLite3Manager:
         self.dbnames = dbnames
         self.dsns = dsns
 
-        con = sqlite3.connect(":memory:")
+        con = _connect()
         for dbname, dsn in zip(self.dbnames, self.dsns):
             LOG.log(INFO_FINE, "Attaching '%s' to %s", dsn, dbname)
-            sql = f"attach database ? as {dbname}"
-            con.execute(sql, (dsn,))
+            _attach(con, dbname, dsn)
 
         self.connection = con
+        self.separate_connections = []
 
     def __del__(self):
         self.close()
@@ -55,6 +97,118 @@ class SQLite3Manager:
         LOG.log(INFO_FINE, "Closing sqlite3 connection; %r", self.dsns)
         self.connection.close()
         self.connection = None
+        for con in self.separate_connections:
+            con.close()
+        self.separate_connections = []
+
+    def open_connection(self, dbname):
+        """Open a separate connection to a single database.
+
+        The database is attached under the same name
+        as in the shared connection,
+        so the same SQL statements can be used with both connections.
+
+        Parameters
+        ----------
+        dbname : str
+            Name of the database
+
+        Returns
+        -------
+        sqlite3.Connection
+            The new connection
+        """
+        dsn = self.dsns[self.dbnames.index(dbname)]
+        LOG.log(INFO_FINE, "Opening separate connection to '%s' as %s", dsn, dbname)
+
+        con = _connect()
+        _attach(con, dbname, dsn)
+        self.separate_connections.append(con)
+        return con
+
+    def backup(self, dbname, path):
+        """Copy a database to a file using the SQLite3 backup API.
+
+        Parameters
+        ----------
+        dbname : str
+            Name of the database to copy
+        path : str
+            Path of the file where the copy is to be written;
+            any existing file is overwritten
+        """
+        LOG.log(INFO_FINE, "Backing up %s to '%s'", dbname, path)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        dst = sqlite3.connect(tmp_path)
+        try:
+            self.connection.backup(dst, name=dbname)
+        finally:
+            dst.close()
+        os.replace(tmp_path, path)
+
+    def restore(self, dbname, path):
+        """Replace the contents of a database with a copy made by `backup`.
+
+        Parameters
+        ----------
+        dbname : str
+            Name of the database to replace
+        path : str
+            Path of the copy
+        """
+        LOG.log(INFO_FINE, "Restoring %s from '%s'", dbname, path)
+        dsn = self.dsns[self.dbnames.index(dbname)]
+
+        src = sqlite3.connect(path)
+        dst = sqlite3.connect(dsn)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+
+
+def _write_summaries(summary_writer, summary_queue, flush_interval):
+    """Write out the queued summaries (runs in the background thread).
+
+    Parameters
+    ----------
+    summary_writer : tensorboardX.SummaryWriter
+        The underlying summary writer
+    summary_queue : queue.Queue
+        The queue of (method, args, kwargs) tuples
+    flush_interval : float
+        Number of seconds between flushes of the summary writer
+    """
+    next_flush_time = monotonic() + flush_interval
+    pending = False
+    while True:
+        timeout = max(next_flush_time - monotonic(), 0.0)
+        try:
+            item = summary_queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+
+        if item is _STOP:
+            summary_writer.flush()
+            return
+
+        if item is not None:
+            method, args, kwargs = item
+            try:
+                getattr(summary_writer, method)(*args, **kwargs)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Error writing summary %s%r", method, args[:1])
+            pending = True
+
+        if monotonic() >= next_flush_time:
+            if pending:
+                summary_writer.flush()
+                pending = False
+            next_flush_time = monotonic() + flush_interval
 
 
 class TensorboardWriter:
@@ -63,33 +217,99 @@ class TensorboardWriter:
     This actor is used to
     manage a tensorboard SummaryWriter object.
 
+    The summaries are not written by the caller.
+    Instead they are put in a bounded queue,
+    and written out by a background thread,
+    which also flushes the summary writer every `flush_interval` seconds.
+    Thus writing summaries never delays the simulation.
+    If the queue is full, new summaries are dropped
+    and counted in `num_dropped`.
+
     Attributes
     ----------
     summary_dir : str
         The summary directory
     summary_writer : tensorboardX.SummaryWriter
         The underlying summary writer
+    flush_interval : float
+        Number of seconds between flushes of the summary writer
+    queue : queue.Queue
+        The queue of summaries to be written
+    num_dropped : int
+        Number of summaries dropped because the queue was full
     """
 
-    def __init__(self, summary_dir):
+    def __init__(
+        self,
+        summary_dir,
+        max_queue_size=MAX_SUMMARY_QUEUE_SIZE,
+        flush_interval=SUMMARY_FLUSH_INTERVAL,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        summary_dir : str
+            The summary directory
+        max_queue_size : int
+            Maximum number of summaries waiting to be written
+        flush_interval : float
+            Number of seconds between flushes of the summary writer
+        """
         self.summary_dir = summary_dir
+        self.flush_interval = flush_interval
 
         LOG.log(INFO_FINE, "Creating tensorboard summary writer for '%s'", summary_dir)
         self.summary_writer = SummaryWriter(str(summary_dir))
 
-        self.add_scalar = self.summary_writer.add_scalar
-        self.add_histogram = self.summary_writer.add_histogram
-
-        self.flush = self.summary_writer.flush
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.num_dropped = 0
+        # NOTE: The thread must not hold a reference to self;
+        # otherwise __del__ would never be called.
+        self.thread = threading.Thread(
+            target=_write_summaries,
+            args=(self.summary_writer, self.queue, flush_interval),
+            daemon=True,
+        )
+        self.thread.start()
 
     def __del__(self):
         self.close()
 
+    def _put(self, method, args, kwargs):
+        """Queue a summary; drop it if the queue is full."""
+        try:
+            self.queue.put_nowait((method, args, kwargs))
+        except queue.Full:
+            self.num_dropped += 1
+            if self.num_dropped == 1:
+                LOG.warning("Summary queue is full; dropping summaries")
+
+    def add_scalar(self, *args, **kwargs):
+        """Queue a scalar summary (see SummaryWriter.add_scalar)."""
+        self._put("add_scalar", args, kwargs)
+
+    def add_histogram(self, *args, **kwargs):
+        """Queue a histogram summary (see SummaryWriter.add_histogram)."""
+        self._put("add_histogram", args, kwargs)
+
+    def add_histogram_raw(self, *args, **kwargs):
+        """Queue a raw histogram summary (see SummaryWriter.add_histogram_raw)."""
+        self._put("add_histogram_raw", args, kwargs)
+
+    def flush(self):
+        """Do nothing; the background thread flushes periodically."""
+
     def close(self):
-        """Close the summary writer."""
+        """Write out the queued summaries and close the summary writer."""
         if self.summary_writer is None:
             return
 
         LOG.log(INFO_FINE, "Closing summary writer; %r", self.summary_dir)
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.num_dropped:
+            LOG.warning("Dropped %d summaries", self.num_dropped)
+
         self.summary_writer.close()
         self.summary_writer = None
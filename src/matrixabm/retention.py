@@ -0,0 +1,205 @@
+"""History retention of append only state tables.
+
+Tables with one row per agent per step
+(e.g. the history of the agents' states)
+grow without bound over a long simulation,
+which slows down both the inserts of the flushes
+(index maintenance) and the reads.
+
+A retention policy keeps only the rows of the last few steps
+in the (hot) table.
+Older rows are retired from the table when the store is compacted;
+before they are deleted, they may be
+
+* rolled up into per step aggregates in a summary table
+  (named ``<table>_summary``) in the same database, and/or
+* copied into a table of the same name in an archive database file.
+
+A store starts compacting its tables right after
+it has reported its flush to the simulator.
+The compaction runs in a background thread of the store,
+on a separate connection to the store's database,
+while the runners are stepping the agents.
+Before its next flush (or checkpoint),
+the store waits for the compaction to finish;
+only the time spent waiting is on the critical path of the step
+(reported as ``store_compaction_wait_time``).
+If the compaction often takes longer than a step,
+`compact_every` can be used to compact less often.
+The store's database is in WAL mode (see `matrixabm.resource_manager`),
+so agents reading the table are not blocked by a running compaction.
+The archive database is not part of the checkpoints.
+"""
+
+import xactor as asys
+
+from . import INFO_FINE
+
+LOG = asys.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """Retention policy of an append only SQLite3 table.
+
+    Attributes
+    ----------
+    table : str
+        Name of the table
+    step_column : str
+        Name of the column with the step (or time) of the rows
+    keep_steps : int
+        Number of most recent steps whose rows are kept in the table
+    archive_path : str or None
+        Path of the archive database file
+    group_by : list of str
+        Columns by which the retired rows are aggregated (besides the step)
+    aggregates : dict [str -> str]
+        Summary column name to aggregate expression (e.g. "count(*)")
+    compact_every : int
+        Compact the table once every this many flushes
+    """
+
+    def __init__(
+        self,
+        table,
+        step_column,
+        keep_steps,
+        archive_path=None,
+        group_by=(),
+        aggregates=None,
+        compact_every=1,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        table : str
+            Name of the table
+        step_column : str
+            Name of the column with the step (or time) of the rows
+        keep_steps : int
+            Number of most recent steps whose rows are kept in the table
+        archive_path : str, optional
+            If given, the retired rows are copied to this database file
+        group_by : list of str
+            Columns by which the retired rows are aggregated (besides the step)
+        aggregates : dict [str -> str], optional
+            If given, the retired rows are rolled up into
+            these aggregates (summary column name to aggregate expression)
+        compact_every : int
+            Compact the table once every this many flushes
+        """
+        self.table = table
+        self.step_column = step_column
+        self.keep_steps = int(keep_steps)
+        self.archive_path = archive_path
+        self.group_by = list(group_by)
+        self.aggregates = dict(aggregates) if aggregates else {}
+        self.compact_every = int(compact_every)
+
+        self.num_flushes = 0
+        self.dbname = None
+        self.archive_dbname = None
+
+    def _setup(self, con, dbname):
+        """Create the index, summary and archive tables if needed."""
+        table, step = self.table, self.step_column
+        self.dbname = dbname
+
+        con.execute(
+            f"create index if not exists {dbname}.{table}_{step}_idx "
+            f"on {table} ({step})"
+        )
+
+        if self.aggregates:
+            sql = f"""
+                create table if not exists {dbname}.{table}_summary as
+                select {self._summary_columns()}
+                from {dbname}.{table}
+                where 0
+                """
+            con.execute(sql)
+
+        if self.archive_path is not None:
+            self.archive_dbname = f"{dbname}_{table}_archive"
+            LOG.log(
+                INFO_FINE,
+                "Attaching archive '%s' to %s",
+                self.archive_path,
+                self.archive_dbname,
+            )
+            sql = f"attach database ? as {self.archive_dbname}"
+            con.execute(sql, (self.archive_path,))
+            sql = f"""
+                create table if not exists {self.archive_dbname}.{table} as
+                select * from {dbname}.{table} where 0
+                """
+            con.execute(sql)
+
+    def _summary_columns(self):
+        """Return the select list of the summary table."""
+        columns = [self.step_column] + self.group_by
+        columns.extend(f"{expr} as {name}" for name, expr in self.aggregates.items())
+        return ", ".join(columns)
+
+    def compact(self, con, dbname):
+        """Retire the rows older than the last `keep_steps` steps (if due).
+
+        Parameters
+        ----------
+        con : sqlite3.Connection
+            Connection with the database attached
+        dbname : str
+            Name of the database with the table
+
+        Returns
+        -------
+        int
+            Number of rows retired
+        """
+        self.num_flushes += 1
+        if self.num_flushes % self.compact_every:
+            return 0
+
+        if self.dbname is None:
+            self._setup(con, dbname)
+
+        table, step = self.table, self.step_column
+
+        # The latest step to be retired
+        sql = f"""
+            select distinct {step}
+            from {dbname}.{table}
+            order by {step} desc
+            limit 1 offset ?
+            """
+        row = con.execute(sql, (self.keep_steps,)).fetchone()
+        if row is None:
+            return 0
+        cutoff = row[0]
+
+        with con:
+            if self.aggregates:
+                group_by = ", ".join([step] + self.group_by)
+                sql = f"""
+                    insert into {dbname}.{table}_summary
+                    select {self._summary_columns()}
+                    from {dbname}.{table}
+                    where {step} <= ?
+                    group by {group_by}
+                    """
+                con.execute(sql, (cutoff,))
+
+            if self.archive_dbname is not None:
+                sql = f"""
+                    insert into {self.archive_dbname}.{table}
+                    select * from {dbname}.{table}
+                    where {step} <= ?
+                    """
+                con.execute(sql, (cutoff,))
+
+            sql = f"delete from {dbname}.{table} where {step} <= ?"
+            n_rows = con.execute(sql, (cutoff,)).rowcount
+
+        return n_rows
+
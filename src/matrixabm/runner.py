@@ -1,13 +1,33 @@
 """Agent runner."""
 
+import os
+import pickle
 from time import perf_counter
+from collections import defaultdict, deque
 
+from sortedcontainers import SortedList
 import xactor as asys
 
-from . import INFO_FINE, WORLD_SIZE
+from . import INFO_FINE
+from . import tracing
+from . import metrics
+from . import memory
+from . import checkpoint
+from .migration import pack_agents, unpack_agents
+from .hibernation import HibernationStore
 
 LOG = asys.getLogger(__name__)
 
+# Maximum number of (combined) updates sent to a store in one message
+UPDATE_BATCH_SIZE = 1000
+
+# Maximum number of interaction keys sent to the coordinator in one message
+INTERACTION_KEYS_CHUNK_SIZE = 10000
+
+# Bounds of the factor correcting the measured memory usage of the agents
+MIN_MEMORY_SCALE = 0.5
+MAX_MEMORY_SCALE = 10.0
+
 
 class Runner:
     """Agent runner.
@@ -18,25 +38,115 @@ class Runner:
     It also sends the step profile info back to the coordinator.
     There is one runner actor per process/rank.
 
+    Agents are referred to by their integer handles
+    assigned by the coordinator (or the distributed populations).
+
+    Agents are only stepped in timesteps in which they are due.
+    Agents whose `next_wake_time` is None are due every timestep;
+    the others are kept in a calendar sorted by their wake time
+    and are due in the timestep whose end is after their wake time.
+
+    If memory measurement is enabled,
+    the memory usage of the agents is estimated with `memory.deep_sizeof`,
+    which misses e.g. the allocator overhead.
+    At the end of every step, the runner compares the measured sizes
+    of its resident agents with the memory its process has gained
+    since the runner was created
+    (the resident set size, or the memory traced by tracemalloc),
+    and scales the memory usage reported for the agents accordingly.
+
+    If hibernation is enabled, sleeping agents that are idle
+    (or haven't produced any updates in a number of steps)
+    are moved out of memory into a node local on disk store,
+    and are faulted back in when they are next due (or moved).
+    Hibernated agents are reported to the coordinator
+    as using no memory.
+
+    If work stealing is enabled, the due agents are stepped in chunks.
+    A runner that has stepped all its chunks asks the other runners
+    on the same node, one at a time, for some of their pending chunks,
+    before finishing the step.
+    Stolen agents become local agents of the stealing runner,
+    which reports the ownership transfer to the coordinator.
+
+    Updates of combinable store methods (see `matrixabm.combiner`)
+    are combined per key over the whole step,
+    and are sent to the stores in batches at the end of the step.
+
+    If update batching is enabled, the other updates are also
+    sent to the stores in batches instead of one by one.
+    This is required by stores using tree fan-out
+    (see `matrixabm.state_store`),
+    in which case every runner is given a proxy
+    only to the store replica on its own node;
+    such stores reject runners sending their updates one by one.
+
+    If interaction observation is enabled,
+    the runner collects the interaction keys of the stepped agents,
+    and reports the agents of every key to the coordinator
+    at the end of the step (for graph aware load balancing).
+    The interaction key of an update is made of its key arguments:
+    the combiner key of combinable methods,
+    otherwise the first positional argument
+    (e.g. the ID of the agent or cell whose state is updated);
+    agents updating the same key interact with each other.
+    Agents may report their own keys instead
+    (see `Agent.interaction_keys`).
+
     Receives
     --------
     * `step` from Simulator
     * `create_agent*` from Coordinator
+    * `create_agent_bulk*` from Coordinator
     * `create_agent_done` from Coordinator
     * `move_agent*` from Coordinator
     * `move_agent_done` from Coordinator
-    * `receive_agent*` from Runner(s)
-    * `receive_agent_done` from Runner(s)
+    * `receive_agents` from Runner(s)
+    * `continue_step` from self (with work stealing)
+    * `steal_request` from Runner(s) (with work stealing)
+    * `receive_stolen_agents*` from Runner(s) (with work stealing)
+    * `checkpoint` from Simulator
+    * `restore` from Simulator
+    * `finish` from Simulator
 
     Sends
     -----
+    * `receive_agents` to Runner(s)
+    * `continue_step` to self (with work stealing)
+    * `steal_request` to Runner(s) (with work stealing)
+    * `receive_stolen_agents*` to Runner(s) (with work stealing)
+    * `agents_stolen` to Coordinator (with work stealing)
     * `handle_update*` to StateStore(s)
+    * `handle_update_batch*` to StateStore(s) (with update batching)
+    * `handle_combined_updates*` to StateStore(s)
     * `handle_update_done` to StateStore(s)
-    * `agent_step_profile` to Coordinator
+    * `agent_step_profile*` to Coordinator
+    * `agent_step_profile_chunk*` to Coordinator
+    * `agent_interaction_keys*` to Coordinator (with interaction observation)
     * `agent_step_profile_done` to Coordinator
+    * `schedule*` to EventCalendar (optional)
+    * `report` to MetricsAggregator (optional)
+    * `checkpoint_done` to Coordinator
+    * `finish_done` to Coordinator
     """
 
-    def __init__(self, store_proxies, coordinator_aid, runner_aid):
+    def __init__(
+        self,
+        store_proxies,
+        coordinator_aid,
+        runner_aid,
+        calendar_aid=None,
+        metrics_aid=None,
+        profile_every=1,
+        measure_memory_every=None,
+        hibernate_dir=None,
+        hibernate_after=None,
+        steal_chunk_size=None,
+        combiners=None,
+        batch_updates=False,
+        observe_interactions=False,
+        trace_memory=False,
+    ):
         """Initialize the runner.
 
         Parameters
@@ -47,17 +157,186 @@ class Runner:
             ID of the coordinator actor
         runner_aid : str
             ID of the runner actors
+        calendar_aid : str, optional
+            ID of the event calendar actor (on the master rank)
+            to which the next activity times of the agents are reported
+        metrics_aid : str, optional
+            ID of the metrics aggregator actor (on the master rank)
+            to which the rank's metrics are reported at the end of every step
+        profile_every : int
+            Profile every agent individually once every this many steps.
+            In the other steps, the agents are stepped class by class,
+            and are charged the mean step time of their class.
+            New and migrated agents are always profiled individually.
+        measure_memory_every : int, optional
+            If given, the memory usage of the agents is measured
+            (using `memory.deep_sizeof`) instead of self reported.
+            Every agent is measured once every this many steps,
+            and the last measurement is used in between.
+            The rank's resident set size is also reported to the coordinator.
+        hibernate_dir : str, optional
+            If given, sleeping agents may be hibernated
+            into a store in this (node local) directory.
+            Agents are hibernated if they are idle (see `Agent.is_idle`).
+        hibernate_after : int, optional
+            If given (and hibernation is enabled),
+            sleeping agents that haven't produced any updates
+            in this many of their steps are also hibernated.
+        steal_chunk_size : int, optional
+            If given, work stealing is enabled,
+            and the due agents are stepped (and stolen)
+            in chunks of this many agents.
+        combiners : dict [str -> dict [str -> Combiner]], optional
+            Combiners of the combinable methods of every store
+            (see `matrixabm.combiner.get_combiners`)
+        batch_updates : bool
+            If True, the updates are sent to the stores
+            in batches of up to `UPDATE_BATCH_SIZE` updates
+        observe_interactions : bool
+            If True, the interaction keys of the stepped agents
+            are reported to the coordinator
+        trace_memory : bool
+            If True (with memory measurement), tracemalloc is started
+            and the memory traced by it is used
+            instead of the resident set size
+            to correct the measured memory usage of the agents
         """
+        tracing.start_tracing_from_env()
+
         self.local_agents = {}
         self.store_proxies = store_proxies
         self.coordinator_proxy = asys.ActorProxy(asys.MASTER_RANK, coordinator_aid)
-        self.every_runner_proxy = asys.ActorProxy(asys.EVERY_RANK, runner_aid)
         self.runner_proxies = [asys.ActorProxy(rank, runner_aid) for rank in asys.ranks()]
+        if calendar_aid is None:
+            self.calendar_proxy = None
+        else:
+            self.calendar_proxy = asys.ActorProxy(asys.MASTER_RANK, calendar_aid)
+        if metrics_aid is None:
+            self.metrics_proxy = None
+        else:
+            self.metrics_proxy = asys.ActorProxy(asys.MASTER_RANK, metrics_aid)
+
+        self.metric_agents_stepped = metrics.counter("runner_agents_stepped")
+        self.metric_agents_died = metrics.counter("runner_agents_died")
+        self.metric_updates_sent = metrics.counter("runner_updates_sent")
+        self.metric_agents_sent = metrics.counter("runner_agents_sent")
+        self.metric_agents_received = metrics.counter("runner_agents_received")
+        self.metric_migrated_bytes = metrics.counter("runner_migrated_bytes")
+        self.metric_migration_time = metrics.counter("runner_migration_time")
+        self.metric_local_agents = metrics.gauge("runner_local_agents")
+        self.metric_rss = metrics.gauge("runner_rss_bytes")
+        self.metric_traced = metrics.gauge("runner_traced_bytes")
+        self.metric_memory_scale = metrics.gauge("runner_memory_scale")
+        self.metric_memory_measure_time = metrics.counter(
+            "runner_memory_measure_time"
+        )
+        self.metric_hibernated_agents = metrics.gauge("runner_hibernated_agents")
+        self.metric_agents_hibernated = metrics.counter("runner_agents_hibernated")
+        self.metric_agents_faulted = metrics.counter("runner_agents_faulted")
+        self.metric_hibernated_bytes = metrics.counter("runner_hibernated_bytes")
+        self.metric_hibernation_time = metrics.counter("runner_hibernation_time")
+        self.metric_steal_requests = metrics.counter("runner_steal_requests")
+        self.metric_agents_stolen = metrics.counter("runner_agents_stolen")
+        self.metric_agents_given = metrics.counter("runner_agents_given")
+        self.metric_updates_combined = metrics.counter("runner_updates_combined")
+        self.metric_update_batches = metrics.counter("runner_update_batches_sent")
+
+        # Agents due every timestep (the dict is used as an ordered set)
+        self.awake_agents = {}
+        # Sleeping agents as sorted (wake_time, handle) tuples
+        self.sleep_calendar = SortedList()
+        self.agent_wake_time = {}
+
+        # Profiling state
+        self.profile_every = int(profile_every)
+        if measure_memory_every is None:
+            self.measure_memory_every = None
+        else:
+            self.measure_memory_every = int(measure_memory_every)
+        self.num_steps = 0
+        # Number of steps before the current step;
+        # the profiling and memory measurement schedules are based on it
+        self.step_phase = 0
+        # Last measured memory usage of the local agents
+        self.agent_memory_usage = {}
+        # Agents not yet profiled on this rank
+        self.new_agents = set()
+        # Factor correcting the measured memory usage of the agents
+        self.memory_scale = 1.0
+        self.trace_memory = bool(trace_memory)
+        self.base_process_memory = None
+        if self.measure_memory_every is not None:
+            if self.trace_memory:
+                memory.start_tracing()
+            self.base_process_memory = self._process_memory()
+
+        # Hibernation state
+        if hibernate_dir is None:
+            self.hibernation = None
+        else:
+            path = os.path.join(
+                hibernate_dir, "hibernate-%d.sqlite3" % asys.current_rank()
+            )
+            self.hibernation = HibernationStore(path)
+        if hibernate_after is None:
+            self.hibernate_after = None
+        else:
+            self.hibernate_after = int(hibernate_after)
+        # Number of consecutive steps in which the agents produced no updates
+        self.agent_quiet_steps = {}
+
+        # Combiner of every combinable (store name, method)
+        self.update_combiner = {}
+        if combiners is not None:
+            for store_name, store_combiners in combiners.items():
+                for method, combiner in store_combiners.items():
+                    self.update_combiner[store_name, method] = combiner
+        # Combined updates of the current step keyed by (store, method, key)
+        self.combined_updates = {}
+        # Updates not yet sent keyed by store (with update batching)
+        self.batch_updates = bool(batch_updates)
+        self.update_batches = defaultdict(list)
+        self.observe_interactions = bool(observe_interactions)
+
+        # Work stealing state
+        if steal_chunk_size is None:
+            self.steal_chunk_size = None
+        else:
+            self.steal_chunk_size = int(steal_chunk_size)
+        self.node_runner_ranks = []
+        if self.steal_chunk_size is not None:
+            rank = asys.current_rank()
+            for node in asys.nodes():
+                node_ranks = list(asys.node_ranks(node))
+                if rank in node_ranks:
+                    # Start with the next rank on the node
+                    i = node_ranks.index(rank)
+                    self.node_runner_ranks = node_ranks[i + 1 :] + node_ranks[:i]
+        # Runners on the node not yet asked for agents in this step
+        self.steal_victims = []
+        # Chunks of due agents not yet stepped as (profiled, handles) tuples
+        self.pending_chunks = deque()
+        # Stolen agents received so far from the current victim
+        self.stolen_entries = []
+
+        # Per step accumulators
+        self.step_dead_agents = []
+        self.step_sleeping_agents = []
+        self.step_hibernating_agents = []
+        self.step_n_agents_stepped = 0
+        self.step_n_updates_sent = 0
+        # Handles of the profiled agents keyed by their interaction keys
+        self.step_interaction_keys = defaultdict(list)
+
+        # Agents to be sent to other ranks as (handle, agent, wake_time) tuples
+        self.outgoing_agents = defaultdict(list)
 
         # Step variables
         self.timestep = None
+        self.step_received_time = None
         self.flag_create_agent_done = None
         self.flag_move_agents_done = None
+        self.num_move_sources = None
         self.num_receive_agent_done = None
 
         self._prepare_for_next_step()
@@ -67,20 +346,22 @@ class Runner:
         LOG.log(INFO_FINE, "Preparing for next step")
 
         self.timestep = None
+        self.step_received_time = None
         self.flag_create_agent_done = False
         self.flag_move_agents_done = False
+        self.num_move_sources = None
         self.num_receive_agent_done = 0
 
     def _try_start_step(self):
         """Step through the local agents to produce updates."""
         LOG.log(
             INFO_FINE,
-            "Can start step? (TS=%s,CAD=%s,MAD=%s,NRAD=%d/%d)",
+            "Can start step? (TS=%s,CAD=%s,MAD=%s,NRAD=%d/%s)",
             bool(self.timestep),
             self.flag_create_agent_done,
             self.flag_move_agents_done,
             self.num_receive_agent_done,
-            WORLD_SIZE,
+            self.num_move_sources,
         )
         if self.timestep is None:
             return
@@ -88,56 +369,657 @@ class Runner:
             return
         if not self.flag_move_agents_done:
             return
-        if self.num_receive_agent_done < WORLD_SIZE:
+        if self.num_receive_agent_done < self.num_move_sources:
             return
 
-        self.do_step()
-        self._prepare_for_next_step()
+        tracing.complete(
+            "wait_for_agents", self.step_received_time, perf_counter(), cat="runner"
+        )
+        with tracing.span("do_step", cat="runner", n_agents=len(self.local_agents)):
+            self.do_step()
+
+    def _schedule_agent(self, handle, wake_time):
+        """Put the agent in the awake set or the sleep calendar.
+
+        Parameters
+        ----------
+        handle : int
+            Handle of the local agent
+        wake_time : float or None
+            The next wake time of the agent
+        """
+        if wake_time is None:
+            self.awake_agents[handle] = None
+        else:
+            self.sleep_calendar.add((wake_time, handle))
+            self.agent_wake_time[handle] = wake_time
+
+    def _unschedule_agent(self, handle):
+        """Remove the agent from the awake set and the sleep calendar.
+
+        Parameters
+        ----------
+        handle : int
+            Handle of the local agent
+
+        Returns
+        -------
+        float or None
+            The next wake time of the agent
+        """
+        if handle in self.awake_agents:
+            del self.awake_agents[handle]
+            return None
+
+        wake_time = self.agent_wake_time.pop(handle)
+        self.sleep_calendar.remove((wake_time, handle))
+        return wake_time
+
+    def _pop_due_agents(self):
+        """Remove and return the agents due in the current timestep.
+
+        Returns
+        -------
+        list of int
+            Handles of the due agents
+        """
+        due_agents = list(self.awake_agents)
+        self.awake_agents.clear()
+
+        end = self.timestep.end
+        calendar = self.sleep_calendar
+        n_awake = len(due_agents)
+        while calendar and calendar[0][0] < end:
+            _, handle = calendar.pop(0)
+            del self.agent_wake_time[handle]
+            due_agents.append(handle)
+
+        if self.hibernation is not None and self.hibernation.handles:
+            hibernated = self.hibernation.handles
+            self._fault_in([h for h in due_agents[n_awake:] if h in hibernated])
+
+        return due_agents
+
+    def _should_hibernate(self, handle, agent, n_updates, wake_time):
+        """Check if a stepped (living) agent should be hibernated.
+
+        Parameters
+        ----------
+        handle : int
+            Handle of the local agent
+        agent : Agent
+            The agent
+        n_updates : int
+            Number of updates produced by the agent in this step
+        wake_time : float or None
+            The next wake time of the agent
+
+        Returns
+        -------
+        bool
+            True if the agent should be hibernated
+        """
+        if self.hibernation is None:
+            return False
+
+        if n_updates:
+            quiet_steps = self.agent_quiet_steps.pop(handle, 0)
+        else:
+            quiet_steps = self.agent_quiet_steps.get(handle, 0) + 1
+            self.agent_quiet_steps[handle] = quiet_steps
+
+        if wake_time is None:
+            return False
+        if agent.is_idle():
+            return True
+        return self.hibernate_after is not None and quiet_steps >= self.hibernate_after
+
+    def _hibernate(self, handles):
+        """Move the agents out of memory into the hibernation store."""
+        if not handles:
+            return
+
+        with tracing.span("hibernate_agents", cat="runner", n_agents=len(handles)):
+            start_time = perf_counter()
+            agents = [(handle, self.local_agents.pop(handle)) for handle in handles]
+            n_bytes = self.hibernation.put_many(agents)
+            self.metric_hibernation_time.inc(perf_counter() - start_time)
+        self.metric_agents_hibernated.inc(len(handles))
+        self.metric_hibernated_bytes.inc(n_bytes)
+
+    def _fault_in(self, handles):
+        """Move the agents from the hibernation store back into memory.
+
+        The faulted in agents are profiled individually in their next step,
+        so that their memory usage is reported to the coordinator again.
+        """
+        if not handles:
+            return
+
+        with tracing.span("fault_in_agents", cat="runner", n_agents=len(handles)):
+            start_time = perf_counter()
+            for handle, agent in self.hibernation.take_many(handles):
+                self.local_agents[handle] = agent
+                self.new_agents.add(handle)
+            self.metric_hibernation_time.inc(perf_counter() - start_time)
+        self.metric_agents_faulted.inc(len(handles))
+
+    def _split_profiled_agents(self, due_agents):
+        """Split the due agents into individually profiled and the rest.
+
+        Parameters
+        ----------
+        due_agents : list of int
+            Handles of the due agents
+
+        Returns
+        -------
+        profiled : list of int
+            Handles of the agents to be profiled individually
+        unprofiled : dict [type -> list of int]
+            Handles of the other agents grouped by their class
+        """
+        k = self.profile_every
+        if k == 1:
+            return due_agents, {}
+
+        phase = self.step_phase % k
+        profiled = []
+        unprofiled = defaultdict(list)
+        for handle in due_agents:
+            if handle in self.new_agents or (handle + phase) % k == 0:
+                profiled.append(handle)
+            else:
+                unprofiled[type(self.local_agents[handle])].append(handle)
+        return profiled, unprofiled
+
+    def _agent_memory_usage(self, handle, agent):
+        """Return the memory usage of an agent.
+
+        If memory measurement is enabled, the agent is measured
+        if it hasn't been measured yet or is due for a measurement;
+        otherwise the last measurement is returned.
+        Otherwise the agent's self reported memory usage is returned.
+        """
+        k = self.measure_memory_every
+        if k is None:
+            return agent.memory_usage()
+
+        if handle in self.agent_memory_usage and (handle + self.step_phase) % k:
+            return self.agent_memory_usage[handle]
+
+        start_time = perf_counter()
+        memory_usage = memory.deep_sizeof(agent)
+        self.metric_memory_measure_time.inc(perf_counter() - start_time)
+        return memory_usage
+
+    def _process_memory(self):
+        """Return the memory used by the process (traced or resident)."""
+        if self.trace_memory:
+            return memory.traced_bytes()
+        return memory.rss_bytes()
+
+    def _update_memory_scale(self, process_memory):
+        """Update the factor correcting the measured memory usage of the agents.
+
+        The factor is chosen so that the corrected sizes of the resident agents
+        add up to the memory the process has gained since the runner was created.
+        """
+        used = process_memory - self.base_process_memory
+        measured = sum(self.agent_memory_usage.get(h, 0.0) for h in self.local_agents)
+        if used <= 0 or measured <= 0:
+            return
+
+        scale = used / measured
+        self.memory_scale = min(max(scale, MIN_MEMORY_SCALE), MAX_MEMORY_SCALE)
+
+    def _send_updates(self, updates):
+        """Send the updates to the stores, or combine or batch them."""
+        if not self.update_combiner and not self.batch_updates:
+            for update in updates:
+                store = self.store_proxies[update.store_name]
+                store.handle_update(update, buffer_=True)
+            return
+
+        for update in updates:
+            store_name = update.store_name
+            combiner = self.update_combiner.get((store_name, update.method))
+            if combiner is None:
+                if self.batch_updates:
+                    batch = self.update_batches[store_name]
+                    batch.append(update)
+                    if len(batch) >= UPDATE_BATCH_SIZE:
+                        self._send_update_batch(store_name)
+                else:
+                    store = self.store_proxies[store_name]
+                    store.handle_update(update, buffer_=True)
+                continue
+
+            key = (store_name, update.method, combiner.key(update))
+            prev = self.combined_updates.get(key)
+            if prev is None:
+                self.combined_updates[key] = update
+            else:
+                self.combined_updates[key] = combiner.combine(prev, update)
+                self.metric_updates_combined.inc()
+
+    def _interaction_key(self, update):
+        """Return the interaction key of an update."""
+        combiner = self.update_combiner.get((update.store_name, update.method))
+        if combiner is None:
+            key = update.args[:1]
+        else:
+            key = tuple(combiner.key(update))
+        return key[0] if len(key) == 1 else key
+
+    def _observe_interactions(self, handle, agent, updates):
+        """Record the interaction keys of a stepped agent."""
+        keys = agent.interaction_keys()
+        if keys is None:
+            keys = [self._interaction_key(update) for update in updates]
+        for key in set(keys):
+            self.step_interaction_keys[key].append(handle)
+
+    def _send_update_batch(self, store_name):
+        """Send the batched updates of a store."""
+        batch = self.update_batches.pop(store_name)
+        self.store_proxies[store_name].handle_update_batch(batch, buffer_=True)
+        self.metric_update_batches.inc()
+
+    def _send_combined_updates(self):
+        """Send the combined updates of the step to the stores in batches."""
+        store_updates = defaultdict(list)
+        for (store_name, _, _), update in self.combined_updates.items():
+            store_updates[store_name].append(update)
+        self.combined_updates.clear()
+
+        rank = asys.current_rank()
+        for store_name, updates in store_updates.items():
+            store = self.store_proxies[store_name]
+            for i in range(0, len(updates), UPDATE_BATCH_SIZE):
+                chunk = updates[i : i + UPDATE_BATCH_SIZE]
+                store.handle_combined_updates(rank, chunk, buffer_=True)
+
+    def _send_interaction_keys(self):
+        """Send the agents of every interaction key to the coordinator."""
+        rank = asys.current_rank()
+        items = list(self.step_interaction_keys.items())
+        for i in range(0, len(items), INTERACTION_KEYS_CHUNK_SIZE):
+            chunk = dict(items[i : i + INTERACTION_KEYS_CHUNK_SIZE])
+            self.coordinator_proxy.agent_interaction_keys(rank, chunk, buffer_=True)
 
     def do_step(self):
-        """Do the actual stepping through over local agents to produce updates."""
-        dead_agents = []
+        """Do the actual stepping through over local agents to produce updates.
+
+        Without work stealing, all the due agents are stepped at once.
+        With work stealing, the due agents are stepped chunk by chunk,
+        so that steal requests from other runners
+        can be served in between the chunks.
+        """
+        self._start_step()
+        if self.steal_chunk_size is None:
+            while self.pending_chunks:
+                self._step_chunk(*self.pending_chunks.popleft())
+            self._finish_step()
+        else:
+            self._continue_step()
+
+    def _start_step(self):
+        """Split the due agents into chunks to be stepped."""
+        self.step_dead_agents = []
+        self.step_sleeping_agents = []
+        self.step_hibernating_agents = []
+        self.step_n_agents_stepped = 0
+        self.step_n_updates_sent = 0
+        self.steal_victims = list(self.node_runner_ranks)
+
+        self.step_phase = self.num_steps
+        self.num_steps += 1
+        profiled, unprofiled = self._split_profiled_agents(self._pop_due_agents())
+
+        self.pending_chunks.clear()
+        self._add_chunks(True, profiled)
+        for handles in unprofiled.values():
+            self._add_chunks(False, handles)
+
+    def _add_chunks(self, profiled, handles):
+        """Add the agents to the pending chunks.
+
+        Parameters
+        ----------
+        profiled : bool
+            True if the agents are to be profiled individually
+        handles : list of int
+            Handles of the agents;
+            if not profiled individually the agents must be of the same class
+        """
+        if not handles:
+            return
+
+        k = self.steal_chunk_size
+        if k is None:
+            self.pending_chunks.append((profiled, handles))
+            return
+
+        for i in range(0, len(handles), k):
+            self.pending_chunks.append((profiled, handles[i : i + k]))
 
-        # Step through the agents
-        for agent_id, agent in self.local_agents.items():
+    def _step_chunk(self, profiled, handles):
+        """Step through a chunk of agents."""
+        if profiled:
+            with tracing.span("step_agents", cat="runner", n_profiled=len(handles)):
+                self._step_profiled_agents(handles)
+        else:
+            cls = type(self.local_agents[handles[0]])
+            with tracing.span("step_agent_chunk", cat="runner", cls=cls.__name__):
+                self._step_unprofiled_agents(handles)
+
+    def _step_profiled_agents(self, handles):
+        """Step through the agents, profiling every agent individually."""
+        rank = asys.current_rank()
+        for handle in handles:
+            agent = self.local_agents[handle]
             start_time = perf_counter()
 
             # Step through the agent
             updates = agent.step(self.timestep)
-            memory_usage = agent.memory_usage()
             is_alive = agent.is_alive()
-            if not is_alive:
-                dead_agents.append(agent_id)
+            if is_alive:
+                wake_time = agent.next_wake_time()
+                self._schedule_agent(handle, wake_time)
+                if wake_time is not None:
+                    self.step_sleeping_agents.append(wake_time)
+            else:
+                wake_time = None
+                self.step_dead_agents.append(handle)
 
             # Send out the updates
-            for update in updates:
-                store_name = update.store_name
-                store = self.store_proxies[store_name]
-                store.handle_update(update, buffer_=True)
+            self._send_updates(updates)
             end_time = perf_counter()
+            if self.observe_interactions:
+                self._observe_interactions(handle, agent, updates)
+            memory_usage = self._agent_memory_usage(handle, agent)
+            self.step_n_agents_stepped += 1
+            self.step_n_updates_sent += len(updates)
+
+            self.agent_memory_usage[handle] = memory_usage
+            memory_usage *= self.memory_scale
+            self.new_agents.discard(handle)
+            if is_alive and self._should_hibernate(
+                handle, agent, len(updates), wake_time
+            ):
+                self.step_hibernating_agents.append(handle)
+                memory_usage = 0.0
 
             # Inform the coordinator
             self.coordinator_proxy.agent_step_profile(
-                asys.current_rank(),
-                agent_id=agent_id,
+                rank,
+                handle=handle,
                 step_time=(end_time - start_time),
                 memory_usage=memory_usage,
                 n_updates=len(updates),
                 is_alive=is_alive,
+                wake_time=wake_time,
+                buffer_=True
+            )
+
+    def _step_unprofiled_agents(self, handles):
+        """Step through agents of the same class, timing them as a whole."""
+        rank = asys.current_rank()
+        results = []
+        start_time = perf_counter()
+        for handle in handles:
+            agent = self.local_agents[handle]
+            updates = agent.step(self.timestep)
+            is_alive = agent.is_alive()
+            wake_time = agent.next_wake_time() if is_alive else None
+            self._send_updates(updates)
+            if self.observe_interactions:
+                self._observe_interactions(handle, agent, updates)
+            results.append((handle, len(updates), is_alive, wake_time))
+        end_time = perf_counter()
+
+        # Every agent is charged the mean step time of its class
+        step_time = (end_time - start_time) / len(handles)
+        chunk_handles = []
+        chunk_memory_usage = 0.0
+        chunk_n_updates = 0
+        for handle, n_updates, is_alive, wake_time in results:
+            self.step_n_agents_stepped += 1
+            self.step_n_updates_sent += n_updates
+            agent = self.local_agents[handle]
+
+            hibernate = False
+            if is_alive:
+                self._schedule_agent(handle, wake_time)
+                hibernate = self._should_hibernate(handle, agent, n_updates, wake_time)
+                if wake_time is None:
+                    chunk_handles.append(handle)
+                    chunk_memory_usage += self.agent_memory_usage[handle]
+                    chunk_n_updates += n_updates
+                    continue
+                self.step_sleeping_agents.append(wake_time)
+            else:
+                self.step_dead_agents.append(handle)
+
+            # Dead and sleeping agents are always reported individually
+            memory_usage = self._agent_memory_usage(handle, agent)
+            self.agent_memory_usage[handle] = memory_usage
+            memory_usage *= self.memory_scale
+            if hibernate:
+                self.step_hibernating_agents.append(handle)
+                memory_usage = 0.0
+            self.coordinator_proxy.agent_step_profile(
+                rank,
+                handle=handle,
+                step_time=step_time,
+                memory_usage=memory_usage,
+                n_updates=n_updates,
+                is_alive=is_alive,
+                wake_time=wake_time,
                 buffer_=True
             )
 
-        # Tell stores that we are done for this step
-        for store in self.store_proxies.values():
-            store.handle_update_done(asys.current_rank())
+        if chunk_handles:
+            self.coordinator_proxy.agent_step_profile_chunk(
+                rank,
+                handles=chunk_handles,
+                step_time=step_time * len(chunk_handles),
+                memory_usage=chunk_memory_usage * self.memory_scale,
+                n_updates=chunk_n_updates,
+                buffer_=True,
+            )
+
+    def _finish_step(self):
+        """Report the end of the step and prepare for the next step."""
+        dead_agents = self.step_dead_agents
+        hibernating_agents = self.step_hibernating_agents
+
+        self.metric_agents_stepped.inc(self.step_n_agents_stepped)
+        self.metric_agents_died.inc(len(dead_agents))
+        self.metric_updates_sent.inc(self.step_n_updates_sent)
+        # The agents dying or going into hibernation in this step
+        # are only removed from the local agents at the end of the step
+        n_resident = len(self.local_agents) - len(dead_agents) - len(hibernating_agents)
+        n_hibernated = len(hibernating_agents)
+        if self.hibernation is not None:
+            n_hibernated += len(self.hibernation)
+        self.metric_local_agents.set(n_resident + n_hibernated)
+        self.metric_hibernated_agents.set(n_hibernated)
+        rss = None
+        if self.measure_memory_every is not None:
+            rss = memory.rss_bytes()
+            self.metric_rss.set(rss)
+            traced = memory.traced_bytes()
+            if traced is not None:
+                self.metric_traced.set(traced)
+            self._update_memory_scale(traced if self.trace_memory else rss)
+            self.metric_memory_scale.set(self.memory_scale)
+
+        # Inform the calendar when the agents are next active
+        if self.calendar_proxy is not None:
+            if self.awake_agents:
+                self.calendar_proxy.schedule(
+                    self.timestep.end, len(self.awake_agents), buffer_=True
+                )
+            for wake_time in self.step_sleeping_agents:
+                self.calendar_proxy.schedule(wake_time, buffer_=True)
+
+        for store_name in list(self.update_batches):
+            self._send_update_batch(store_name)
+
+        if self.combined_updates:
+            with tracing.span(
+                "send_combined_updates", cat="runner", n=len(self.combined_updates)
+            ):
+                self._send_combined_updates()
 
-        # Tell the coordinator we are done
-        self.coordinator_proxy.agent_step_profile_done(asys.current_rank())
+        if self.step_interaction_keys:
+            self._send_interaction_keys()
+
+        # Flushing out the buffered messages happens here
+        with tracing.span("send_step_done", cat="runner"):
+            # Tell stores that we are done for this step
+            for store in self.store_proxies.values():
+                store.handle_update_done(asys.current_rank(), self.batch_updates)
+
+            # Tell the coordinator we are done
+            self.coordinator_proxy.agent_step_profile_done(asys.current_rank(), rss)
+
+            # Report the metrics of this rank
+            if self.metrics_proxy is not None:
+                self.metrics_proxy.report(
+                    asys.current_rank(), self.timestep.step, metrics.collect()
+                )
 
         # Delete any dead agents
-        for agent_id in dead_agents:
-            del self.local_agents[agent_id]
+        for handle in dead_agents:
+            del self.local_agents[handle]
+            del self.agent_memory_usage[handle]
+            self.agent_quiet_steps.pop(handle, None)
+
+        # Hibernate the idle agents
+        self._hibernate(hibernating_agents)
+
+        self.step_dead_agents = []
+        self.step_sleeping_agents = []
+        self.step_hibernating_agents = []
+        self.step_interaction_keys = defaultdict(list)
+        self._prepare_for_next_step()
+
+    def _continue_step(self):
+        """Step through the next pending chunk, or try to steal more agents."""
+        if self.pending_chunks:
+            self._step_chunk(*self.pending_chunks.popleft())
+
+        if self.pending_chunks:
+            # Let the steal requests from other runners in
+            self.runner_proxies[asys.current_rank()].continue_step()
+        else:
+            self._try_steal()
+
+    def _try_steal(self):
+        """Ask the next runner on the node for agents, or finish the step."""
+        if not self.steal_victims:
+            self._finish_step()
+            return
+
+        victim = self.steal_victims.pop(0)
+        self.metric_steal_requests.inc()
+        self.runner_proxies[victim].steal_request(asys.current_rank())
+
+    def continue_step(self):
+        """Continue stepping through the due agents (sent to self)."""
+        self._continue_step()
 
+    def steal_request(self, rank):
+        """Give half of the pending chunks to an idle runner.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the idle runner
+        """
+        n_chunks = len(self.pending_chunks) // 2
+        chunks = [self.pending_chunks.pop() for _ in range(n_chunks)]
+        chunks.reverse()
+
+        entries = []
+        for _, handles in chunks:
+            for handle in handles:
+                entries.append(
+                    (
+                        handle,
+                        self.local_agents.pop(handle),
+                        self.agent_memory_usage.pop(handle, None),
+                        handle in self.new_agents,
+                        self.agent_quiet_steps.pop(handle, 0),
+                    )
+                )
+                self.new_agents.discard(handle)
+        self.metric_agents_given.inc(len(entries))
+
+        with tracing.span("pack_agents", cat="runner", dst_rank=rank):
+            payloads = pack_agents(entries)
+        src_rank = asys.current_rank()
+        for payload in payloads[:-1]:
+            self.runner_proxies[rank].receive_stolen_agents(src_rank, payload, None)
+        payload = payloads[-1] if payloads else None
+        chunk_sizes = [(profiled, len(handles)) for profiled, handles in chunks]
+        self.runner_proxies[rank].receive_stolen_agents(src_rank, payload, chunk_sizes)
+
+    def receive_stolen_agents(self, rank, payload, chunk_sizes):
+        """Receive agents given away by another runner.
+
+        The stolen agents are due in the current step
+        and are stepped by this runner.
+        Their ownership transfer is reported to the coordinator.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner giving away the agents
+        payload : AgentPayload or None
+            The packed (handle, agent, memory_usage, is_new, quiet_steps) tuples
+        chunk_sizes : list of (bool, int) tuples or None
+            None if more payloads are to follow;
+            otherwise, for every given chunk, in order,
+            whether its agents are to be profiled individually
+            and the number of agents in it
+        """
+        if payload is not None:
+            self.stolen_entries.extend(unpack_agents(payload))
+        if chunk_sizes is None:
+            return
+
+        entries = self.stolen_entries
+        self.stolen_entries = []
+        if not entries:
+            self._try_steal()
+            return
+
+        handles = []
+        for handle, agent, memory_usage, is_new, quiet_steps in entries:
+            self.local_agents[handle] = agent
+            if memory_usage is not None:
+                self.agent_memory_usage[handle] = memory_usage
+            if is_new:
+                self.new_agents.add(handle)
+            if quiet_steps:
+                self.agent_quiet_steps[handle] = quiet_steps
+            handles.append(handle)
+        self.metric_agents_stolen.inc(len(handles))
+        self.coordinator_proxy.agents_stolen(rank, asys.current_rank(), handles)
+
+        # The agents were packed chunk by chunk
+        start = 0
+        for profiled, n_agents in chunk_sizes:
+            self.pending_chunks.append((profiled, handles[start : start + n_agents]))
+            start += n_agents
+
+        # Steal again from the same runner once done
+        self.steal_victims.insert(0, rank)
+        self._continue_step()
 
     def step(self, timestep):
         """Respond to the step signal from the simulator.
@@ -150,25 +1032,44 @@ class Runner:
         assert self.timestep is None
 
         self.timestep = timestep
+        self.step_received_time = perf_counter()
         self._try_start_step()
 
-    def create_agent(self, agent_id, constructor):
+    def create_agent(self, handle, constructor):
         """Create an agent locally.
 
         Parameters
         ----------
-        agent_id : str
-            ID of the to be created agent
+        handle : int
+            Handle of the to be created agent
         constructor : Constructor
             Constructor to create the agent
         """
+        self._add_agent(handle, constructor.construct())
+
+    def create_agent_bulk(self, template):
+        """Create a number of agents locally.
+
+        Parameters
+        ----------
+        template : ConstructorTemplate
+            Constructor template of the agents;
+            its object IDs are the agent handles
+        """
+        for handle, agent in template.construct_all():
+            self._add_agent(handle, agent)
+
+    def _add_agent(self, handle, agent):
+        """Add a newly created agent as due."""
         if __debug__:
-            if agent_id in self.local_agents:
+            if handle in self.local_agents:
                 raise RuntimeError(
-                    "Can't create agent; agent %s already exists" % agent_id
+                    "Can't create agent; agent %s already exists" % handle
                 )
 
-        self.local_agents[agent_id] = constructor.construct()
+        self.local_agents[handle] = agent
+        self.new_agents.add(handle)
+        self._schedule_agent(handle, None)
 
     def create_agent_done(self):
         """Respond to create event done message from coordinator."""
@@ -177,64 +1078,182 @@ class Runner:
         self.flag_create_agent_done = True
         self._try_start_step()
 
-    def move_agent(self, agent_id, dst_rank):
+    def move_agent(self, handle, dst_rank):
         """Send local agents to destination ranks.
 
+        The agents are only queued here;
+        they are packed and sent when `move_agent_done` is received.
+
         Parameters
         ----------
-        agent_id : str
-            ID of the agent to be moved
+        handle : int
+            Handle of the agent to be moved
         dst_rank : int
             Destination rank of the agent
         """
+        if self.hibernation is not None and handle in self.hibernation:
+            self._fault_in([handle])
+
         if __debug__:
-            if agent_id not in self.local_agents:
+            if handle not in self.local_agents:
                 raise RuntimeError(
-                    "Can't send agent; agent %s doesn't exist" % agent_id
+                    "Can't send agent; agent %s doesn't exist" % handle
                 )
 
-        agent = self.local_agents[agent_id]
-        self.runner_proxies[dst_rank].receive_agent(agent_id, agent)
+        agent = self.local_agents.pop(handle)
+        wake_time = self._unschedule_agent(handle)
+        self.agent_memory_usage.pop(handle, None)
+        self.agent_quiet_steps.pop(handle, None)
+        self.new_agents.discard(handle)
+        self.outgoing_agents[dst_rank].append((handle, agent, wake_time))
+        self.metric_agents_sent.inc()
+
+    def move_agent_done(self, n_sources):
+        """Respond to move agents done message from coordinator.
 
-        del self.local_agents[agent_id]
+        The queued agents are packed into payloads,
+        one set of payloads per destination rank, and sent.
 
-    def move_agent_done(self):
-        """Respond to move agents done message from coordinator."""
+        Parameters
+        ----------
+        n_sources : int
+            Number of ranks sending agents to this rank in this step
+        """
         assert not self.flag_move_agents_done
         self.flag_move_agents_done = True
+        self.num_move_sources = n_sources
+
+        rank = asys.current_rank()
+        for dst_rank, entries in self.outgoing_agents.items():
+            with tracing.span(
+                "pack_agents", cat="runner", dst_rank=dst_rank, n_agents=len(entries)
+            ):
+                start_time = perf_counter()
+                payloads = pack_agents(entries)
+                self.metric_migration_time.inc(perf_counter() - start_time)
+
+            for i, payload in enumerate(payloads):
+                is_last = i == len(payloads) - 1
+                self.runner_proxies[dst_rank].receive_agents(rank, payload, is_last)
+                self.metric_migrated_bytes.inc(payload.size())
+        self.outgoing_agents.clear()
 
-        self.every_runner_proxy.receive_agent_done(asys.current_rank())
         self._try_start_step()
 
-    def receive_agent(self, agent_id, agent):
-        """Receive an agent from another worker process.
+    def receive_agents(self, rank, payload, is_last):
+        """Receive a payload of agents from another runner.
 
         Parameters
         ----------
-        agent_id : str
-            ID of the incoming agent
-        agent : Agent
-            The actual agent itself
+        rank : int
+            Rank of the sending runner
+        payload : AgentPayload
+            The packed (handle, agent, wake_time) tuples
+        is_last : bool
+            True if this is the last payload from the sending runner
+            in this step
         """
-        if __debug__:
-            if agent_id in self.local_agents:
-                raise RuntimeError(
-                    "Can't receive agent; agent %s already exists" % agent_id
-                )
+        with tracing.span(
+            "unpack_agents", cat="runner", src_rank=rank, n_agents=payload.n_agents
+        ):
+            start_time = perf_counter()
+            entries = unpack_agents(payload)
+            self.metric_migration_time.inc(perf_counter() - start_time)
+
+        for handle, agent, wake_time in entries:
+            if __debug__:
+                if handle in self.local_agents:
+                    raise RuntimeError(
+                        "Can't receive agent; agent %s already exists" % handle
+                    )
+
+            self.local_agents[handle] = agent
+            self.new_agents.add(handle)
+            self._schedule_agent(handle, wake_time)
+        self.metric_agents_received.inc(len(entries))
+
+        if is_last:
+            if __debug__:
+                LOG.debug("Runner on %d has finished sending agents", rank)
+            self.num_receive_agent_done += 1
+            self._try_start_step()
 
-        self.local_agents[agent_id] = agent
+    def checkpoint(self, checkpoint_path):
+        """Write the runner's shard of a checkpoint.
 
-    def receive_agent_done(self, rank):
-        """Respond to receive agent done message from other agent steppers.
+        The local agents (including the hibernated ones)
+        are written along with their schedule and profiling state.
 
         Parameters
         ----------
-        rank : int
-            Rank of the agent runner
+        checkpoint_path : str
+            Path of the checkpoint
         """
-        assert self.num_receive_agent_done < WORLD_SIZE
-        if __debug__:
-            LOG.debug("Runner on %d has finished sending agents", rank)
+        rank = asys.current_rank()
+        with tracing.span("checkpoint", cat="runner", n_agents=len(self.local_agents)):
+            hibernated = [] if self.hibernation is None else self.hibernation.dump()
+            state = {
+                "local_agents": self.local_agents,
+                "hibernated": hibernated,
+                "awake_agents": self.awake_agents,
+                "sleep_calendar": list(self.sleep_calendar),
+                "agent_memory_usage": self.agent_memory_usage,
+                "agent_quiet_steps": self.agent_quiet_steps,
+                "new_agents": self.new_agents,
+                "num_steps": self.num_steps,
+            }
+            path = checkpoint.shard_path(checkpoint_path, "runner", rank)
+            checkpoint.write_shard(path, state)
 
-        self.num_receive_agent_done += 1
-        self._try_start_step()
+        self.coordinator_proxy.checkpoint_done(rank)
+
+    def finish(self, step):
+        """Respond to the end of the simulation.
+
+        The metrics recorded on this rank after the last step was reported
+        (e.g. by the final flush of the stores) are reported.
+
+        Parameters
+        ----------
+        step : float
+            The step under which the remaining metrics are reported
+        """
+        rank = asys.current_rank()
+        if self.metrics_proxy is not None:
+            self.metrics_proxy.report(rank, step, metrics.collect(), buffer_=True)
+
+        self.coordinator_proxy.finish_done(rank)
+
+    def restore(self, checkpoint_path):
+        """Restore the runner's state from a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        rank = asys.current_rank()
+        with tracing.span("restore", cat="runner"):
+            path = checkpoint.shard_path(checkpoint_path, "runner", rank)
+            state = checkpoint.read_shard(path)
+
+            self.local_agents = state["local_agents"]
+            self.awake_agents = state["awake_agents"]
+            self.sleep_calendar = SortedList(state["sleep_calendar"])
+            self.agent_wake_time = {
+                handle: wake_time for wake_time, handle in self.sleep_calendar
+            }
+            self.agent_memory_usage = state["agent_memory_usage"]
+            self.agent_quiet_steps = state["agent_quiet_steps"]
+            self.new_agents = state["new_agents"]
+            self.num_steps = state["num_steps"]
+
+            # Agents hibernated at checkpoint time are hibernated again,
+            # unless hibernation is disabled
+            if self.hibernation is not None:
+                self.hibernation.load(state["hibernated"])
+            else:
+                for handle, data in state["hibernated"]:
+                    self.local_agents[handle] = pickle.loads(data)
+
+        self.coordinator_proxy.checkpoint_done(rank)
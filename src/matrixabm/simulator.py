@@ -4,7 +4,9 @@ from time import perf_counter
 
 import xactor as asys
 
-from . import INFO_FINE
+from . import INFO_FINE, WORLD_SIZE
+from . import tracing
+from . import checkpoint
 
 LOG = asys.getLogger(__name__)
 
@@ -15,16 +17,36 @@ class Simulator:
     The simulator is responsible for coordinating the overall simulation.
     It expects all the actors have already been created.
 
+    If checkpointing is enabled, every `checkpoint_every` steps,
+    once the step is complete,
+    the simulator asks the coordinator, runners, populations and stores
+    to write their shards of a checkpoint,
+    and starts the next step only after all of them are done.
+    The simulator itself checkpoints the timestep generator
+    and any other local actors in `checkpoint_aids`.
+
+    When restarting from a checkpoint,
+    all the actors are expected to have been created as usual.
+    Before starting the first step,
+    the simulator asks them to restore their state
+    from the latest complete checkpoint.
+
     Receives
     --------
     * `store_flush_done` from StateStore(s)
     * `coordinator_done` from Coordinator
+    * `store_checkpoint_done` from StateStore(s)
+    * `checkpoint_done` from Coordinator
+    * `runners_finished` from Coordinator
 
     Sends
     -----
     * `step` to Coordinator
     * `step` to Runner
     * `create_agents` to Population
+    * `checkpoint` to Coordinator, Runner, Population and StateStore(s)
+    * `restore` to Coordinator, Runner, Population and StateStore(s)
+    * `finish` to Runner
     """
 
     def __init__(
@@ -35,16 +57,75 @@ class Simulator:
         timestep_generator_aid,
         store_names,
         summary_writer_aid=None,
+        distributed_population=False,
+        store_proxies=None,
+        checkpoint_dir=None,
+        checkpoint_every=None,
+        checkpoint_aids=(),
+        restore=False,
     ):
-        """Initialize."""
+        """Initialize.
+
+        Parameters
+        ----------
+        coordinator_aid : str
+            ID of the coordinator actor
+        runner_aid : str
+            ID of the runner actors
+        population_aid : str
+            ID of the population actor(s)
+        timestep_generator_aid : str
+            ID of the local timestep generator actor
+        store_names : list of str
+            Names of the state stores
+        summary_writer_aid : str, optional
+            ID of the local summary writer actor
+        distributed_population : bool
+            If True, there is a population actor on every rank
+        store_proxies : dict [str -> ActorProxy], optional
+            Actor proxy objects to stores;
+            required if checkpointing or restoring
+        checkpoint_dir : str, optional
+            Directory where the checkpoints are written
+            and restored from
+        checkpoint_every : int, optional
+            If given, a checkpoint is written every this many steps
+        checkpoint_aids : list of str
+            IDs of other local actors (e.g. an EventCalendar)
+            whose state is to be checkpointed along with the simulator;
+            like the timestep generator, they must have the
+            `get_checkpoint_state` and `set_checkpoint_state` methods
+        restore : bool
+            If True, restore the simulation
+            from the latest checkpoint in `checkpoint_dir`
+        """
+        tracing.start_tracing_from_env()
+
         self.coordinator_proxy = asys.ActorProxy(asys.MASTER_RANK, coordinator_aid)
         self.every_runner_proxy = asys.ActorProxy(asys.EVERY_RANK, runner_aid)
-        self.population_proxy = asys.ActorProxy(asys.MASTER_RANK, population_aid)
+        if distributed_population:
+            self.population_proxy = asys.ActorProxy(asys.EVERY_RANK, population_aid)
+        else:
+            self.population_proxy = asys.ActorProxy(asys.MASTER_RANK, population_aid)
 
         self.timestep_generator_aid = timestep_generator_aid
         self.summary_writer_aid = summary_writer_aid
         self.store_names = store_names
 
+        if (checkpoint_every is not None or restore) and (
+            checkpoint_dir is None or store_proxies is None
+        ):
+            raise ValueError("Checkpointing requires checkpoint_dir and store_proxies")
+        self.store_proxies = store_proxies
+        self.checkpoint_dir = checkpoint_dir
+        if checkpoint_every is None:
+            self.checkpoint_every = None
+        else:
+            self.checkpoint_every = int(checkpoint_every)
+        self.checkpoint_aids = [timestep_generator_aid] + list(checkpoint_aids)
+        self.restore = restore
+        self.num_steps = 0
+
         self.timestep = None
         self.round_start_time = None
         self.round_end_time = None
@@ -54,6 +135,12 @@ class Simulator:
         self.num_store_flush_done = None
         self.store_rank_flush_time = None
 
+        # Checkpoint variables
+        self.checkpoint_path = None
+        self.checkpoint_start_time = None
+        self.flag_coordinator_checkpoint_done = None
+        self.num_store_checkpoint_done = None
+
         self._prepare_for_next_step()
 
     def _prepare_for_next_step(self):
@@ -62,20 +149,32 @@ class Simulator:
         self.num_store_flush_done = {store_name: 0 for store_name in self.store_names}
         self.store_rank_flush_time = {}
 
-    def _write_summary(self):
-        """Log the summary of activities."""
+        self.checkpoint_path = None
+        self.checkpoint_start_time = None
+        self.flag_coordinator_checkpoint_done = False
+        self.num_store_checkpoint_done = 0
+
+    def _write_summary(self, timestep, round_time):
+        """Log the summary of activities.
+
+        Parameters
+        ----------
+        timestep : Timestep
+            The completed timestep
+        round_time : float
+            Time taken by the completed timestep (in seconds)
+        """
         if self.summary_writer_aid is None:
             return
         summary_writer = asys.local_actor(self.summary_writer_aid)
         if summary_writer is None:
             return
 
-        round_time = self.round_end_time - self.round_start_time
-        summary_writer.add_scalar("round_time", round_time, self.timestep.step)
+        summary_writer.add_scalar("round_time", round_time, timestep.step)
 
         for (store_name, rank), flush_time in self.store_rank_flush_time.items():
             summary_writer.add_scalar(
-                f"store_flush_time/{store_name}/{rank}", flush_time, self.timestep.step
+                f"store_flush_time/{store_name}/{rank}", flush_time, timestep.step
             )
 
         summary_writer.flush()
@@ -100,15 +199,37 @@ class Simulator:
                 if self.num_store_flush_done[store_name] < n_nodes:
                     return
 
+            if self.round_end_time is None:
+                self.round_end_time = perf_counter()
+                self.num_steps += 1
+            if not self._try_checkpoint():
+                return
+
+        prev_timestep, round_time = None, None
         if not starting:
-            self.round_end_time = perf_counter()
-            self._write_summary()
+            tracing.complete(
+                "round",
+                self.round_start_time,
+                self.round_end_time,
+                cat="simulator",
+                step=self.timestep.step,
+            )
+            prev_timestep = self.timestep
+            round_time = self.round_end_time - self.round_start_time
 
         timestep_generator = asys.local_actor(self.timestep_generator_aid)
-        self.timestep = timestep_generator.get_next_timestep()
+        with tracing.span("get_next_timestep", cat="simulator"):
+            self.timestep = timestep_generator.get_next_timestep()
         if self.timestep is None:
-            LOG.info("Simulation finished.")
-            asys.stop()
+            if prev_timestep is None:
+                self.runners_finished()
+                return
+
+            self._write_summary(prev_timestep, round_time)
+
+            # The metrics recorded during the last step's flush
+            # ride on the report of the step after it
+            self.every_runner_proxy.finish(prev_timestep.step + 1)
             return
         self.round_start_time = perf_counter()
         self.round_end_time = None
@@ -118,11 +239,137 @@ class Simulator:
         self.coordinator_proxy.step(self.timestep)
         self.every_runner_proxy.step(self.timestep)
 
+        # Write the summary of the previous step
+        # only after the next step has been started
+        if prev_timestep is not None:
+            with tracing.span("write_summary", cat="simulator"):
+                self._write_summary(prev_timestep, round_time)
+
         self._prepare_for_next_step()
 
+    def _checkpoint_actors(self):
+        """Send a checkpoint or restore message to every participating actor."""
+        method = "restore" if self.restore else "checkpoint"
+        getattr(self.coordinator_proxy, method)(self.checkpoint_path)
+        getattr(self.every_runner_proxy, method)(self.checkpoint_path)
+        getattr(self.population_proxy, method)(self.checkpoint_path)
+        for store_proxy in self.store_proxies.values():
+            getattr(store_proxy, method)(self.checkpoint_path)
+
+    def _checkpoint_done(self):
+        """Check if all the actors are done with the checkpoint or restore."""
+        LOG.log(
+            INFO_FINE,
+            "Checkpoint done? (CCD=%s,NSCD=%d/%d)",
+            self.flag_coordinator_checkpoint_done,
+            self.num_store_checkpoint_done,
+            len(self.store_proxies) * len(asys.nodes()),
+        )
+        if not self.flag_coordinator_checkpoint_done:
+            return False
+        if self.num_store_checkpoint_done < len(self.store_proxies) * len(asys.nodes()):
+            return False
+        return True
+
+    def _try_checkpoint(self):
+        """Try to checkpoint the completed step.
+
+        Returns
+        -------
+        bool
+            True if no checkpoint is due or the checkpoint is complete
+        """
+        if self.checkpoint_every is None or self.num_steps % self.checkpoint_every:
+            return True
+
+        if self.checkpoint_path is None:
+            self.checkpoint_path = checkpoint.step_path(
+                self.checkpoint_dir, self.num_steps
+            )
+            LOG.info("Writing checkpoint %s", self.checkpoint_path)
+            self.checkpoint_start_time = perf_counter()
+
+            state = {
+                "world_size": WORLD_SIZE,
+                "n_nodes": len(asys.nodes()),
+                "num_steps": self.num_steps,
+                "local_actors": {
+                    aid: asys.local_actor(aid).get_checkpoint_state()
+                    for aid in self.checkpoint_aids
+                },
+            }
+            path = checkpoint.shard_path(self.checkpoint_path, "simulator")
+            checkpoint.write_shard(path, state)
+
+            self._checkpoint_actors()
+            return False
+
+        if not self._checkpoint_done():
+            return False
+
+        checkpoint.write_latest(self.checkpoint_dir, self.checkpoint_path)
+        end_time = perf_counter()
+        tracing.complete(
+            "checkpoint", self.checkpoint_start_time, end_time, cat="simulator"
+        )
+        LOG.info(
+            "Checkpoint %s written in %.3f seconds",
+            self.checkpoint_path,
+            end_time - self.checkpoint_start_time,
+        )
+        return True
+
+    def _start_restore(self):
+        """Start restoring the simulation from the latest checkpoint."""
+        self.checkpoint_path = checkpoint.read_latest(self.checkpoint_dir)
+        LOG.info("Restoring from checkpoint %s", self.checkpoint_path)
+        self.checkpoint_start_time = perf_counter()
+
+        path = checkpoint.shard_path(self.checkpoint_path, "simulator")
+        state = checkpoint.read_shard(path)
+        if state["world_size"] != WORLD_SIZE or state["n_nodes"] != len(asys.nodes()):
+            raise RuntimeError(
+                "Checkpoint was written with %d ranks on %d nodes; "
+                "can't restore it on %d ranks on %d nodes"
+                % (
+                    state["world_size"],
+                    state["n_nodes"],
+                    WORLD_SIZE,
+                    len(asys.nodes()),
+                )
+            )
+
+        self.num_steps = state["num_steps"]
+        for aid, actor_state in state["local_actors"].items():
+            asys.local_actor(aid).set_checkpoint_state(actor_state)
+
+        self._checkpoint_actors()
+
+    def _try_finish_restore(self):
+        """Start the simulation once all the actors have been restored."""
+        if not self._checkpoint_done():
+            return
+
+        end_time = perf_counter()
+        tracing.complete(
+            "restore", self.checkpoint_start_time, end_time, cat="simulator"
+        )
+        LOG.info(
+            "Restored from checkpoint %s in %.3f seconds",
+            self.checkpoint_path,
+            end_time - self.checkpoint_start_time,
+        )
+
+        self.restore = False
+        self._prepare_for_next_step()
+        self._try_start_step(starting=True)
+
     def start(self):
         """Start the simulation."""
-        self._try_start_step(starting=True)
+        if self.restore:
+            self._start_restore()
+        else:
+            self._try_start_step(starting=True)
 
     def store_flush_done(self, store_name, rank, flush_time):
         """Log that the store flush for the given store was completed.
@@ -154,3 +401,41 @@ class Simulator:
 
         self.flag_coordinator_done = True
         self._try_start_step(starting=False)
+
+    def store_checkpoint_done(self, store_name, rank):
+        """Log that a store is done with the checkpoint or restore.
+
+        Parameters
+        ----------
+        store_name : str
+            Name of the state store
+        rank : int
+            The rank on which the store was running
+        """
+        if __debug__:
+            LOG.debug("The store %s on rank %d is done checkpointing", store_name, rank)
+
+        self.num_store_checkpoint_done += 1
+        self._continue_after_checkpoint()
+
+    def checkpoint_done(self):
+        """Log that the coordinator, runners and populations are done."""
+        if __debug__:
+            LOG.debug("The coordinator is done checkpointing")
+
+        assert not self.flag_coordinator_checkpoint_done
+
+        self.flag_coordinator_checkpoint_done = True
+        self._continue_after_checkpoint()
+
+    def runners_finished(self):
+        """Stop the simulation once the runners are done."""
+        LOG.info("Simulation finished.")
+        asys.stop()
+
+    def _continue_after_checkpoint(self):
+        """Continue the simulation if the checkpoint or restore is done."""
+        if self.restore:
+            self._try_finish_restore()
+        else:
+            self._try_start_step(starting=False)
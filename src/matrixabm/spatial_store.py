@@ -0,0 +1,484 @@
+"""Spatial index store.
+
+Many models need the agents within some distance of a point
+or the agents in some grid cell, on every step.
+A spatial store keeps the positions of the agents
+in a uniform grid index built from NumPy arrays,
+and answers batched neighbourhood queries with vectorized operations.
+
+Agents set their positions by sending updates::
+
+    StateUpdate(store_name, order_key, "set_position", agent_id, x, y, ...)
+    StateUpdate(store_name, order_key, "remove_agent", agent_id)
+
+where the agent IDs are integers (e.g. the agent handles).
+The index is rebuilt during the flush.
+
+The store actor lives on one rank of the node,
+while the agents querying the index may be on any rank of the node.
+The store therefore publishes every new index
+as a set of ``.npy`` files in a node local directory,
+which the other ranks memory map using `open_index`
+(see `matrixabm.array_io`).
+An index is published before the next step starts,
+and is not changed afterwards.
+"""
+
+import os
+import itertools
+from time import perf_counter
+
+import numpy as np
+
+from . import INFO_FINE
+from . import tracing
+from . import metrics
+from . import array_io
+from .array_io import concat_ranges, to_csr
+from .state_store import StateStore
+
+
+class SpatialIndex:
+    """Uniform grid index of agent positions.
+
+    The agents are sorted by the linear index of their grid cell,
+    so the agents of a cell are found with a binary search.
+    Empty cells take no space.
+
+    Attributes
+    ----------
+    cell_size : float
+        Side length of the grid cells
+    cell_min : np.ndarray
+        Smallest grid cell coordinates of the agents
+    grid_shape : np.ndarray
+        Number of grid cells along every dimension
+    keys : np.ndarray
+        Sorted cell keys of the agents
+    ids : np.ndarray
+        IDs of the agents (in cell key order)
+    positions : np.ndarray
+        Positions of the agents (in cell key order)
+    id_order : np.ndarray
+        Permutation sorting `ids`
+    """
+
+    def __init__(self, ids, positions, cell_size):
+        """Build the index.
+
+        Parameters
+        ----------
+        ids : array of int
+            IDs of the agents
+        positions : array of float, shape (n_agents, n_dims)
+            Positions of the agents
+        cell_size : float
+            Side length of the grid cells
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.float64)
+        self.cell_size = float(cell_size)
+
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        if len(cells):
+            self.cell_min = cells.min(axis=0)
+            self.grid_shape = cells.max(axis=0) - self.cell_min + 1
+        else:
+            self.cell_min = np.zeros(positions.shape[1], dtype=np.int64)
+            self.grid_shape = np.ones(positions.shape[1], dtype=np.int64)
+
+        keys = self._cell_keys(cells)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = ids[order]
+        self.positions = positions[order]
+        self.id_order = np.argsort(self.ids, kind="stable")
+
+    @classmethod
+    def _from_arrays(cls, cell_size, cell_min, grid_shape, arrays):
+        """Make an index from already built arrays."""
+        index = cls.__new__(cls)
+        index.cell_size = cell_size
+        index.cell_min = cell_min
+        index.grid_shape = grid_shape
+        index.keys = arrays["keys"]
+        index.ids = arrays["ids"]
+        index.positions = arrays["positions"]
+        index.id_order = arrays["id_order"]
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell_keys(self, cells):
+        """Return the linear keys of grid cells (-1 for cells outside the grid)."""
+        rel = cells - self.cell_min
+        valid = ((rel >= 0) & (rel < self.grid_shape)).all(axis=1)
+        keys = np.full(len(cells), -1, dtype=np.int64)
+        if valid.any():
+            keys[valid] = np.ravel_multi_index(rel[valid].T, self.grid_shape)
+        return keys
+
+    def _cell_ranges(self, cells):
+        """Return the start and count of the agents of every cell."""
+        keys = self._cell_keys(cells)
+        starts = np.searchsorted(self.keys, keys, side="left")
+        ends = np.searchsorted(self.keys, keys, side="right")
+        counts = np.where(keys >= 0, ends - starts, 0)
+        return starts, counts
+
+    def cell_of(self, positions):
+        """Return the grid cells of the given positions.
+
+        Parameters
+        ----------
+        positions : array of float, shape (n, n_dims)
+            The positions
+
+        Returns
+        -------
+        np.ndarray
+            The grid cell coordinates, shape (n, n_dims)
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        return np.floor(positions / self.cell_size).astype(np.int64)
+
+    def get_positions(self, ids):
+        """Return the positions of the given agents.
+
+        Parameters
+        ----------
+        ids : array of int
+            IDs of the agents
+
+        Returns
+        -------
+        np.ndarray
+            Positions of the agents, shape (n, n_dims)
+
+        Raises
+        ------
+        KeyError
+            If some agents are not in the index
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        sorted_ids = self.ids[self.id_order]
+        i = np.searchsorted(sorted_ids, ids)
+        i = np.minimum(i, len(sorted_ids) - 1)
+        if len(sorted_ids) == 0 or not (sorted_ids[i] == ids).all():
+            raise KeyError("Some agents are not in the spatial index")
+        return self.positions[self.id_order[i]]
+
+    def query_cells(self, cells):
+        """Find the agents in the given grid cells.
+
+        Parameters
+        ----------
+        cells : array of int, shape (n_queries, n_dims)
+            The grid cell coordinates
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The agents of the i-th cell are ``ids[offsets[i]:offsets[i+1]]``
+        ids : np.ndarray
+            IDs of the agents
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        starts, counts = self._cell_ranges(cells)
+        offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, self.ids[concat_ranges(starts, counts)]
+
+    def query_radius(self, points, radius):
+        """Find the agents within a distance of the given points.
+
+        Parameters
+        ----------
+        points : array of float, shape (n_queries, n_dims)
+            The query points
+        radius : float
+            The query radius
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The agents near the i-th point are ``ids[offsets[i]:offsets[i+1]]``
+        ids : np.ndarray
+            IDs of the agents
+        """
+        points = np.asarray(points, dtype=np.float64)
+        n_queries, n_dims = points.shape
+        query_cells = self.cell_of(points)
+
+        # Process the queries in cell order for memory locality
+        query_order = np.argsort(self._cell_keys(query_cells), kind="stable")
+        points = points[query_order]
+        query_cells = query_cells[query_order]
+
+        reach = int(np.ceil(radius / self.cell_size))
+        radius2 = radius * radius
+
+        found_query, found_index = [], []
+        for offset in itertools.product(range(-reach, reach + 1), repeat=n_dims):
+            starts, counts = self._cell_ranges(query_cells + np.array(offset))
+            if not counts.any():
+                continue
+            index = concat_ranges(starts, counts)
+            query = np.repeat(np.arange(n_queries), counts)
+            dist2 = ((self.positions[index] - points[query]) ** 2).sum(axis=1)
+            near = dist2 <= radius2
+            found_query.append(query[near])
+            found_index.append(index[near])
+
+        if not found_query:
+            return np.zeros(n_queries + 1, dtype=np.int64), self.ids[:0]
+
+        query = query_order[np.concatenate(found_query)]
+        index = np.concatenate(found_index)
+        return to_csr(query, self.ids[index], n_queries)
+
+    def neighbors(self, ids, radius):
+        """Find the agents within a distance of the given agents.
+
+        The agents themselves are included in the results.
+
+        Parameters
+        ----------
+        ids : array of int
+            IDs of the agents
+        radius : float
+            The query radius
+
+        Returns
+        -------
+        offsets : np.ndarray
+            The neighbors of the i-th agent are ``ids[offsets[i]:offsets[i+1]]``
+        ids : np.ndarray
+            IDs of the neighbors
+        """
+        return self.query_radius(self.get_positions(ids), radius)
+
+    def save(self, path):
+        """Write the index to a directory of .npy files.
+
+        Parameters
+        ----------
+        path : str
+            The (new) directory
+        """
+        names = ["keys", "ids", "positions", "id_order"]
+        arrays = {name: getattr(self, name) for name in names}
+        meta = {
+            "cell_size": self.cell_size,
+            "cell_min": self.cell_min.tolist(),
+            "grid_shape": self.grid_shape.tolist(),
+        }
+        array_io.save_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read an index written by `save`.
+
+        Parameters
+        ----------
+        path : str
+            The directory
+        mmap : bool
+            If True, the arrays are memory mapped read only
+
+        Returns
+        -------
+        SpatialIndex
+            The index
+        """
+        arrays, meta = array_io.load_arrays(path, mmap)
+        return cls._from_arrays(
+            meta["cell_size"],
+            np.array(meta["cell_min"], dtype=np.int64),
+            np.array(meta["grid_shape"], dtype=np.int64),
+            arrays,
+        )
+
+
+def open_index(index_dir):
+    """Return the latest index published by a spatial store.
+
+    The index is memory mapped, and is reloaded only when
+    a new index has been published.
+
+    Parameters
+    ----------
+    index_dir : str
+        The (node local) index directory of the store
+
+    Returns
+    -------
+    SpatialIndex
+        The latest published index
+    """
+    return array_io.open_latest(index_dir, SpatialIndex.load)
+
+
+class SpatialStore(StateStore):
+    """Spatial index store.
+
+    Attributes
+    ----------
+    cell_size : float
+        Side length of the grid cells
+    n_dims : int
+        Number of dimensions of the positions
+    index_dir : str or None
+        Node local directory where the indices are published
+    index : SpatialIndex
+        The index as of the last flush
+    """
+
+    def __init__(
+        self, store_name, simulator_aid, cell_size, n_dims=2, index_dir=None, **kwargs
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_name : str
+            Name of the current state store
+        simulator_aid : str
+            ID of the simulator actor
+        cell_size : float
+            Side length of the grid cells
+            (ideally about the typical query radius)
+        n_dims : int
+            Number of dimensions of the positions
+        index_dir : str, optional
+            Node local directory where the indices are published
+            for the other ranks of the node
+        **kwargs : dict
+            Other arguments of `StateStore`
+        """
+        super().__init__(store_name, simulator_aid, **kwargs)
+
+        self.cell_size = float(cell_size)
+        self.n_dims = int(n_dims)
+        self.index_dir = index_dir
+        self.version = 0
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+
+        self.update_cache = []
+
+        # Agent positions; the first n_agents rows are in use
+        self.row_of = {}
+        self.n_agents = 0
+        self.ids = np.empty(1024, dtype=np.int64)
+        self.positions = np.empty((1024, self.n_dims), dtype=np.float64)
+        self.changed = False
+
+        self.index = SpatialIndex(self.ids[:0], self.positions[:0], self.cell_size)
+        self._publish_index()
+
+        self.metric_index_build_time = metrics.counter(
+            f"store_index_build_time/{store_name}"
+        )
+        self.metric_indexed_agents = metrics.gauge(f"store_indexed_agents/{store_name}")
+
+    def handle_update(self, update):
+        """Handle incoming update."""
+        self.update_cache.append(update)
+
+    def set_position(self, agent_id, *position):
+        """Set the position of an agent (adding it if needed).
+
+        Parameters
+        ----------
+        agent_id : int
+            ID of the agent
+        *position : tuple of float
+            The position of the agent
+        """
+        row = self.row_of.get(agent_id)
+        if row is None:
+            row = self.n_agents
+            if row == len(self.ids):
+                self.ids = np.resize(self.ids, 2 * row)
+                self.positions = np.resize(self.positions, (2 * row, self.n_dims))
+            self.ids[row] = agent_id
+            self.row_of[agent_id] = row
+            self.n_agents += 1
+        self.positions[row] = position
+        self.changed = True
+
+    def remove_agent(self, agent_id):
+        """Remove an agent.
+
+        Parameters
+        ----------
+        agent_id : int
+            ID of the agent
+        """
+        row = self.row_of.pop(agent_id, None)
+        if row is None:
+            return
+
+        # Move the last agent into the freed row
+        last = self.n_agents - 1
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.positions[row] = self.positions[last]
+            self.row_of[int(self.ids[row])] = row
+        self.n_agents -= 1
+        self.changed = True
+
+    def flush(self):
+        """Apply the updates and rebuild the index."""
+        self.log.log(INFO_FINE, "Applying %d updates", len(self.update_cache))
+        with tracing.span("apply", cat="store", n_updates=len(self.update_cache)):
+            self.update_cache.sort()
+            for update in self.update_cache:
+                update.apply(self)
+            self.update_cache.clear()
+
+        if self.changed:
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        """Rebuild and publish the index."""
+        start_time = perf_counter()
+        with tracing.span("build_index", cat="store", n_agents=self.n_agents):
+            n = self.n_agents
+            self.index = SpatialIndex(
+                self.ids[:n], self.positions[:n], self.cell_size
+            )
+            self._publish_index()
+        self.changed = False
+
+        self.metric_index_build_time.inc(perf_counter() - start_time)
+        self.metric_indexed_agents.set(self.n_agents)
+
+    def _publish_index(self):
+        """Write the index for the other ranks of the node."""
+        if self.index_dir is None:
+            return
+
+        self.version += 1
+        array_io.publish(self.index_dir, self.version, self.index)
+
+    def save_checkpoint(self, path):
+        """Write the agent positions."""
+        n = self.n_agents
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, ids=self.ids[:n], positions=self.positions[:n])
+        os.replace(tmp_path, path + ".npz")
+
+    def load_checkpoint(self, path):
+        """Replace the agent positions with the checkpointed ones."""
+        with np.load(path + ".npz") as data:
+            ids, positions = data["ids"], data["positions"]
+
+        self.n_agents = len(ids)
+        capacity = max(1024, len(ids))
+        self.ids = np.resize(ids, capacity)
+        self.positions = np.resize(positions, (capacity, self.n_dims))
+        self.row_of = {int(agent_id): row for row, agent_id in enumerate(ids)}
+        self._rebuild_index()
@@ -24,14 +24,63 @@ to the underlying state store object.
 
 Once the cached updates are flushed,
 the store informs the Simulator that it is done.
+
+Updates of combinable store methods (see `matrixabm.combiner`)
+are combined by the runners and are received in batches
+via `handle_combined_updates` messages.
+The store merges the partial results from the runners,
+and passes a single update per key to `handle_update`
+just before the flush.
+The partial results are merged in the order of the runners' ranks
+(and with tree fan-out, the nodes' merged results
+in the order of the nodes),
+irrespective of the order in which they arrive,
+so that the store actors on every node
+compute identical (e.g. floating point) results.
+
+By default every runner sends its updates
+to the store actors on every node.
+With tree fan-out, every runner sends its updates in batches
+(via `handle_update_batch` messages)
+only to the store actor on its own node;
+a runner sending its updates one by one is rejected.
+Once all the runners on its node are done,
+the store actor forwards the node's batch
+along a binomial broadcast tree rooted at its node
+to the store actors on the other nodes,
+which forward it further down the tree
+(via `forward_updates` messages).
+A store actor thus flushes once all the runners on its node are done
+and it has received the batches of all the other nodes.
+This cuts the outbound update traffic of every runner
+from one copy per node to a single copy.
+
+The store actors on a node may share a flush executor
+(see `matrixabm.flush_executor`),
+which flushes all the local stores together
+once they are all ready to flush.
+
+At step boundaries, the simulator may ask the stores
+to write their contents to a checkpoint,
+or to restore their contents from one.
+Every store actor writes its own copy of the store object.
 """
 
+import os
 from time import perf_counter
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 import xactor as asys
 
 from . import INFO_FINE, WORLD_SIZE
+from . import tracing
+from . import metrics
+from . import checkpoint
+from .combiner import get_combiners
+
+# Maximum number of updates forwarded to another node in one message
+FORWARD_BATCH_SIZE = 1000
 
 
 class StateStore(ABC):
@@ -40,14 +89,23 @@ class StateStore(ABC):
     Receives
     --------
     * `handle_update*` from Runner
+    * `handle_update_batch*` from Runner
+    * `handle_combined_updates*` from Runner
     * `handle_update_done` from Runner
+    * `forward_updates*` from StateStore(s) (with tree fan-out)
+    * `checkpoint` from Simulator
+    * `restore` from Simulator
 
     Sends
     -----
+    * `forward_updates*` to StateStore(s) (with tree fan-out)
     * `store_flush_done` to Simulator
+    * `store_checkpoint_done` to Simulator
     """
 
-    def __init__(self, store_name, simulator_aid):
+    def __init__(
+        self, store_name, simulator_aid, store_ranks=None, flush_executor_aid=None
+    ):
         """Initialize.
 
         Parameters
@@ -56,7 +114,15 @@ class StateStore(ABC):
             Name of the current state store
         simulator_aid : str
             Proxy of the simulator actor
+        store_ranks : list of int, optional
+            If given, tree fan-out is used.
+            The ranks of the store actors, one per node,
+            whose actor ID is expected to be the store name.
+        flush_executor_aid : str, optional
+            ID of the local flush executor, if any
         """
+        tracing.start_tracing_from_env()
+
         self.store_name = store_name
         self.simulator_proxy = asys.ActorProxy(asys.MASTER_RANK, simulator_aid)
 
@@ -64,6 +130,38 @@ class StateStore(ABC):
         self.log = asys.getLogger(logger_name)
 
         self.num_handle_update_done = 0
+        self.flush_executor_aid = flush_executor_aid
+
+        self.combiners = get_combiners(type(self))
+        # Combined updates received from the runners, keyed by rank
+        self.runner_combined_updates = {}
+
+        # Tree fan-out state
+        self.store_ranks = store_ranks
+        if store_ranks is None:
+            self.node_index = None
+            self.num_local_runners = WORLD_SIZE
+        else:
+            rank = asys.current_rank()
+            self.node_index = store_ranks.index(rank)
+            for node in asys.nodes():
+                if rank in asys.node_ranks(node):
+                    self.num_local_runners = len(asys.node_ranks(node))
+            self.store_proxies = [asys.ActorProxy(r, store_name) for r in store_ranks]
+        # Updates received from the runners on this node
+        self.node_updates = []
+        # Merged combined updates of every node, keyed by node index
+        self.node_combined_updates = {}
+        # Number of other nodes whose batches have been received
+        self.num_nodes_done = 0
+
+        self.metric_flush_time = metrics.histogram(f"store_flush_time/{store_name}")
+        self.metric_updates_merged = metrics.counter(
+            f"store_updates_merged/{store_name}"
+        )
+        self.metric_updates_forwarded = metrics.counter(
+            f"store_updates_forwarded/{store_name}"
+        )
 
     @abstractmethod
     def handle_update(self, update):
@@ -75,51 +173,381 @@ class StateStore(ABC):
             A state update
         """
 
-    def handle_update_done(self, rank):
+    def handle_update_batch(self, updates):
+        """Handle a batch of incoming updates from a runner.
+
+        Parameters
+        ----------
+        updates : list of StateUpdate
+            The state updates
+        """
+        if self.store_ranks is not None:
+            self.node_updates.extend(updates)
+        for update in updates:
+            self.handle_update(update)
+
+    def handle_combined_updates(self, rank, updates):
+        """Receive a batch of combined updates from a runner.
+
+        The updates are merged only once all the runners are done.
+
+        Parameters
+        ----------
+        rank : int
+            Rank of the runner
+        updates : list of StateUpdate
+            Updates of combinable methods, at most one per key
+        """
+        self.runner_combined_updates.setdefault(rank, []).extend(updates)
+
+    def _merge_combined_updates(self, source_updates):
+        """Merge the combined updates of every source in the order of the sources.
+
+        Parameters
+        ----------
+        source_updates : dict [int -> list of StateUpdate]
+            Combined updates, at most one per key, keyed by source
+
+        Returns
+        -------
+        dict
+            The merged updates, keyed by (method, key)
+        """
+        combined_updates = {}
+        for source in sorted(source_updates):
+            for update in source_updates[source]:
+                combiner = self.combiners[update.method]
+                key = (update.method, combiner.key(update))
+                prev = combined_updates.get(key)
+                if prev is None:
+                    combined_updates[key] = update
+                else:
+                    combined_updates[key] = combiner.combine(prev, update)
+                    self.metric_updates_merged.inc()
+        source_updates.clear()
+        return combined_updates
+
+    def handle_update_done(self, rank, batched=False):
         """Respond to `handle_update_done` message from a agent runner.
 
         Parameters
         ----------
         rank : int
             Rank of the runner
+        batched : bool
+            True if the runner sent its updates in batches
+
+        Raises
+        ------
+        ValueError
+            If tree fan-out is used and the runner did not batch its updates;
+            updates received one by one are not forwarded to the other nodes
         """
-        assert self.num_handle_update_done < WORLD_SIZE
+        assert self.num_handle_update_done < self.num_local_runners
+        if self.store_ranks is not None and not batched:
+            raise ValueError(
+                "Tree fan-out requires the runners to batch their updates "
+                "(runner on rank %d does not)" % rank
+            )
         if __debug__:
             self.log.debug("Received all updates from rand %d", rank)
 
         self.num_handle_update_done += 1
+        if (
+            self.store_ranks is not None
+            and self.num_handle_update_done == self.num_local_runners
+        ):
+            self._forward_node_updates()
         self._try_flush()
 
+    def _tree_children(self, src_index):
+        """Return the children of this node in the broadcast tree of a node.
+
+        The tree is a binomial tree over the nodes
+        rooted at the source node.
+
+        Parameters
+        ----------
+        src_index : int
+            Index of the source (root) node
+
+        Returns
+        -------
+        list of int
+            Indices of the child nodes
+        """
+        n_nodes = len(self.store_ranks)
+        rel_index = (self.node_index - src_index) % n_nodes
+        children = []
+        step = 1
+        while rel_index + step < n_nodes:
+            if step > rel_index:
+                children.append((src_index + rel_index + step) % n_nodes)
+            step *= 2
+        return children
+
+    def _forward_node_updates(self):
+        """Send the updates of this node's runners to the other nodes."""
+        updates, self.node_updates = self.node_updates, []
+        combined_updates = self._merge_combined_updates(self.runner_combined_updates)
+        combined_updates = list(combined_updates.values())
+        self.node_combined_updates[self.node_index] = combined_updates
+
+        children = self._tree_children(self.node_index)
+        if not children:
+            return
+
+        chunks = [
+            (updates[i : i + FORWARD_BATCH_SIZE], [])
+            for i in range(0, len(updates), FORWARD_BATCH_SIZE)
+        ]
+        chunks.extend(
+            ([], combined_updates[i : i + FORWARD_BATCH_SIZE])
+            for i in range(0, len(combined_updates), FORWARD_BATCH_SIZE)
+        )
+        if not chunks:
+            chunks.append(([], []))
+
+        with tracing.span(
+            "forward_node_updates",
+            cat="store",
+            store_name=self.store_name,
+            n_updates=len(updates) + len(combined_updates),
+        ):
+            for i, (chunk, combined_chunk) in enumerate(chunks):
+                is_last = i == len(chunks) - 1
+                for child in children:
+                    self.store_proxies[child].forward_updates(
+                        self.node_index,
+                        chunk,
+                        combined_chunk,
+                        is_last,
+                        buffer_=not is_last,
+                    )
+                    self.metric_updates_forwarded.inc(len(chunk) + len(combined_chunk))
+
+    def forward_updates(self, src_index, updates, combined_updates, is_last):
+        """Handle a batch of updates forwarded from another node.
+
+        Parameters
+        ----------
+        src_index : int
+            Index of the node whose runners produced the updates
+        updates : list of StateUpdate
+            The state updates
+        combined_updates : list of StateUpdate
+            Combined updates of combinable methods, at most one per key
+        is_last : bool
+            True if this is the last batch from the source node
+        """
+        n_updates = len(updates) + len(combined_updates)
+        for child in self._tree_children(src_index):
+            self.store_proxies[child].forward_updates(
+                src_index, updates, combined_updates, is_last, buffer_=not is_last
+            )
+            self.metric_updates_forwarded.inc(n_updates)
+
+        for update in updates:
+            self.handle_update(update)
+        if combined_updates:
+            self.node_combined_updates.setdefault(src_index, []).extend(
+                combined_updates
+            )
+
+        if is_last:
+            self.num_nodes_done += 1
+            self._try_flush()
+
     def _try_flush(self):
         """Apply the cached updates to the state store."""
+        if self.store_ranks is None:
+            num_nodes = 1
+        else:
+            num_nodes = len(self.store_ranks)
         self.log.log(
             INFO_FINE,
-            "Can flush? (NHUD=%d/%d)",
+            "Can flush? (NHUD=%d/%d, NND=%d/%d)",
             self.num_handle_update_done,
-            WORLD_SIZE,
+            self.num_local_runners,
+            self.num_nodes_done,
+            num_nodes - 1,
         )
-        if self.num_handle_update_done < WORLD_SIZE:
+        if self.num_handle_update_done < self.num_local_runners:
+            return
+        if self.num_nodes_done < num_nodes - 1:
+            return
+
+        self.num_handle_update_done = 0
+        self.num_nodes_done = 0
+
+        self.before_flush()
+
+        # Hand over the merged combined updates
+        if self.store_ranks is None:
+            combined_updates = self._merge_combined_updates(
+                self.runner_combined_updates
+            )
+        else:
+            combined_updates = self._merge_combined_updates(self.node_combined_updates)
+        for update in combined_updates.values():
+            self.handle_update(update)
+
+        if self.flush_executor_aid is not None:
+            asys.local_actor(self.flush_executor_aid).submit(self)
             return
 
         start_time = perf_counter()
         self.flush()
-        flush_time = perf_counter() - start_time
+        self.report_flush(start_time, perf_counter())
+
+    def report_flush(self, start_time, end_time):
+        """Report a completed flush to the simulator.
+
+        Parameters
+        ----------
+        start_time : float
+            Start time of the flush (as returned by `perf_counter`)
+        end_time : float
+            End time of the flush (as returned by `perf_counter`)
+        """
+        flush_time = end_time - start_time
+        self.metric_flush_time.observe(flush_time)
+        tracing.complete(
+            "flush", start_time, end_time, cat="store", store_name=self.store_name
+        )
 
         self.simulator_proxy.store_flush_done(
             self.store_name, asys.current_rank(), flush_time,
         )
 
-        self.num_handle_update_done = 0
+        self.after_flush()
+
+    def before_flush(self):
+        """Prepare for the flush once all the updates of the step are in.
+
+        This is called on the store's rank before the updates are applied,
+        e.g. to wait for housekeeping started by `after_flush`.
+        """
+
+    def after_flush(self):
+        """Do any housekeeping after the flush has been reported.
+
+        This is called on the store's rank,
+        and thus delays the other actors on the rank
+        (e.g. the local runner) until it returns;
+        long running housekeeping should be started in the background
+        and waited for in `before_flush`.
+        """
 
     @abstractmethod
     def flush(self):
         """Apply the received updates to state store."""
 
+    def _checkpoint_path(self, checkpoint_path):
+        """Return the path of the store's shard of a checkpoint."""
+        name = "store-%s" % self.store_name
+        return checkpoint.shard_path(
+            checkpoint_path, name, asys.current_rank(), ext=""
+        )
+
+    def checkpoint(self, checkpoint_path):
+        """Write the store's shard of a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        os.makedirs(checkpoint_path, exist_ok=True)
+        start_time = perf_counter()
+        self.save_checkpoint(self._checkpoint_path(checkpoint_path))
+        tracing.complete(
+            "checkpoint",
+            start_time,
+            perf_counter(),
+            cat="store",
+            store_name=self.store_name,
+        )
+
+        self.simulator_proxy.store_checkpoint_done(self.store_name, asys.current_rank())
+
+    def restore(self, checkpoint_path):
+        """Restore the store's contents from a checkpoint.
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            Path of the checkpoint
+        """
+        self.load_checkpoint(self._checkpoint_path(checkpoint_path))
+        self.simulator_proxy.store_checkpoint_done(self.store_name, asys.current_rank())
+
+    def save_checkpoint(self, path):
+        """Write the contents of the state store.
+
+        Parameters
+        ----------
+        path : str
+            Path (without extension) of the store's checkpoint shard
+        """
+        raise NotImplementedError(
+            "%s doesn't support checkpoints" % self.__class__.__name__
+        )
+
+    def load_checkpoint(self, path):
+        """Replace the contents of the state store with a checkpointed copy.
+
+        Parameters
+        ----------
+        path : str
+            Path (without extension) of the store's checkpoint shard
+        """
+        raise NotImplementedError(
+            "%s doesn't support checkpoints" % self.__class__.__name__
+        )
+
+
+def _compact(retention, con, dbname):
+    """Apply the retention policies (runs in the compaction thread).
+
+    Parameters
+    ----------
+    retention : list of RetentionPolicy
+        The retention policies
+    con : sqlite3.Connection
+        Connection with the database attached
+    dbname : str
+        Name of the database
+
+    Returns
+    -------
+    n_rows : int
+        Number of rows retired
+    start_time : float
+        Start time of the compaction (as returned by `perf_counter`)
+    end_time : float
+        End time of the compaction (as returned by `perf_counter`)
+    """
+    start_time = perf_counter()
+    n_rows = 0
+    for policy in retention:
+        n_rows += policy.compact(con, dbname)
+    return n_rows, start_time, perf_counter()
+
 
 class SQLite3Store(StateStore):
     """SQLite3 database file backed state store."""
 
-    def __init__(self, store_name, simulator_proxy, sqlite3_aid):
+    def __init__(
+        self,
+        store_name,
+        simulator_proxy,
+        sqlite3_aid,
+        store_ranks=None,
+        flush_executor_aid=None,
+        separate_connection=False,
+        retention=None,
+    ):
         """Initialize.
 
         Parameters
@@ -130,16 +558,60 @@ class SQLite3Store(StateStore):
             Proxy of the simulator actor
         sqlite3_aid : str
             ID of the local SQLite3 connection manager
+        store_ranks : list of int, optional
+            If given, tree fan-out is used (see `StateStore`)
+        flush_executor_aid : str, optional
+            ID of the local flush executor, if any
+        separate_connection : bool
+            If True, the store uses its own connection to its database
+            instead of the shared connection of the SQLite3 manager,
+            so that it can be flushed concurrently with the other stores
+        retention : list of RetentionPolicy, optional
+            Retention policies of the store's append only tables,
+            applied in the background after every flush
+            (see `matrixabm.retention`)
         """
-        super().__init__(store_name, simulator_proxy)
+        super().__init__(store_name, simulator_proxy, store_ranks, flush_executor_aid)
 
         self.sqlite3_aid = sqlite3_aid
+        if separate_connection:
+            manager = asys.local_actor(sqlite3_aid)
+            self.separate_connection = manager.open_connection(store_name)
+        else:
+            self.separate_connection = None
         self.insert_sql_cache = {}
         self.insert_or_ignore_sql_cache = {}
         self.update_cache = []
 
+        self.metric_updates_applied = metrics.counter(
+            f"store_updates_applied/{store_name}"
+        )
+
+        self.retention = [] if retention is None else list(retention)
+        if self.retention:
+            manager = asys.local_actor(sqlite3_aid)
+            self.compaction_connection = manager.open_connection(store_name)
+            self.compaction_pool = ThreadPoolExecutor(1, thread_name_prefix="compact")
+        else:
+            self.compaction_connection = None
+            self.compaction_pool = None
+        self.compaction = None
+        self.metric_rows_retired = metrics.counter(f"store_rows_retired/{store_name}")
+        self.metric_compaction_time = metrics.counter(
+            f"store_compaction_time/{store_name}"
+        )
+        self.metric_compaction_wait_time = metrics.counter(
+            f"store_compaction_wait_time/{store_name}"
+        )
+
     def connection(self):
-        """Get the connection from the local SQLite3 manager object."""
+        """Get the store's connection.
+
+        This is the store's own connection if it has one,
+        otherwise the connection from the local SQLite3 manager object.
+        """
+        if self.separate_connection is not None:
+            return self.separate_connection
         return asys.local_actor(self.sqlite3_aid).connection
 
     def handle_update(self, update):
@@ -147,18 +619,75 @@ class SQLite3Store(StateStore):
         self.update_cache.append(update)
 
     def flush(self):
-        """Apply the updates."""
+        """Apply the updates in a transaction."""
+        with self.connection():
+            self.apply_updates()
+
+    def apply_updates(self):
+        """Apply the updates without committing them."""
         self.log.log(INFO_FINE, "Sorting %d updates", len(self.update_cache))
-        self.update_cache.sort()
+        with tracing.span("sort", cat="store", n_updates=len(self.update_cache)):
+            self.update_cache.sort()
 
         self.log.log(INFO_FINE, "Applying %d updates", len(self.update_cache))
-        con = self.connection()
-        with con:
+        with tracing.span("apply", cat="store", n_updates=len(self.update_cache)):
             for update in self.update_cache:
                 update.apply(self)
 
+        self.metric_updates_applied.inc(len(self.update_cache))
         self.update_cache.clear()
 
+    def after_flush(self):
+        """Start retiring the old rows of the tables with retention policies.
+
+        The tables are compacted in a background thread,
+        using the store's compaction connection,
+        while the runners step through the next step.
+        """
+        if not self.retention:
+            return
+
+        self.compaction = self.compaction_pool.submit(
+            _compact, self.retention, self.compaction_connection, self.store_name
+        )
+
+    def wait_compaction(self):
+        """Wait for the running compaction (if any) to finish."""
+        if self.compaction is None:
+            return
+
+        wait_start_time = perf_counter()
+        compaction, self.compaction = self.compaction, None
+        n_rows, start_time, end_time = compaction.result()
+
+        self.metric_rows_retired.inc(n_rows)
+        self.metric_compaction_time.inc(end_time - start_time)
+        self.metric_compaction_wait_time.inc(perf_counter() - wait_start_time)
+        tracing.complete(
+            "compact",
+            start_time,
+            end_time,
+            cat="store",
+            store_name=self.store_name,
+            n_rows=n_rows,
+        )
+        if n_rows:
+            self.log.log(INFO_FINE, "Retired %d rows", n_rows)
+
+    def before_flush(self):
+        """Wait for the compaction started after the previous flush."""
+        self.wait_compaction()
+
+    def save_checkpoint(self, path):
+        """Copy the database using the SQLite3 backup API."""
+        self.wait_compaction()
+        asys.local_actor(self.sqlite3_aid).backup(self.store_name, path + ".sqlite3")
+
+    def load_checkpoint(self, path):
+        """Replace the database with the checkpointed copy."""
+        self.wait_compaction()
+        asys.local_actor(self.sqlite3_aid).restore(self.store_name, path + ".sqlite3")
+
     def execute(self, sql, params=None):
         """Execute the given sql.
 
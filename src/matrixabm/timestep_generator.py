@@ -14,10 +14,19 @@ the Simulator actor calls the `get_next_timestep` method
 of the timestep generator.
 The method is supposed to return a `Timestep` object or None.
 In case it returns None, the simulation ends.
+
+The `ActivityTimestepGenerator` chooses variable length timesteps
+based on when agents are next scheduled to be active.
+It reads the next activity time from a local activity source,
+which can be a state store or an `EventCalendar` actor.
 """
 
 from abc import ABC, abstractmethod
 
+from sortedcontainers import SortedDict
+
+import xactor as asys
+
 from .datatypes import Timestep
 
 class TimestepGenerator(ABC):
@@ -33,6 +42,32 @@ class TimestepGenerator(ABC):
             The current timestep
         """
 
+    def get_checkpoint_state(self):
+        """Return the state of the generator to be checkpointed.
+
+        By default all the attributes of the generator are checkpointed.
+        Generators should override this method and `set_checkpoint_state`
+        to checkpoint only their position,
+        so that a restored simulation keeps its own configuration
+        (e.g. a later end time).
+
+        Returns
+        -------
+        object
+            The (picklable) state of the generator
+        """
+        return dict(vars(self))
+
+    def set_checkpoint_state(self, state):
+        """Restore the state of the generator.
+
+        Parameters
+        ----------
+        state : object
+            The state returned by `get_checkpoint_state`
+        """
+        vars(self).update(state)
+
 class RangeTimestepGenerator(TimestepGenerator):
     """Generate timesteps in the range [0, nsteps-1].
 
@@ -67,3 +102,253 @@ class RangeTimestepGenerator(TimestepGenerator):
         self.step += 1
 
         return timestep
+
+    def get_checkpoint_state(self):
+        """Return the current step of the generator."""
+        return {"step": self.step}
+
+    def set_checkpoint_state(self, state):
+        """Restore the current step of the generator."""
+        self.step = state["step"]
+
+
+class EventCalendar:
+    """Calendar of scheduled agent activity.
+
+    The event calendar keeps track of the (real) times
+    at which agents are scheduled to be active.
+    It is meant to be run as an actor on the master rank,
+    where it serves as the activity source
+    of an `ActivityTimestepGenerator`.
+    Activities whose time has passed are discarded
+    when the generator calls `discard_before`.
+
+    Receives
+    --------
+    * `schedule*` from Runner(s) or Population
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.time_count = SortedDict()
+
+    def get_checkpoint_state(self):
+        """Return the scheduled activity of the calendar."""
+        return {"time_count": dict(self.time_count)}
+
+    def set_checkpoint_state(self, state):
+        """Restore the scheduled activity of the calendar."""
+        self.time_count = SortedDict(state["time_count"])
+
+    def schedule(self, time, count=1):
+        """Schedule activity at the given time.
+
+        Parameters
+        ----------
+        time : float
+            The (real) time of the activity
+        count : int
+            Number of agents active at the given time
+        """
+        self.time_count[time] = self.time_count.get(time, 0) + count
+
+    def next_activity_time(self, after):
+        """Return the time of the next activity.
+
+        Parameters
+        ----------
+        after : float
+            Only activities at or after this time are considered
+
+        Returns
+        -------
+        float or None
+            Time of the next scheduled activity
+            or None if there is no scheduled activity
+        """
+        index = self.time_count.bisect_left(after)
+        if index == len(self.time_count):
+            return None
+        return self.time_count.peekitem(index)[0]
+
+    def discard_before(self, time):
+        """Discard the activities scheduled before the given time.
+
+        Parameters
+        ----------
+        time : float
+            Activities before this time are discarded
+        """
+        index = self.time_count.bisect_left(time)
+        for _ in range(index):
+            self.time_count.popitem(0)
+
+    def activity_count(self, start, end):
+        """Return the number of activities in the given period.
+
+        Parameters
+        ----------
+        start : float
+            Start of the period (inclusive)
+        end : float
+            End of the period (exclusive)
+
+        Returns
+        -------
+        int
+            The number of scheduled activities
+        """
+        return sum(
+            self.time_count[t]
+            for t in self.time_count.irange(start, end, inclusive=(True, False))
+        )
+
+
+class ActivityTimestepGenerator(TimestepGenerator):
+    """Generate variable length timesteps driven by scheduled activity.
+
+    The `ActivityTimestepGenerator` consults a local activity source
+    for the time of the next scheduled activity.
+    Idle periods without any scheduled activity are coalesced
+    into a single timestep of at most `max_step` length.
+    Timesteps containing activity are `min_step` long;
+    if `max_activity` is given, they are extended
+    (up to `max_step`) as long as the number of activities
+    in the timestep does not exceed `max_activity`.
+
+    The activity source is a local actor
+    (e.g. an `EventCalendar` or a state store)
+    with the method `next_activity_time(after)`.
+    To use `max_activity` it must also have the method
+    `activity_count(start, end)`.
+    If the source has the method `discard_before(time)`,
+    it is called with the start of every timestep,
+    so that the source can drop activity that has passed.
+    See `EventCalendar` for the semantics of the methods.
+
+    Only activity that has been scheduled with the source is seen.
+    In particular, agents created by the population
+    are not scheduled until a runner has stepped them,
+    and the source is empty at the start of the simulation
+    unless it has been seeded.
+    By default idle periods are thus stepped through
+    (in `max_step` long timesteps) until `end`,
+    which must then be finite.
+    With `stop_when_idle` the simulation ends
+    as soon as there is no more scheduled activity (or at `end`);
+    this should only be used when the source is seeded before the start
+    and every birth is scheduled when it is created.
+    """
+
+    def __init__(
+        self,
+        source_aid,
+        min_step,
+        max_step,
+        start=0.0,
+        end=float("inf"),
+        max_activity=None,
+        stop_when_idle=False,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        source_aid : str
+            ID of the local activity source actor
+        min_step : float
+            Minimum (real) length of a timestep
+        max_step : float
+            Maximum (real) length of a timestep
+        start : float
+            Start (real) time of the simulation
+        end : float
+            End (real) time of the simulation;
+            must be finite unless `stop_when_idle` is True
+        max_activity : int, optional
+            Maximum number of activities in timesteps
+            longer than `min_step`
+        stop_when_idle : bool
+            If True, the simulation ends when there is no more scheduled activity
+            (instead of at `end`)
+        """
+        if not 0 < min_step <= max_step:
+            raise ValueError("Expected 0 < min_step <= max_step")
+        if end == float("inf") and not stop_when_idle:
+            raise ValueError("Expected a finite end unless stop_when_idle is True")
+
+        self.source_aid = source_aid
+        self.min_step = float(min_step)
+        self.max_step = float(max_step)
+        self.end = float(end)
+        self.max_activity = max_activity
+        self.stop_when_idle = stop_when_idle
+
+        self.now = float(start)
+        self.step = 0
+
+    def _extend(self, source, step_end):
+        """Extend the timestep while it contains at most max_activity activities."""
+        max_k = int((self.now + self.max_step - step_end) // self.min_step)
+
+        def fits(k):
+            end = step_end + k * self.min_step
+            return source.activity_count(self.now, end) <= self.max_activity
+
+        if max_k <= 0 or not fits(1):
+            return step_end
+
+        # Exponential search followed by binary search
+        # for the largest number of extra min_steps that fit
+        lo, hi = 1, 2
+        while hi <= max_k and fits(hi):
+            lo, hi = hi, hi * 2
+        hi = min(hi, max_k + 1)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if fits(mid):
+                lo = mid
+            else:
+                hi = mid
+
+        return step_end + lo * self.min_step
+
+    def get_next_timestep(self):
+        """Return the next timestep and associated timeperiods.
+
+        Returns
+        -------
+        timestep : Timestep, optional
+            The current timestep
+        """
+        if self.now >= self.end:
+            return None
+
+        source = asys.local_actor(self.source_aid)
+        if hasattr(source, "discard_before"):
+            source.discard_before(self.now)
+        next_time = source.next_activity_time(self.now)
+        if next_time is None:
+            if self.stop_when_idle:
+                return None
+            next_time = self.end
+
+        step_end = min(next_time + self.min_step, self.now + self.max_step)
+        if self.max_activity is not None and step_end > next_time:
+            step_end = self._extend(source, step_end)
+        step_end = min(step_end, self.end)
+
+        timestep = Timestep(float(self.step), self.now, step_end)
+        self.step += 1
+        self.now = step_end
+
+        return timestep
+
+    def get_checkpoint_state(self):
+        """Return the current step and time of the generator."""
+        return {"step": self.step, "now": self.now}
+
+    def set_checkpoint_state(self, state):
+        """Restore the current step and time of the generator."""
+        self.step = state["step"]
+        self.now = state["now"]
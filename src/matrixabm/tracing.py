@@ -0,0 +1,410 @@
+"""Structured tracing of simulation phases.
+
+The tracing subsystem records begin/end spans of the different phases
+of a Matrix simulation step (balancing, stepping agents, flushing stores, etc.)
+in the Chrome trace event format.
+The resulting traces can be viewed in ``chrome://tracing``
+or in the Perfetto UI (https://ui.perfetto.dev).
+
+Tracing is opt-in.
+It is enabled by setting the environment variable
+``MATRIXABM_TRACE_DIR`` to an existing directory
+(picked up when the Matrix actors are created),
+or by calling `start_tracing` on every rank.
+When tracing is disabled, `span` returns a shared no-op context manager,
+so that instrumented code pays only the cost of a function call.
+
+Every rank buffers its events locally
+and appends them to its own file, ``trace-<rank>.jsonl``,
+in the trace directory.
+Each line of the file is one trace event.
+The per-rank files can be merged into a single Chrome trace file
+with the following command::
+
+    $ matrixabm-trace merge trace.json TRACE_DIR/trace-*.jsonl
+
+In the merged trace every rank is shown as a separate process.
+Timestamps are wall clock based,
+so events on ranks running on the same node are directly comparable.
+"""
+
+import os
+import json
+import time
+import atexit
+from time import perf_counter
+
+import click
+
+from . import asys
+
+TRACE_DIR_EV = "MATRIXABM_TRACE_DIR"
+
+# Number of buffered events after which they are written out
+MAX_BUFFERED_EVENTS = 65536
+
+
+def get_trace_dir():
+    """Return the directory to write the traces to."""
+    trace_dir = os.environ.get(TRACE_DIR_EV, None)
+    if trace_dir is None:
+        return None
+
+    if not os.path.isdir(trace_dir):
+        raise ValueError(
+            f"Environment variable {TRACE_DIR_EV} points to '{trace_dir}' which is not a directory"
+        )
+
+    return trace_dir
+
+
+def _json_default(obj):
+    """Convert numpy scalars and other objects in event args to JSON."""
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+class Tracer:
+    """Rank local trace event buffer.
+
+    Attributes
+    ----------
+    fname : str
+        The file where the trace events are written
+    rank : int
+        The rank of the current process
+    events : list of dict
+        The buffered events
+    offset : float
+        Offset to convert `perf_counter` values to wall clock time
+    """
+
+    def __init__(self, trace_dir, rank):
+        """Initialize.
+
+        Parameters
+        ----------
+        trace_dir : str
+            Directory where the trace file is to be written
+        rank : int
+            Rank of the current process
+        """
+        self.fname = os.path.join(str(trace_dir), "trace-%d.jsonl" % rank)
+        self.rank = rank
+        self.events = []
+        self.offset = time.time() - perf_counter()
+
+        # Truncate any existing trace file
+        with open(self.fname, "w"):
+            pass
+
+        self.events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": rank,
+                "tid": 0,
+                "args": {"name": "Rank %d" % rank},
+            }
+        )
+        self.events.append(
+            {
+                "name": "process_sort_index",
+                "ph": "M",
+                "pid": rank,
+                "tid": 0,
+                "args": {"sort_index": rank},
+            }
+        )
+
+    def _add(self, event):
+        """Buffer an event; write out the buffer if it is full."""
+        self.events.append(event)
+        if len(self.events) >= MAX_BUFFERED_EVENTS:
+            self.flush()
+
+    def complete(self, name, cat, start, end, args=None):
+        """Record a complete (begin and end) event.
+
+        Parameters
+        ----------
+        name : str
+            Name of the span
+        cat : str
+            Category of the span
+        start : float
+            Start time of the span (as returned by `perf_counter`)
+        end : float
+            End time of the span (as returned by `perf_counter`)
+        args : dict, optional
+            Additional data to be shown with the span
+        """
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start + self.offset) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.rank,
+            "tid": 0,
+        }
+        if args:
+            event["args"] = args
+        self._add(event)
+
+    def instant(self, name, cat, args=None):
+        """Record an instant event.
+
+        Parameters
+        ----------
+        name : str
+            Name of the event
+        cat : str
+            Category of the event
+        args : dict, optional
+            Additional data to be shown with the event
+        """
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "p",
+            "ts": (perf_counter() + self.offset) * 1e6,
+            "pid": self.rank,
+            "tid": 0,
+        }
+        if args:
+            event["args"] = args
+        self._add(event)
+
+    def counter(self, name, values):
+        """Record a counter event.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter
+        values : dict [str -> float]
+            The counter series and their values
+        """
+        event = {
+            "name": name,
+            "ph": "C",
+            "ts": (perf_counter() + self.offset) * 1e6,
+            "pid": self.rank,
+            "tid": 0,
+            "args": values,
+        }
+        self._add(event)
+
+    def flush(self):
+        """Write out the buffered events."""
+        if not self.events:
+            return
+
+        with open(self.fname, "a") as fobj:
+            for event in self.events:
+                fobj.write(json.dumps(event, default=_json_default))
+                fobj.write("\n")
+        self.events.clear()
+
+
+class Span:
+    """Context manager recording a complete event on exit."""
+
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        """Initialize."""
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.complete(self.name, self.cat, self.start, perf_counter(), self.args)
+
+
+class NullSpan:
+    """No-op context manager used when tracing is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+_TRACER = None
+
+
+def start_tracing(trace_dir):
+    """Start tracing on the current rank.
+
+    Parameters
+    ----------
+    trace_dir : str
+        Directory where the trace file is to be written
+    """
+    global _TRACER  # pylint: disable=global-statement
+
+    if _TRACER is not None:
+        raise ValueError("Tracing has already been started.")
+
+    _TRACER = Tracer(trace_dir, asys.current_rank())
+    atexit.register(stop_tracing)
+
+
+def start_tracing_from_env():
+    """Start tracing if requested via the environment and not already started."""
+    if _TRACER is not None:
+        return
+
+    trace_dir = get_trace_dir()
+    if trace_dir is not None:
+        start_tracing(trace_dir)
+
+
+def stop_tracing():
+    """Stop tracing on the current rank and write out any buffered events."""
+    global _TRACER  # pylint: disable=global-statement
+
+    if _TRACER is None:
+        return
+
+    _TRACER.flush()
+    _TRACER = None
+
+
+def is_enabled():
+    """Return True if tracing is enabled on the current rank."""
+    return _TRACER is not None
+
+
+def span(name, cat="matrixabm", **args):
+    """Return a context manager that records the enclosed block as a span.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span
+    cat : str
+        Category of the span
+    **args : dict
+        Additional data to be shown with the span
+
+    Returns
+    -------
+    context manager
+    """
+    if _TRACER is None:
+        return NULL_SPAN
+    return Span(_TRACER, name, cat, args)
+
+
+def complete(name, start, end, cat="matrixabm", **args):
+    """Record a span whose start and end time were measured by the caller.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span
+    start : float
+        Start time of the span (as returned by `perf_counter`)
+    end : float
+        End time of the span (as returned by `perf_counter`)
+    cat : str
+        Category of the span
+    **args : dict
+        Additional data to be shown with the span
+    """
+    if _TRACER is None:
+        return
+    _TRACER.complete(name, cat, start, end, args)
+
+
+def instant(name, cat="matrixabm", **args):
+    """Record an instant event.
+
+    Parameters
+    ----------
+    name : str
+        Name of the event
+    cat : str
+        Category of the event
+    **args : dict
+        Additional data to be shown with the event
+    """
+    if _TRACER is None:
+        return
+    _TRACER.instant(name, cat, args)
+
+
+def counter(name, **values):
+    """Record a counter event.
+
+    Parameters
+    ----------
+    name : str
+        Name of the counter
+    **values : dict [str -> float]
+        The counter series and their values
+    """
+    if _TRACER is None:
+        return
+    _TRACER.counter(name, values)
+
+
+def merge_traces(fnames, out_fname):
+    """Merge per-rank trace files into a single Chrome trace file.
+
+    Parameters
+    ----------
+    fnames : list of str
+        The per-rank trace files
+    out_fname : str
+        The merged Chrome trace file
+    """
+    events = []
+    for fname in fnames:
+        with open(fname) as fobj:
+            for line in fobj:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+
+    events.sort(key=lambda e: (e["ph"] != "M", e.get("ts", 0.0)))
+
+    with open(out_fname, "w") as fobj:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fobj)
+
+
+@click.group()
+def cli():
+    """Matrix ABM trace tools."""
+
+
+@cli.command()
+@click.argument("out_fname")
+@click.argument("fnames", nargs=-1, required=True)
+def merge(out_fname, fnames):
+    """Merge per-rank trace files.
+
+    OUT_FNAME is the merged Chrome trace file to be created.
+    FNAMES are the per-rank trace files.
+    """
+    merge_traces(fnames, out_fname)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Strong and weak scaling runs of the BluePill benchmark.
+
+This script runs the BluePill simulation (bluepillsim.py)
+with mpiexec on the local machine
+for a number of different rank counts,
+and collects the individual JSON results into one results file.
+
+In strong scaling mode the total population is kept fixed.
+In weak scaling mode the population per rank is kept fixed.
+All options not understood by this script
+are passed on to bluepillsim.py.
+"""
+
+import os
+import sys
+import json
+import shlex
+import tempfile
+import subprocess
+
+import click
+
+BLUEPILLSIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bluepillsim.py")
+
+
+def run_once(n_ranks, mode, sim_args, mpiexec, work_dir):
+    """Run the simulation once with the given number of ranks.
+
+    Returns
+    -------
+    dict
+        The benchmark results
+    """
+    run_dir = os.path.join(work_dir, "ranks-%d" % n_ranks)
+    os.makedirs(run_dir, exist_ok=True)
+
+    store_path = os.path.join(run_dir, "store.sqlite3")
+    summary_dir = os.path.join(run_dir, "summary")
+    results_file = os.path.join(run_dir, "results.json")
+
+    cmd = shlex.split(mpiexec) + ["-n", str(n_ranks), sys.executable, BLUEPILLSIM]
+    cmd += [store_path, summary_dir, "--results-file", results_file]
+    if mode == "weak":
+        cmd.append("--per-rank")
+    cmd += list(sim_args)
+
+    click.echo("Running: %s" % " ".join(cmd), err=True)
+    subprocess.run(cmd, check=True)
+
+    with open(results_file) as fobj:
+        return json.load(fobj)
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option(
+    "--ranks",
+    default="1,2,4",
+    show_default=True,
+    help="Comma separated list of rank counts.",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(["strong", "weak"]),
+    default="strong",
+    show_default=True,
+    help="Scaling mode.",
+)
+@click.option(
+    "--mpiexec", default="mpiexec", show_default=True, help="The MPI launcher command."
+)
+@click.option(
+    "--work-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory for the store and summary files (default: temporary directory).",
+)
+@click.option(
+    "--output", default="-", type=click.File("w"), help="The combined JSON results file."
+)
+@click.argument("sim_args", nargs=-1, type=click.UNPROCESSED)
+def main(ranks, mode, mpiexec, work_dir, output, sim_args):
+    """Run BluePill scaling experiments.
+
+    SIM_ARGS are passed on to bluepillsim.py.
+    """
+    ranks = [int(r) for r in ranks.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if work_dir is None:
+            work_dir = tmp_dir
+
+        runs = []
+        for n_ranks in ranks:
+            results = run_once(n_ranks, mode, sim_args, mpiexec, work_dir)
+            del results["per_step"]
+            runs.append(results)
+
+    base = runs[0]
+    for results in runs:
+        n_ranks = results["config"]["world_size"]
+        rel_ranks = n_ranks / base["config"]["world_size"]
+        if mode == "strong":
+            speedup = base["wall_time"] / results["wall_time"]
+        else:
+            speedup = (
+                results["agent_steps_per_sec"] / base["agent_steps_per_sec"]
+            )
+        results["speedup"] = speedup
+        results["efficiency"] = speedup / rel_ranks
+
+        click.echo(
+            "ranks=%d wall_time=%.3f agent_steps/s=%.1f updates/s=%.1f speedup=%.2f efficiency=%.2f"
+            % (
+                n_ranks,
+                results["wall_time"],
+                results["agent_steps_per_sec"],
+                results["updates_per_sec"],
+                results["speedup"],
+                results["efficiency"],
+            ),
+            err=True,
+        )
+
+    json.dump({"mode": mode, "runs": runs}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
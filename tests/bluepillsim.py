@@ -5,30 +5,56 @@ In the BluePill simulation
 agents choose change their state in sequence:
 rock -> paper -> scissors -> rock.
 The starting state of every agent is chosen at random.
-State of all agents is stored in a single SQLite3 state store.
+State of all agents is stored in SQLite3 state stores.
 Agent objects themselves store not state information.
+
+The BluePill simulation doubles as a parameterized benchmark
+of the Matrix framework.
+The population size, birth and death rates, number and size of updates,
+agent compute cost, number of stores, and the load balancer
+can be configured from the command line.
+At the end of the simulation,
+the throughput and per-phase times are written to a JSON results file.
 """
 
+import json
 import random
 import logging
+from time import perf_counter
+from collections import defaultdict
 
 import click
+import numpy as np
 
 from matrixabm import (
     asys,
     WORLD_SIZE,
     Agent,
     AgentPopulation,
+    DistributedAgentPopulation,
     RangeTimestepGenerator,
+    ActivityTimestepGenerator,
+    EventCalendar,
     GreedyLoadBalancer,
+    RandomLoadBalancer,
+    GraphLoadBalancer,
     StateUpdate,
     SQLite3Store,
     SQLite3Manager,
+    FlushExecutor,
+    RetentionPolicy,
+    Aggregate,
+    AggregateStore,
     Coordinator,
     Runner,
     Simulator,
     TensorboardWriter,
+    MetricsAggregator,
     Constructor,
+    ConstructorTemplate,
+    SumCombiner,
+    combinable,
+    get_combiners,
 )
 
 
@@ -41,9 +67,39 @@ AID_POPULATION = "population"
 AID_TIMESTEP_GEN = "timestep_gen"
 AID_SUMMARY_WRITER = "summary_writer"
 AID_SQLITE3 = "sqlite3"
+AID_CALENDAR = "calendar"
+AID_METRICS = "metrics"
+AID_FLUSH_EXECUTOR = "flush_executor"
 
 # The database schema name
 STORE_NAME = "bluepill"
+AGGREGATE_STORE_NAME = "bluepill_agg"
+
+# Aggregates of the aggregate store
+AGGREGATES = [
+    Aggregate(
+        "age_by_state",
+        group_by=["state"],
+        stats=["count", "mean", "max"],
+        quantiles=[0.5],
+    )
+]
+
+BALANCERS = {
+    "greedy": GreedyLoadBalancer,
+    "random": RandomLoadBalancer,
+    "graph": GraphLoadBalancer,
+}
+
+
+def get_store_names(n_stores):
+    """Return the names of the stores."""
+    return [STORE_NAME if i == 0 else f"{STORE_NAME}{i}" for i in range(n_stores)]
+
+
+def get_store_paths(store_path, n_stores):
+    """Return the paths of the store files."""
+    return [store_path if i == 0 else f"{store_path}.{i}" for i in range(n_stores)]
 
 
 class BluePillStore(SQLite3Store):
@@ -51,25 +107,85 @@ class BluePillStore(SQLite3Store):
 
     The BluePill store maintains the state of the simulation.
     The store object is a SQLite3 file.
-    The file contains one table called "state".
+    The file contains two tables:
+    "state" with the states of the agents,
+    and "state_count" with the number of agents in every state at every step.
     """
 
-    def __init__(self):
-        """Initialize."""
-        super().__init__(STORE_NAME, AID_SIMULATOR, AID_SQLITE3)
+    def __init__(
+        self,
+        store_name,
+        store_ranks=None,
+        flush_executor=None,
+        keep_steps=None,
+        archive_path=None,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_name : str
+            Name of the store
+        store_ranks : list of int, optional
+            Ranks of the stores (with tree fan-out)
+        flush_executor : str, optional
+            How the stores on a node are flushed together;
+            "shared" to flush them in one transaction on a shared connection,
+            "concurrent" to flush them concurrently on separate connections
+        keep_steps : int, optional
+            If given, only the states of this many recent steps are kept
+            in the state table; older states are counted per step
+            in the "state_summary" table
+        archive_path : str, optional
+            If given (with `keep_steps`), the older states are moved
+            to the state table of this archive database file
+        """
+        if keep_steps is None:
+            retention = None
+        else:
+            policy = RetentionPolicy(
+                "state",
+                "timestep",
+                keep_steps,
+                archive_path=archive_path,
+                group_by=["state"],
+                aggregates={"n_agents": "count(*)"},
+            )
+            retention = [policy]
+
+        super().__init__(
+            store_name,
+            AID_SIMULATOR,
+            AID_SQLITE3,
+            store_ranks,
+            None if flush_executor is None else AID_FLUSH_EXECUTOR,
+            flush_executor == "concurrent",
+            retention,
+        )
 
         # Setup the state table
-        con = asys.local_actor(AID_SQLITE3).connection
+        con = self.connection()
         sql = f"""
             create table if not exists
             {self.store_name}.state (
                 agent_id text,
                 state text,
-                timestep float
+                timestep float,
+                payload text
+            )"""
+        con.execute(sql)
+
+        sql = f"""
+            create table if not exists
+            {self.store_name}.state_count (
+                state text,
+                timestep float,
+                count integer,
+                primary key (state, timestep)
             )"""
         con.execute(sql)
 
-    def set_state(self, agent_id, state, step):
+    def set_state(self, agent_id, state, step, payload=""):
         """Set the agent state.
 
         Parameters
@@ -81,10 +197,33 @@ class BluePillStore(SQLite3Store):
             One of "rock", "paper", and "scissors"
         step : int
             The current timestep
+        payload : str
+            Extra data stored with the state
         """
-        con = asys.local_actor(AID_SQLITE3).connection
-        sql = f"insert into {self.store_name}.state values (?,?,?)"
-        con.execute(sql, (agent_id, state, step))
+        con = self.connection()
+        sql = f"insert into {self.store_name}.state values (?,?,?,?)"
+        con.execute(sql, (agent_id, state, step, payload))
+
+    @combinable(SumCombiner(key_args=2))
+    def add_state_count(self, state, step, count):
+        """Add to the number of agents in a state.
+
+        Parameters
+        ----------
+        state : str
+            State of the agents
+        step : int
+            The current timestep
+        count : int
+            Number of agents
+        """
+        con = self.connection()
+        sql = f"""
+            insert into {self.store_name}.state_count values (?,?,?)
+            on conflict (state, timestep) do update
+            set count = count + excluded.count
+            """
+        con.execute(sql, (state, step, count))
 
     @staticmethod
     def get_state(store_name, agent_id):
@@ -126,13 +265,70 @@ class BluePillAgent(Agent):
     rock -> paper -> scissors -> rock.
     """
 
-    def __init__(self, store_name, agent_id):
+    def __init__(
+        self,
+        store_names,
+        agent_id,
+        n_updates=1,
+        payload_size=0,
+        compute_cost=0.0,
+        death_prob=0.5,
+        sleep_time=0.0,
+        count_states=False,
+        aggregate_store=None,
+        interaction_groups=0,
+    ):
+        """Initialize.
+
+        Parameters
+        ----------
+        store_names : list of str
+            Names of the stores to send updates to
+        agent_id : str
+            ID of the agent
+        n_updates : int
+            Number of updates produced per step
+        payload_size : int
+            Size of the extra payload sent with every update (in bytes)
+        compute_cost : float
+            Time spent computing every step (in seconds)
+        death_prob : float
+            Probability of the agent dying at every step
+        sleep_time : float
+            Time the agent sleeps after every step
+        count_states : bool
+            If True, the agent also adds itself to the state counts
+        aggregate_store : str, optional
+            If given, the agent observes its age in this aggregate store
+        interaction_groups : int
+            If positive, the agent interacts with the other agents
+            of one of this many (random) groups
+        """
         self.agent_id = agent_id
-        self.store_name = store_name
+        self.store_names = store_names
+        self.n_updates = n_updates
+        self.payload_size = payload_size
+        self.compute_cost = compute_cost
+        self.death_prob = death_prob
+        self.sleep_time = sleep_time
+        self.count_states = count_states
+        self.aggregate_store = aggregate_store
+        if interaction_groups > 0:
+            self.interaction_group = random.randrange(interaction_groups)
+        else:
+            self.interaction_group = None
+        self.age = 0
+        self.wake_time = None
         self.state = random.choice(["rock", "paper", "scissors"])
 
     def step(self, timestep):
         """Return the step update."""
+        # Simulate the agent's compute cost
+        if self.compute_cost > 0:
+            end_time = perf_counter() + self.compute_cost
+            while perf_counter() < end_time:
+                pass
+
         # Compute local state change
         if self.state == "rock":
             self.state = "paper"
@@ -141,20 +337,63 @@ class BluePillAgent(Agent):
         else:  # self.state == "scissors"
             self.state = "paper"
 
-        # Compute order key of next state
-        order_key = f"{timestep.step}-{self.agent_id}"
-
-        # Make the update
-        update = StateUpdate(
-            self.store_name,
-            order_key,
-            "set_state",
-            self.agent_id,
-            self.state,
-            timestep.step,
-        )
+        if self.sleep_time > 0:
+            self.wake_time = timestep.end + self.sleep_time
+
+        payload = "x" * self.payload_size
+
+        updates = []
+        for i in range(self.n_updates):
+            store_name = self.store_names[i % len(self.store_names)]
+
+            # Compute order key of next state
+            order_key = f"{timestep.step}-{self.agent_id}-{i}"
+
+            # Make the update
+            update = StateUpdate(
+                store_name,
+                order_key,
+                "set_state",
+                self.agent_id,
+                self.state,
+                timestep.step,
+                payload,
+            )
+            updates.append(update)
+
+        if self.count_states:
+            order_key = f"{timestep.step}-{self.agent_id}-count"
+            update = StateUpdate(
+                self.store_names[0],
+                order_key,
+                "add_state_count",
+                self.state,
+                timestep.step,
+                1,
+            )
+            updates.append(update)
+
+        if self.aggregate_store is not None:
+            self.age += 1
+            order_key = f"{timestep.step}-{self.agent_id}-age"
+            update = StateUpdate(
+                self.aggregate_store,
+                order_key,
+                "observe",
+                "age_by_state",
+                timestep.step,
+                self.state,
+                self.age,
+            )
+            updates.append(update)
 
-        return [update]
+        return updates
+
+    def interaction_keys(self):
+        """Return the interaction group of the agent."""
+        if self.interaction_group is None:
+            return None
+        return [("group", self.interaction_group)]
 
     def memory_usage(self):
         """Return the memory usage."""
@@ -162,50 +401,272 @@ class BluePillAgent(Agent):
 
     def is_alive(self):
         """Return if the agent is alive or not."""
-        return random.choice((True, False))
+        return random.random() >= self.death_prob
+
+    def next_wake_time(self):
+        """Return the next wake time."""
+        return self.wake_time
+
+    def is_idle(self):
+        """Return if the agent is idle (while sleeping)."""
+        return self.sleep_time > 0
 
 
 class BluePillPopulation(AgentPopulation):
     """Blue Pill Agent Population.
 
-    At every timestep between 100 and 200 new agents are created.
+    At every timestep between `min_births` and `max_births` new agents are created.
     """
 
-    def __init__(self):
+    def __init__(self, min_births, max_births, agent_kwargs, bulk_create):
+        """Initialize.
+
+        Parameters
+        ----------
+        min_births : int
+            Minimum number of agents created every step
+        max_births : int
+            Maximum number of agents created every step
+        agent_kwargs : dict
+            Keyword arguments passed to every new agent
+        bulk_create : bool
+            If True, create the agents using a constructor template
+        """
         super().__init__(AID_COORDINATOR)
 
+        self.min_births = min_births
+        self.max_births = max_births
+        self.agent_kwargs = agent_kwargs
+        self.bulk_create = bulk_create
+
     def do_create_agents(self, timestep):
         """Create the new agents for this timestep."""
-        # Decide on the number of agents to create
-        n = random.randint(100, 200)
+        return make_births(
+            f"agent-{timestep.step}",
+            self.min_births,
+            self.max_births,
+            self.agent_kwargs,
+            self.bulk_create,
+        )
+
+
+class DistributedBluePillPopulation(DistributedAgentPopulation):
+    """Blue Pill Agent Population running on every rank.
+
+    At every timestep, on every rank,
+    between `min_births` and `max_births` new agents are created.
+    """
+
+    def __init__(self, min_births, max_births, agent_kwargs, bulk_create):
+        """Initialize.
+
+        Parameters
+        ----------
+        min_births : int
+            Minimum number of agents created every step on this rank
+        max_births : int
+            Maximum number of agents created every step on this rank
+        agent_kwargs : dict
+            Keyword arguments passed to every new agent
+        bulk_create : bool
+            If True, create the agents using a constructor template
+        """
+        super().__init__(AID_COORDINATOR, AID_RUNNER)
 
-        ret = []
+        self.min_births = min_births
+        self.max_births = max_births
+        self.agent_kwargs = agent_kwargs
+        self.bulk_create = bulk_create
+
+    def do_create_agents(self, timestep):
+        """Create the new agents of this rank for this timestep."""
+        return make_births(
+            f"agent-{timestep.step}-{asys.current_rank()}",
+            self.min_births,
+            self.max_births,
+            self.agent_kwargs,
+            self.bulk_create,
+        )
+
+
+def make_births(prefix, min_births, max_births, agent_kwargs, bulk_create):
+    """Make between `min_births` and `max_births` new agents."""
+    # Decide on the number of agents to create
+    n = random.randint(min_births, max_births)
+
+    if bulk_create:
+        template = ConstructorTemplate(BluePillAgent, **agent_kwargs)
         for i in range(n):
-            agent_id = f"agent-{timestep.step}-{i}"
-            constructor = Constructor(BluePillAgent, STORE_NAME, agent_id)
-            step_time = 1.0
-            memory_usage = 1.0
-            ret.append((agent_id, constructor, step_time, memory_usage))
+            agent_id = f"{prefix}-{i}"
+            template.add(agent_id, agent_id=agent_id)
+        step_time = 1.0
+        memory_usage = 1.0
+        return [(template, step_time, memory_usage)]
+
+    ret = []
+    for i in range(n):
+        agent_id = f"{prefix}-{i}"
+        constructor = Constructor(BluePillAgent, agent_id=agent_id, **agent_kwargs)
+        step_time = 1.0
+        memory_usage = 1.0
+        ret.append((agent_id, constructor, step_time, memory_usage))
+
+    return ret
+
+
+def summarize(values):
+    """Return the summary statistics of a list of values."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return None
 
-        return ret
+    return {
+        "total": float(values.sum()),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "median": float(np.median(values)),
+    }
+
+
+class BenchmarkWriter(TensorboardWriter):
+    """Summary writer that also collects benchmark results.
+
+    The benchmark writer records the scalars
+    written by the Simulator and the Coordinator,
+    and on close writes the throughput and per-phase times
+    to a JSON results file.
+    """
+
+    def __init__(self, summary_dir, results_file, config):
+        """Initialize.
+
+        Parameters
+        ----------
+        summary_dir : str
+            The summary directory
+        results_file : str
+            The JSON file where the results are to be written
+        config : dict
+            The benchmark configuration
+        """
+        super().__init__(summary_dir)
+
+        self.results_file = results_file
+        self.config = config
+        self.step_scalars = defaultdict(dict)
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        """Record a scalar and pass it on to the tensorboard writer."""
+        self.step_scalars[global_step][tag] = scalar_value
+        super().add_scalar(tag, scalar_value, global_step)
+
+    def get_results(self):
+        """Compute the benchmark results."""
+        per_step = []
+        for step in sorted(self.step_scalars):
+            scalars = self.step_scalars[step]
+            if "round_time" not in scalars:
+                continue
+
+            rank_step_time = [
+                v for k, v in scalars.items() if k.startswith("rank_step_time/")
+            ]
+            store_flush_time = [
+                v for k, v in scalars.items() if k.startswith("store_flush_time/")
+            ]
+            per_step.append(
+                {
+                    "step": step,
+                    "round_time": scalars["round_time"],
+                    "balancing_time": scalars.get("balancing_time", 0.0),
+                    "max_rank_step_time": max(rank_step_time, default=0.0),
+                    "total_rank_step_time": sum(rank_step_time),
+                    "max_store_flush_time": max(store_flush_time, default=0.0),
+                    "num_agents_stepped": scalars.get("num_agents_stepped", 0),
+                    "num_updates": scalars.get("num_updates", 0),
+                    "num_residual_population": scalars.get(
+                        "num_residual_population", 0
+                    ),
+                }
+            )
+
+        wall_time = sum(s["round_time"] for s in per_step)
+        agent_steps = sum(s["num_agents_stepped"] for s in per_step)
+        updates = sum(s["num_updates"] for s in per_step)
+
+        phase_names = [
+            "round_time",
+            "balancing_time",
+            "max_rank_step_time",
+            "total_rank_step_time",
+            "max_store_flush_time",
+        ]
+        phases = {
+            name: summarize([s[name] for s in per_step]) for name in phase_names
+        }
+
+        return {
+            "config": self.config,
+            "n_steps": len(per_step),
+            "wall_time": wall_time,
+            "agent_steps": agent_steps,
+            "updates": updates,
+            "agent_steps_per_sec": agent_steps / wall_time if wall_time else None,
+            "updates_per_sec": updates / wall_time if wall_time else None,
+            "phases": phases,
+            "summaries_dropped": self.num_dropped,
+            "per_step": per_step,
+        }
+
+    def close(self):
+        """Write out the results and close the summary writer."""
+        if self.results_file is not None:
+            with open(self.results_file, "w") as fobj:
+                json.dump(self.get_results(), fobj, indent=2)
+            self.results_file = None
+
+        super().close()
 
 
 class Main:
     """The main actor."""
 
-    def __init__(self, store_path, summary_dir):
+    def __init__(self, store_path, summary_dir, results_file, config):
         """Initialize.
 
         store_path : str
             Path to the local sqlite3 file
         summary_dir : str
             Directory where runtime summary is to be written
+        results_file : str
+            File where the benchmark results are to be written
+        config : dict
+            The simulation configuration
         """
         self.store_path = store_path
         self.summary_dir = summary_dir
+        self.results_file = results_file
+        self.config = config
 
     def main(self):
         """Setup the connectors on the ranks."""
+        config = self.config
+        config["n_nodes"] = len(asys.nodes())
+        store_names = get_store_names(config["n_stores"])
+        store_paths = get_store_paths(self.store_path, config["n_stores"])
+        state_store_names = list(store_names)
+        if config["aggregate_states"]:
+            store_names.append(AGGREGATE_STORE_NAME)
+            store_paths.append(self.store_path + ".agg")
+
+        # The stores are on the first rank of every node
+        store_ranks = [asys.node_ranks(node)[0] for node in asys.nodes()]
+        store_proxies = {
+            name: asys.ActorProxy(store_ranks, name) for name in store_names
+        }
+        calendar_aid = AID_CALENDAR if config["max_step"] is not None else None
+
         # Create the simulator
         asys.create_actor(
             asys.MASTER_RANK,
@@ -215,11 +676,18 @@ class Main:
             runner_aid=AID_RUNNER,
             population_aid=AID_POPULATION,
             timestep_generator_aid=AID_TIMESTEP_GEN,
-            store_names=[STORE_NAME],
+            store_names=store_names,
+            summary_writer_aid=AID_SUMMARY_WRITER,
+            distributed_population=config["distributed_population"],
+            store_proxies=store_proxies,
+            checkpoint_dir=config["checkpoint_dir"],
+            checkpoint_every=config["checkpoint_every"],
+            checkpoint_aids=[] if calendar_aid is None else [calendar_aid],
+            restore=config["restore"],
         )
 
         # Create the coordinator
-        load_balancer = GreedyLoadBalancer(WORLD_SIZE)
+        load_balancer = BALANCERS[config["balancer"]](WORLD_SIZE)
         asys.create_actor(
             asys.MASTER_RANK,
             AID_COORDINATOR,
@@ -228,42 +696,151 @@ class Main:
             AID_SIMULATOR,
             AID_RUNNER,
             AID_SUMMARY_WRITER,
+            config["distributed_population"],
         )
 
         # Create the SQLite3 connection managers on every rank
         for rank in asys.ranks():
-            asys.create_actor(
-                rank, AID_SQLITE3, SQLite3Manager, [STORE_NAME], [self.store_path]
-            )
+            asys.create_actor(rank, AID_SQLITE3, SQLite3Manager, store_names, store_paths)
 
-        # Create a store on the first rank of every node
-        store_ranks = {STORE_NAME: []}
-        for node in asys.nodes():
-            rank = asys.node_ranks(node)[0]
-            store_ranks[STORE_NAME].append(rank)
-        store_proxies = {
-            name: asys.ActorProxy(store_ranks[name], STORE_NAME)
-            for name, ranks in store_ranks.items()
-        }
-        store_proxies[STORE_NAME].create_actor_(BluePillStore)
+        # Create the flush executors on the first rank of every node
+        if config["flush_executor"] is not None:
+            for rank in store_ranks:
+                asys.create_actor(rank, AID_FLUSH_EXECUTOR, FlushExecutor, store_names)
+
+        # Create the stores on the first rank of every node
+        tree_ranks = store_ranks if config["tree_fanout"] else None
+        for name, path in zip(state_store_names, store_paths):
+            store_proxies[name].create_actor_(
+                BluePillStore,
+                name,
+                tree_ranks,
+                config["flush_executor"],
+                config["keep_steps"],
+                path + ".archive" if config["archive"] else None,
+            )
+        if config["aggregate_states"]:
+            store_proxies[AGGREGATE_STORE_NAME].create_actor_(
+                AggregateStore,
+                AGGREGATE_STORE_NAME,
+                AID_SIMULATOR,
+                AID_SQLITE3,
+                AGGREGATES,
+                store_ranks=tree_ranks,
+                flush_executor_aid=(
+                    None if config["flush_executor"] is None else AID_FLUSH_EXECUTOR
+                ),
+                separate_connection=config["flush_executor"] == "concurrent",
+            )
 
         # Create the runners on every rank
-        for rank in asys.ranks():
+        for node_store_rank, node in zip(store_ranks, asys.nodes()):
+            if config["tree_fanout"]:
+                # The runners only send updates to the stores on their node
+                runner_store_proxies = {
+                    name: asys.ActorProxy(node_store_rank, name) for name in store_names
+                }
+            else:
+                runner_store_proxies = store_proxies
+            for rank in asys.node_ranks(node):
+                asys.create_actor(
+                    rank,
+                    AID_RUNNER,
+                    Runner,
+                    runner_store_proxies,
+                    AID_COORDINATOR,
+                    AID_RUNNER,
+                    calendar_aid,
+                    AID_METRICS,
+                    config["profile_every"],
+                    config["measure_memory_every"],
+                    config["hibernate_dir"],
+                    config["hibernate_after"],
+                    config["steal_chunk_size"],
+                    {name: get_combiners(BluePillStore) for name in state_store_names},
+                    config["tree_fanout"],
+                    observe_interactions=config["interaction_groups"] > 0,
+                    trace_memory=config["trace_memory"],
+                )
+
+        # Create the timestep generator
+        if config["max_step"] is None:
             asys.create_actor(
-                rank, AID_RUNNER, Runner, store_proxies, AID_COORDINATOR, AID_RUNNER
+                asys.MASTER_RANK,
+                AID_TIMESTEP_GEN,
+                RangeTimestepGenerator,
+                config["n_steps"],
+            )
+        else:
+            asys.create_actor(asys.MASTER_RANK, AID_CALENDAR, EventCalendar)
+            asys.create_actor(
+                asys.MASTER_RANK,
+                AID_TIMESTEP_GEN,
+                ActivityTimestepGenerator,
+                AID_CALENDAR,
+                min_step=1.0,
+                max_step=config["max_step"],
+                end=config["n_steps"],
+                stop_when_idle=False,
             )
 
-        # Create the timestep generator
-        asys.create_actor(
-            asys.MASTER_RANK, AID_TIMESTEP_GEN, RangeTimestepGenerator, 10
+        # Create the agent population
+        births_scale = WORLD_SIZE if config["per_rank"] else 1
+        agent_kwargs = dict(
+            store_names=state_store_names,
+            n_updates=config["updates_per_agent"],
+            payload_size=config["payload_size"],
+            compute_cost=config["compute_cost"] * 1e-6,
+            death_prob=config["death_prob"],
+            sleep_time=config["sleep_time"],
+            count_states=config["count_states"],
+            aggregate_store=(
+                AGGREGATE_STORE_NAME if config["aggregate_states"] else None
+            ),
+            interaction_groups=config["interaction_groups"],
         )
+        if config["distributed_population"]:
+            # Every rank creates its share of the births
+            for rank in asys.ranks():
+                min_births = config["min_births"] * births_scale // WORLD_SIZE
+                max_births = config["max_births"] * births_scale // WORLD_SIZE
+                asys.create_actor(
+                    rank,
+                    AID_POPULATION,
+                    DistributedBluePillPopulation,
+                    min_births,
+                    max_births,
+                    agent_kwargs,
+                    config["bulk_create"],
+                )
+        else:
+            asys.create_actor(
+                asys.MASTER_RANK,
+                AID_POPULATION,
+                BluePillPopulation,
+                config["min_births"] * births_scale,
+                config["max_births"] * births_scale,
+                agent_kwargs,
+                config["bulk_create"],
+            )
 
-        # Create the agent population
-        asys.create_actor(asys.MASTER_RANK, AID_POPULATION, BluePillPopulation)
+        # Create the metrics aggregator
+        asys.create_actor(
+            asys.MASTER_RANK,
+            AID_METRICS,
+            MetricsAggregator,
+            AID_SUMMARY_WRITER,
+            config["metrics_file"],
+        )
 
         # Create the tensorboard summary directory manager
         asys.create_actor(
-            asys.MASTER_RANK, AID_SUMMARY_WRITER, TensorboardWriter, self.summary_dir
+            asys.MASTER_RANK,
+            AID_SUMMARY_WRITER,
+            BenchmarkWriter,
+            self.summary_dir,
+            self.results_file,
+            config,
         )
 
         # Start the simulator
@@ -273,13 +850,194 @@ class Main:
 @click.command()
 @click.argument("store_path")
 @click.argument("summary_dir")
-def main(store_path, summary_dir):
+@click.option(
+    "--n-steps",
+    default=10,
+    show_default=True,
+    help="Number of timesteps (length of the simulated time with --max-step).",
+)
+@click.option(
+    "--min-births", default=100, show_default=True, help="Minimum births per step."
+)
+@click.option(
+    "--max-births", default=200, show_default=True, help="Maximum births per step."
+)
+@click.option(
+    "--per-rank",
+    is_flag=True,
+    help="Scale the births by the number of ranks (weak scaling).",
+)
+@click.option(
+    "--death-prob",
+    default=0.5,
+    show_default=True,
+    help="Probability of an agent dying every step.",
+)
+@click.option(
+    "--updates-per-agent",
+    default=1,
+    show_default=True,
+    help="Number of updates sent by an agent every step.",
+)
+@click.option(
+    "--payload-size",
+    default=0,
+    show_default=True,
+    help="Extra payload sent with every update (in bytes).",
+)
+@click.option(
+    "--compute-cost",
+    default=0.0,
+    show_default=True,
+    help="Compute time of every agent step (in microseconds).",
+)
+@click.option(
+    "--sleep-time",
+    default=0.0,
+    show_default=True,
+    help="Time an agent sleeps after every step.",
+)
+@click.option(
+    "--max-step",
+    default=None,
+    type=float,
+    help="Use activity driven timesteps of at most this length.",
+)
+@click.option(
+    "--distributed-population",
+    is_flag=True,
+    help="Create the agents on every rank instead of on the master rank.",
+)
+@click.option(
+    "--bulk-create",
+    is_flag=True,
+    help="Create the agents of every step using a constructor template.",
+)
+@click.option(
+    "--profile-every",
+    default=1,
+    show_default=True,
+    help="Profile every agent individually once every this many steps.",
+)
+@click.option(
+    "--measure-memory-every",
+    default=None,
+    type=int,
+    help="Measure the agents' memory usage once every this many steps.",
+)
+@click.option(
+    "--trace-memory",
+    is_flag=True,
+    help="Correct the measured memory usage with tracemalloc instead of RSS.",
+)
+@click.option(
+    "--hibernate-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory where the sleeping agents are hibernated.",
+)
+@click.option(
+    "--hibernate-after",
+    default=None,
+    type=int,
+    help="Hibernate sleeping agents without updates in this many steps.",
+)
+@click.option(
+    "--count-states",
+    is_flag=True,
+    help="Count the agents in every state (with combined updates).",
+)
+@click.option(
+    "--aggregate-states",
+    is_flag=True,
+    help="Aggregate the agents' ages by state in an aggregate store.",
+)
+@click.option(
+    "--keep-steps",
+    default=None,
+    type=int,
+    help="Keep only the states of this many recent steps in the state table.",
+)
+@click.option(
+    "--archive",
+    is_flag=True,
+    help="Move the older states to an archive file (with --keep-steps).",
+)
+@click.option(
+    "--flush-executor",
+    type=click.Choice(["shared", "concurrent"]),
+    default=None,
+    help="Flush the stores of a node together, in one transaction or concurrently.",
+)
+@click.option(
+    "--tree-fanout",
+    is_flag=True,
+    help="Forward the updates between the nodes' stores along a tree.",
+)
+@click.option(
+    "--steal-chunk-size",
+    default=None,
+    type=int,
+    help="Enable work stealing, stepping agents in chunks of this size.",
+)
+@click.option(
+    "--checkpoint-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory where the checkpoints are written.",
+)
+@click.option(
+    "--checkpoint-every",
+    default=None,
+    type=int,
+    help="Write a checkpoint every this many steps.",
+)
+@click.option(
+    "--restore",
+    is_flag=True,
+    help="Restore from the latest checkpoint in the checkpoint directory.",
+)
+@click.option("--n-stores", default=1, show_default=True, help="Number of stores.")
+@click.option(
+    "--balancer",
+    type=click.Choice(sorted(BALANCERS)),
+    default="greedy",
+    show_default=True,
+    help="The load balancer.",
+)
+@click.option(
+    "--interaction-groups",
+    default=0,
+    show_default=True,
+    help="Number of groups of interacting agents "
+    "(observed by the runners for the graph load balancer).",
+)
+@click.option("--seed", default=None, type=int, help="Random seed.")
+@click.option(
+    "--metrics-file",
+    default=None,
+    type=click.Path(),
+    help="File where the OpenMetrics text metrics are to be written.",
+)
+@click.option(
+    "--results-file",
+    default=None,
+    type=click.Path(),
+    help="File where the JSON benchmark results are to be written.",
+)
+def main(store_path, summary_dir, results_file, seed, **config):
     """Run a Blue Pill simulation.
 
     STORE_PATH should point the file when the SQLite3 store file should be created.
+    With multiple stores, the i-th additional store is created at STORE_PATH.i .
     SUMMARY_DIR should point to the directory where runtime summary is to be written.
     """
-    asys.start(AID_MAIN, Main, store_path, summary_dir)
+    if seed is not None:
+        random.seed(seed + asys.current_rank())
+
+    config["seed"] = seed
+    config["world_size"] = WORLD_SIZE
+    asys.start(AID_MAIN, Main, store_path, summary_dir, results_file, config)
 
 
 if __name__ == "__main__":
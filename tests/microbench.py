@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the Matrix ABM hot components.
+
+The benchmarks in this script exercise individual components
+in isolation, without starting the actor system:
+
+* ``balance``: `GreedyLoadBalancer.balance` with a given number of objects
+  (and `GraphLoadBalancer.balance` refining a partition of a contact graph)
+* ``update_sort``: sorting of `StateUpdate` objects (as done during store flush)
+* ``update_apply``: `StateUpdate.apply` on a no-op store
+* ``sqlite3_flush``: `SQLite3Store.flush` throughput per update method
+* ``runner_step``: `Runner.do_step` per agent overhead with stub proxies
+  (with every agent profiled, or with sampled profiling)
+* ``spatial_index``: building a `SpatialIndex`
+  and a batched radius query around every agent
+* ``graph``: batched neighbour and attribute reads of a `CSRGraph`,
+  and bulk edge updates
+
+Every benchmark is run with a fixed random seed,
+after a warmup run, a given number of times;
+the minimum and median times are reported.
+The results can be saved to a JSON file
+and compared against a previously saved baseline.
+
+Example::
+
+    $ python tests/microbench.py --output baseline.json
+    $ python tests/microbench.py --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import tempfile
+import platform
+import statistics
+from time import perf_counter
+
+import click
+import numpy as np
+
+from matrixabm import (
+    Agent,
+    Constructor,
+    Runner,
+    Timestep,
+    StateUpdate,
+    SQLite3Store,
+    GreedyLoadBalancer,
+    GraphLoadBalancer,
+    SumCombiner,
+    SpatialIndex,
+    CSRGraph,
+)
+
+SEED = 42
+
+
+class StubProxy:
+    """Actor proxy replacement that drops all messages."""
+
+    def __getattr__(self, method):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        pass
+
+
+class NullStore:
+    """Store with a no-op update method."""
+
+    def set_state(self, *args, **kwargs):
+        """Do nothing."""
+
+
+class BenchAgent(Agent):
+    """Agent producing a fixed number of updates every step."""
+
+    def __init__(self, agent_id, n_updates):
+        self.agent_id = agent_id
+        self.n_updates = n_updates
+
+    def step(self, timestep):
+        """Return the step updates."""
+        return [
+            StateUpdate("bench", self.agent_id, "set_state", self.agent_id, i)
+            for i in range(self.n_updates)
+        ]
+
+    def memory_usage(self):
+        """Return the memory usage."""
+        return 1.0
+
+    def is_alive(self):
+        """Return if the agent is alive or not."""
+        return True
+
+
+class CountAgent(BenchAgent):
+    """Agent adding to one of 100 shared counters every step."""
+
+    def step(self, timestep):
+        """Return the step updates."""
+        cell = hash(self.agent_id) % 100
+        return [
+            StateUpdate("bench", self.agent_id, "add_count", cell, 1)
+            for _ in range(self.n_updates)
+        ]
+
+
+class BenchStore(SQLite3Store):
+    """SQLite3 store using a private connection."""
+
+    def __init__(self, con):
+        super().__init__("bench", "simulator", None)
+        self.con = con
+
+        con.execute("drop table if exists bench.state")
+        con.execute(
+            "create table bench.state (agent_id text primary key, value int, step float)"
+        )
+
+    def connection(self):
+        """Return the private connection."""
+        return self.con
+
+    def set_state(self, agent_id, value, step):
+        """Insert or replace the state of the agent."""
+        self.execute(
+            "insert or replace into bench.state values (?,?,?)",
+            (agent_id, value, step),
+        )
+
+
+def make_updates(n, method, unique):
+    """Make updates in random order."""
+    updates = []
+    for i in range(n):
+        agent_id = "agent-%d" % (i if unique else i % 1000)
+        if method == "set_state":
+            args = (agent_id, i, 0.0)
+        else:
+            args = ("state", agent_id, i, 0.0)
+        updates.append(StateUpdate("bench", "0-%s-%d" % (agent_id, i), method, *args))
+    random.shuffle(updates)
+    return updates
+
+
+def bench_balance(n):
+    """Time `GreedyLoadBalancer.balance` with n objects in 64 buckets."""
+    balancer = GreedyLoadBalancer(64)
+    for o in range(n):
+        balancer.add_object(o, random.random(), random.random())
+    balancer.reset()
+
+    # Skew the load so that the balancer has work to do
+    for o in range(0, n, 3):
+        balancer.update_load(o, random.random() * 10, random.random() * 10)
+
+    start_time = perf_counter()
+    balancer.balance()
+    return perf_counter() - start_time
+
+
+def bench_graph_balance(n):
+    """Time `GraphLoadBalancer.balance` with n objects in 64 buckets.
+
+    The objects interact with 10 others on average,
+    mostly with objects having nearby handles.
+    The first (placing) balance step is not timed.
+    """
+    rng = np.random.default_rng(SEED)
+    objects_a = rng.integers(0, n, 5 * n)
+    near = np.clip(objects_a + rng.integers(-50, 50, 5 * n), 0, n - 1)
+    far = rng.integers(0, n, 5 * n)
+    objects_b = np.where(rng.random(5 * n) < 0.9, near, far)
+
+    balancer = GraphLoadBalancer(64)
+    for o in range(n):
+        balancer.add_object(o, 1.0, 1.0)
+    balancer.add_interactions(objects_a, objects_b)
+    balancer.balance()
+    balancer.reset()
+
+    # Skew the load so that the balancer has work to do
+    for o in range(0, n, 3):
+        balancer.update_load(o, random.random() * 10, random.random() * 10)
+
+    start_time = perf_counter()
+    balancer.balance()
+    return perf_counter() - start_time
+
+
+def bench_update_sort(n):
+    """Time sorting n updates."""
+    updates = make_updates(n, "set_state", True)
+
+    start_time = perf_counter()
+    updates.sort()
+    return perf_counter() - start_time
+
+
+def bench_update_apply(n):
+    """Time applying n updates to a no-op store."""
+    updates = make_updates(n, "set_state", True)
+    store = NullStore()
+
+    start_time = perf_counter()
+    for update in updates:
+        update.apply(store)
+    return perf_counter() - start_time
+
+
+def make_sqlite3_flush_bench(method):
+    """Make a benchmark of flushing n updates with the given store method."""
+
+    def bench_sqlite3_flush(n):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            con = sqlite3.connect(":memory:")
+            con.execute(
+                "attach database ? as bench", (os.path.join(tmp_dir, "bench.sqlite3"),)
+            )
+            try:
+                store = BenchStore(con)
+                for update in make_updates(n, method, method != "insert_or_ignore"):
+                    store.handle_update(update)
+
+                start_time = perf_counter()
+                store.flush()
+                return perf_counter() - start_time
+            finally:
+                con.close()
+
+    bench_sqlite3_flush.__doc__ = "Time flushing n updates using %s." % method
+    return bench_sqlite3_flush
+
+
+def make_runner_step_bench(profile_every, combine=False):
+    """Make a benchmark of `Runner.do_step` with the given profiling interval."""
+    agent_cls = CountAgent if combine else BenchAgent
+    combiners = {"bench": {"add_count": SumCombiner()}} if combine else None
+
+    def bench_runner_step(n):
+        runner = Runner(
+            {"bench": StubProxy()},
+            "coordinator",
+            "runner",
+            profile_every=profile_every,
+            combiners=combiners,
+        )
+        runner.coordinator_proxy = StubProxy()
+        for i in range(n):
+            runner.create_agent(i, Constructor(agent_cls, "agent-%d" % i, 1))
+
+        # New agents are always profiled; time the second step
+        runner.timestep = Timestep(0.0, 0.0, 1.0)
+        runner.do_step()
+        runner.timestep = Timestep(1.0, 1.0, 2.0)
+
+        start_time = perf_counter()
+        runner.do_step()
+        return perf_counter() - start_time
+
+    bench_runner_step.__doc__ = (
+        "Time `Runner.do_step` with n local agents producing one update each, "
+        "profiling every agent once every %d steps." % profile_every
+    )
+    if combine:
+        bench_runner_step.__doc__ += " The updates are combined into 100 counters."
+    return bench_runner_step
+
+
+def make_positions(n):
+    """Make n random 2D positions with about one agent per unit area."""
+    rng = np.random.default_rng(SEED)
+    side = np.sqrt(n)
+    return np.arange(n), rng.uniform(0.0, side, (n, 2))
+
+
+def bench_spatial_build(n):
+    """Time building a spatial index of n agents."""
+    ids, positions = make_positions(n)
+
+    start_time = perf_counter()
+    SpatialIndex(ids, positions, 2.0)
+    return perf_counter() - start_time
+
+
+def bench_spatial_query(n):
+    """Time finding the agents within distance 2 of each of n agents."""
+    ids, positions = make_positions(n)
+    index = SpatialIndex(ids, positions, 2.0)
+
+    start_time = perf_counter()
+    index.query_radius(positions, 2.0)
+    return perf_counter() - start_time
+
+
+def make_graph(n, degree=10):
+    """Make a random contact graph of n nodes with the given out degree."""
+    rng = np.random.default_rng(SEED)
+    src = np.repeat(np.arange(n), degree)
+    dst = rng.integers(0, n, len(src))
+    weight = rng.uniform(0.0, 1.0, len(src)).astype(np.float32)
+    return CSRGraph(n, src, dst, {"weight": weight})
+
+
+def bench_graph_neighbors(n):
+    """Time reading the neighbours and edge weights of n nodes."""
+    graph = make_graph(n)
+    nodes = np.random.default_rng(SEED).permutation(n)
+
+    start_time = perf_counter()
+    graph.edge_attrs(nodes, ["weight"])
+    return perf_counter() - start_time
+
+
+def bench_graph_update(n):
+    """Time adding, removing and reweighting n / 10 edges each."""
+    graph = make_graph(n)
+    rng = np.random.default_rng(SEED)
+    m = n // 10
+    remove = rng.choice(graph.n_edges, m, replace=False)
+    changed = rng.choice(graph.n_edges, m, replace=False)
+    add_src = rng.integers(0, n, m)
+    add_dst = rng.integers(0, n, m)
+
+    start_time = perf_counter()
+    edge_ids = graph.find_edges(add_src, add_dst)
+    new = edge_ids < 0
+    graph.updated(
+        remove,
+        add_src[new],
+        add_dst[new],
+        {"weight": np.ones(new.sum())},
+        {"weight": (changed, np.zeros(m))},
+    )
+    return perf_counter() - start_time
+
+
+BENCHMARKS = {
+    "balance": (bench_balance, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "balance/graph": (bench_graph_balance, [10 ** 4, 10 ** 5]),
+    "update_sort": (bench_update_sort, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "update_apply": (bench_update_apply, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "sqlite3_flush/insert": (make_sqlite3_flush_bench("insert"), [10 ** 4, 10 ** 5]),
+    "sqlite3_flush/insert_or_ignore": (
+        make_sqlite3_flush_bench("insert_or_ignore"),
+        [10 ** 4, 10 ** 5],
+    ),
+    "sqlite3_flush/set_state": (
+        make_sqlite3_flush_bench("set_state"),
+        [10 ** 4, 10 ** 5],
+    ),
+    "runner_step": (make_runner_step_bench(1), [10 ** 3, 10 ** 4, 10 ** 5]),
+    "runner_step/profile_every_8": (
+        make_runner_step_bench(8),
+        [10 ** 3, 10 ** 4, 10 ** 5],
+    ),
+    "runner_step/combined": (
+        make_runner_step_bench(1, combine=True),
+        [10 ** 3, 10 ** 4, 10 ** 5],
+    ),
+    "spatial_index/build": (bench_spatial_build, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "spatial_index/query": (bench_spatial_query, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "graph/neighbors": (bench_graph_neighbors, [10 ** 4, 10 ** 5, 10 ** 6]),
+    "graph/update": (bench_graph_update, [10 ** 4, 10 ** 5, 10 ** 6]),
+}
+
+
+def run_benchmark(func, n, repeat):
+    """Run a benchmark repeatedly.
+
+    Returns
+    -------
+    dict
+        The timing results
+    """
+    random.seed(SEED)
+    func(n)  # warmup
+
+    times = []
+    for _ in range(repeat):
+        random.seed(SEED)
+        times.append(func(n))
+
+    return {
+        "n": n,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "per_item_min": min(times) / n,
+    }
+
+
+def parse_sizes(sizes):
+    """Parse a comma separated list of sizes (e.g. 1e4,1e5)."""
+    if sizes is None:
+        return None
+    return [int(float(s)) for s in sizes.split(",")]
+
+
+@click.command()
+@click.option(
+    "--bench",
+    "bench_names",
+    multiple=True,
+    type=click.Choice(sorted(BENCHMARKS)),
+    help="Benchmark(s) to run (default: all).",
+)
+@click.option(
+    "--sizes", default=None, help="Comma separated list of sizes (e.g. 1e4,1e7)."
+)
+@click.option("--repeat", default=5, show_default=True, help="Number of repetitions.")
+@click.option(
+    "--output", default=None, type=click.Path(), help="Save the results as JSON."
+)
+@click.option(
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True),
+    help="Compare against previously saved results.",
+)
+def main(bench_names, sizes, repeat, output, baseline):
+    """Run the Matrix ABM microbenchmarks."""
+    if not bench_names:
+        bench_names = list(BENCHMARKS)
+    sizes = parse_sizes(sizes)
+
+    baseline_results = {}
+    if baseline is not None:
+        with open(baseline) as fobj:
+            for result in json.load(fobj)["results"]:
+                baseline_results[result["bench"], result["n"]] = result
+
+    results = []
+    for name in bench_names:
+        func, default_sizes = BENCHMARKS[name]
+        for n in sizes or default_sizes:
+            result = run_benchmark(func, n, repeat)
+            result["bench"] = name
+            results.append(result)
+
+            line = "%-32s n=%-9d min=%.6fs median=%.6fs per_item=%.3fus" % (
+                name,
+                n,
+                result["min"],
+                result["median"],
+                result["per_item_min"] * 1e6,
+            )
+            base = baseline_results.get((name, n))
+            if base is not None:
+                ratio = result["min"] / base["min"]
+                result["baseline_ratio"] = ratio
+                line += " vs_baseline=%.2fx" % ratio
+            click.echo(line)
+
+    if output is not None:
+        info = {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "seed": SEED,
+        }
+        with open(output, "w") as fobj:
+            json.dump({"info": info, "results": results}, fobj, indent=2)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter